@@ -1,6 +1,6 @@
 from django import forms
-from django.forms import inlineformset_factory
-from backend.models import LoggedDoc, Author, Category, Country, DocImage
+from django.forms import BaseInlineFormSet, inlineformset_factory
+from backend.models import LoggedDoc, Author, Category, Country, DocImage, DocAuthor, DocCategory, DocCountry
 
 # Create the inline formset class
 class LoggedDocForm(forms.ModelForm):
@@ -9,6 +9,13 @@ class LoggedDocForm(forms.ModelForm):
         fields = ['slug','title', 'source_url', 'publication_date', 'overview','summary_type', 'summary', 'comment', 'llm', 'is_draft']  # Add fields as needed
 
 
+# used by the document pipeline: uniqueness (slug, source_url) is left to the DB constraints, 
+# as documents are written in bulk and a concurrent writer is only detected on insert (see newdocs.doc_processing.add_docs_to_db)
+class PipelineDocForm(LoggedDocForm):
+    def validate_unique(self):
+        pass
+
+
 class DocImageForm(forms.ModelForm):
     class Meta:
         model = DocImage
@@ -16,26 +23,63 @@ class DocImageForm(forms.ModelForm):
 
     set_as_default = forms.BooleanField(required=False)
 
-AuthorFormset = inlineformset_factory(
-    LoggedDoc, Author, 
-    fields=('name',),  # Specify the fields to include
-    extra=1,           # Number of empty forms to display
-    can_delete=True    # Allow deletion of authors
-)
+# authors, categories and countries are edited as names: each form is a link between the document and a name,
+# saving it links the document to the existing name or creates it
+class NameLinkForm(forms.ModelForm):
+    entity_model = None
+    name_field = None
 
-CategoryFormset = inlineformset_factory(
-    LoggedDoc, Category, 
-    fields=('category_name',),  
-    extra=1,           
-    can_delete=True    
-)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields[self.name_field] = forms.CharField(max_length=255)
+        entity = getattr(self.instance, self.entity_field(), None) if self.instance.pk else None
+        if entity is not None:
+            self.initial[self.name_field] = getattr(entity, self.name_field)
 
-CountryFormset = inlineformset_factory(
-    LoggedDoc, Country, 
-    fields=('country_name',),  
-    extra=1,           
-    can_delete=True  
-)
+    @classmethod
+    def entity_field(cls):
+        return cls.entity_model._meta.model_name
+
+    def save(self, commit=True):
+        entity, _ = self.entity_model.objects.get_or_create(**{self.name_field: self.cleaned_data[self.name_field].strip()})
+        setattr(self.instance, self.entity_field(), entity)
+        return super().save(commit)
+
+
+class NameLinkFormSet(BaseInlineFormSet):
+    # prefix of the fields in the edit template (author_set-0-name...)
+    name_prefix = None
+
+    @classmethod
+    def get_default_prefix(cls):
+        return cls.name_prefix
+
+    def clean(self):
+        super().clean()
+        names = [form.cleaned_data[form.name_field].strip() for form in self.forms
+                 if form.cleaned_data.get(form.name_field) and not form.cleaned_data.get("DELETE")]
+        if len(names) != len(set(names)):
+            raise forms.ValidationError("The same name is listed twice")
+
+
+def name_link_formset(link_model, entity_model, name_field, prefix):
+    form = type(f"{link_model.__name__}Form", (NameLinkForm,), {"entity_model": entity_model, "name_field": name_field,
+                                                                 "Meta": type("Meta", (), {"model": link_model, "fields": ()})})
+    formset = type(f"{link_model.__name__}FormSet", (NameLinkFormSet,), {"name_prefix": prefix})
+    return inlineformset_factory(
+        LoggedDoc, link_model,
+        form=form,
+        formset=formset,
+        fields=(),
+        extra=1,           # Number of empty forms to display
+        can_delete=True    # Allow deletion of names
+    )
+
+AuthorFormset = name_link_formset(DocAuthor, Author, "name", "author_set")
+
+CategoryFormset = name_link_formset(DocCategory, Category, "category_name", "category_set")
+
+CountryFormset = name_link_formset(DocCountry, Country, "country_name", "country_set")
 
 DocImageFormSet = inlineformset_factory(
     LoggedDoc, 
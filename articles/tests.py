@@ -1,3 +1,58 @@
+import io
+import os
+import tempfile
+from unittest import mock
+
 from django.test import TestCase
+from PIL import Image
+
+from backend.models import LoggedDoc, StoredImage
+from newdocs.image_processing import process_image
+from newdocs.image_store import store_doc_images
+from newdocs.thumbnails import THUMBNAIL_SIZES, image_files
+
+
+# the writer thread has its own connection, which does not see the transaction of a test
+@mock.patch("backend.sqlite.SQLITE_SINGLE_WRITER", False)
+@mock.patch("articles.views.unindex_docs")
+class DeleteDocumentTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        patcher = mock.patch("newdocs.thumbnails.MEDIA_ROOT", media_root.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.media_root = media_root.name
+
+        # two documents showing the same image, stored once
+        content = io.BytesIO()
+        Image.new("RGB", (640, 480), "orange").save(content, "JPEG")
+        image = process_image(content.getvalue(), THUMBNAIL_SIZES)
+
+        self.docs = [LoggedDoc.objects.create(slug=f"doc-{i}", title=f"doc-{i}", source_url=f"https://example.com/{i}")
+                     for i in range(2)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.image = store_doc_images([(doc, image) for doc in self.docs])[0]
+
+    def delete(self, doc):
+        return self.client.post(f"/document/{doc.slug}/delete", HTTP_HOST="localhost", HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+
+    def files_exist(self):
+        return [os.path.isfile(os.path.join(self.media_root, path)) for path in image_files(self.image)]
+
+    def test_image_kept_while_shown(self, unindex_docs):
+        response = self.delete(self.docs[0])
+
+        self.assertEqual(response.json(), {"deleted":"doc-0"})
+        unindex_docs.assert_called_once_with([self.docs[0].pk])
+        self.assertEqual(StoredImage.objects.get().ref_count, 1)
+        self.assertTrue(all(self.files_exist()))
+
+    def test_last_document_releases_the_image(self, unindex_docs):
+        for doc in self.docs:
+            self.delete(doc)
 
-# Create your tests here.
+        self.assertFalse(LoggedDoc.objects.exists())
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertFalse(any(self.files_exist()))
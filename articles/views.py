@@ -1,20 +1,36 @@
 from django.shortcuts import render, get_object_or_404
 from django.http import JsonResponse
+from django.core.cache import cache
+from django.template.loader import render_to_string
 from articles.forms import AuthorFormset, CategoryFormset, CountryFormset
 from backend.models import LoggedDoc
+from backend.doc_cache import DOC_CACHE_TIMEOUT, doc_cache_enabled, page_key, forget_docs
+from newdocs.embeddings import unindex_docs
+from newdocs.image_store import release_unreferenced
+from backend.sqlite import run_write
 
 # Create your views here.
 def document_details(request, document_slug):
     '''
     Get information of a document and display it in a template
+    The page of the document is cached until it changes (see backend/doc_cache.py)
     '''
 
-    document = get_object_or_404(LoggedDoc, slug=document_slug)
-    authors= document.author_set.all()
-    categories= document.category_set.all()
-    countries= document.country_set.all()
+    doc_id, version = get_object_or_404(LoggedDoc.objects.values_list('id', 'cache_version'), slug=document_slug)
+    key = page_key(doc_id, version)
+    document_html = cache.get(key) if doc_cache_enabled() else None
+
+    if document_html is None:
+        document = LoggedDoc.objects.select_related('default_image').get(id=doc_id)
+        authors= document.authors.order_by('docauthor')
+        categories= document.categories.order_by('doccategory')
+        countries= document.countries.order_by('doccountry')
+
+        document_html = render_to_string('articles/document_page.html', {'document': document, 'authors': authors, 'categories': categories, 'countries': countries}, request=request)
+        if doc_cache_enabled():
+            cache.set(key, document_html, DOC_CACHE_TIMEOUT)
 
-    return render(request, 'articles/document_details.html', {'document': document, 'authors': authors, 'categories': categories, 'countries': countries})
+    return render(request, 'articles/document_details.html', {'document_html': document_html})
 
 
 def edit_document_details(request, document_slug):
@@ -41,6 +57,12 @@ def delete_document(request, document_slug):
 
         if request.headers.get('x-Requested-with') == 'XMLHttpRequest':
             document = get_object_or_404(LoggedDoc, slug=document_slug)
+            doc_id = document.pk
+            version = document.cache_version
             document.delete()
+            forget_docs([(doc_id, version)])
+            unindex_docs([doc_id])
+            # the images only this document showed
+            run_write(release_unreferenced)
             return JsonResponse({'deleted': document_slug})
      
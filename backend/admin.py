@@ -1,21 +1,50 @@
 from django.contrib import admin
+from django.db import transaction
 
 # Register your models here.
-from .models import LoggedDoc, Author, Category, DocImage, Country, ChatFormat, ProcessingLog, OpenaiModel
+from .models import LoggedDoc, Author, Category, DocImage, Country, DocAuthor, DocCategory, DocCountry, ChatFormat, ProcessingLog, OpenaiModel, ProcessingTask, ProcessingJob, CompletionCache, FacetCount, TaskState, StoredImage
+from .doc_cache import bump_versions, forget_docs
+from .sqlite import run_write
+from newdocs.embeddings import unindex_docs
+from newdocs.image_store import release_unreferenced
 
+# the cached tiles and pages of the documents (see backend/doc_cache.py) follow the changes made in the admin
+class DocCacheMixin:
+    def docs_of(self, obj):
+        ''' ids of the documents that show the object '''
+        return list(obj.docs.values_list('id', flat=True))
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        bump_versions(self.docs_of(form.instance))
+
+    def delete_model(self, request, obj):
+        doc_ids = self.docs_of(obj)
+        super().delete_model(request, obj)
+        bump_versions(doc_ids)
+
+    def delete_queryset(self, request, queryset):
+        doc_ids = [doc_id for obj in queryset for doc_id in self.docs_of(obj)]
+        super().delete_queryset(request, queryset)
+        bump_versions(doc_ids)
+
+# names are picked with a search box, the tables hold too many names for a drop-down
 class AuthorInline(admin.TabularInline):
-    model = Author
+    model = DocAuthor
+    autocomplete_fields = ('author',)
     extra = 1
 
 class CategoryInline(admin.TabularInline):
-    model = Category
+    model = DocCategory
+    autocomplete_fields = ('category',)
     extra = 1
 
 class CountryInline(admin.TabularInline):
-    model = Country
+    model = DocCountry
+    autocomplete_fields = ('country',)
     extra = 1
 
-class LoggedDocAdmin(admin.ModelAdmin):
+class LoggedDocAdmin(DocCacheMixin, admin.ModelAdmin):
     list_display = ('title', 'source_url', 'publication_date','is_draft', 'slug', 'summary_type','llm','created_at','modified_at')
     search_fields = ('title', 'source_url', 'is_draft','summary','comment','llm','created_at')
     readonly_fields = ('created_at', 'modified_at')
@@ -23,27 +52,63 @@ class LoggedDocAdmin(admin.ModelAdmin):
     list_filter = ('is_draft','llm','publication_date','created_at', 'modified_at')
     inlines = [AuthorInline, CategoryInline, CountryInline]
 
-class CategoryAdmin(admin.ModelAdmin):
-    list_display = ('category_name', 'doc')
-    search_fields = ('category_name', 'doc')
-    list_filter = ('category_name',)
+    def docs_of(self, obj):
+        return [obj.pk]
+
+    # the deleted documents leave the vector store (see newdocs/embeddings.py) and their images are released once
+    # the deletion is committed: the admin deletes in a transaction, which run_write would wait for
+    def delete_model(self, request, obj):
+        version = (obj.pk, obj.cache_version)
+        super().delete_model(request, obj)
+        forget_docs([version])
+        transaction.on_commit(lambda: unindex_docs([version[0]]))
+        transaction.on_commit(lambda: run_write(release_unreferenced))
+
+    def delete_queryset(self, request, queryset):
+        versions = list(queryset.values_list('id', 'cache_version'))
+        super().delete_queryset(request, queryset)
+        forget_docs(versions)
+        transaction.on_commit(lambda: unindex_docs([doc_id for doc_id, _ in versions]))
+        transaction.on_commit(lambda: run_write(release_unreferenced))
+
+class CategoryAdmin(DocCacheMixin, admin.ModelAdmin):
+    list_display = ('category_name',)
+    search_fields = ('category_name',)
     ordering = ('category_name',)
 
-class AuthorAdmin(admin.ModelAdmin):
-    list_display = ('name', 'doc')
-    search_fields = ('name', 'doc')
-    list_filter = ('name',)
+class AuthorAdmin(DocCacheMixin, admin.ModelAdmin):
+    list_display = ('name',)
+    search_fields = ('name',)
     ordering = ('name',)
 
-class DocImageAdmin(admin.ModelAdmin):
-    list_display = ('image_url', 'doc')
+class DocImageAdmin(DocCacheMixin, admin.ModelAdmin):
+    list_display = ('image_url', 'doc', 'format', 'width', 'height')
     search_fields = ('image', 'doc')
     ordering = ('-created_at',)
+    raw_id_fields = ('stored',)
+
+    def docs_of(self, obj):
+        return [obj.doc_id]
+
+    # the files of the image are deleted once no document shows it (see newdocs/image_store.py),
+    # after the deletion is committed as for the documents
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        transaction.on_commit(lambda: run_write(release_unreferenced))
 
-class CountryAdmin(admin.ModelAdmin):
-    list_display = ('country_name', 'doc')
-    search_fields = ('country_name', 'doc')
-    list_filter = ('country_name',)
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        transaction.on_commit(lambda: run_write(release_unreferenced))
+
+class StoredImageAdmin(admin.ModelAdmin):
+    list_display = ('image_url', 'format', 'width', 'height', 'size', 'ref_count', 'created_at')
+    search_fields = ('sha256', 'image_url')
+    readonly_fields = ('sha256', 'image_url', 'size', 'format', 'width', 'height', 'variants', 'ref_count', 'created_at')
+    ordering = ('-created_at',)
+
+class CountryAdmin(DocCacheMixin, admin.ModelAdmin):
+    list_display = ('country_name',)
+    search_fields = ('country_name',)
     ordering = ('country_name',)
 
 class ChatFormatAdmin(admin.ModelAdmin):
@@ -53,11 +118,45 @@ class ChatFormatAdmin(admin.ModelAdmin):
     ordering = ('chat_name',)
 
 class ProcessingLogAdmin(admin.ModelAdmin):
-    list_display = ('task_id','source_url', 'success', 'llm_turns','llm', 'created_at')
+    list_display = ('task_id','source_url', 'success', 'llm_turns', 'cache_hits', 'cache_misses', 'llm', 'created_at')
     search_fields = ('source_url', 'success', 'llm_turns','llm')
     list_filter = ('task_id','llm','success', 'llm_turns','created_at')
     ordering = ('-created_at',)
 
+class ProcessingJobInline(admin.TabularInline):
+    model = ProcessingJob
+    extra = 0
+    readonly_fields = ('url', 'category', 'status', 'success', 'slug', 'worker', 'claimed_at', 'attempts')
+
+class ProcessingTaskAdmin(admin.ModelAdmin):
+    list_display = ('task_id', 'client', 'model', 'status', 'total_docs', 'created_at', 'modified_at')
+    search_fields = ('task_id',)
+    list_filter = ('status', 'client', 'created_at')
+    ordering = ('-created_at',)
+    inlines = [ProcessingJobInline]
+
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ('url', 'task', 'category', 'status', 'success', 'worker', 'attempts', 'claimed_at')
+    search_fields = ('url', 'worker')
+    list_filter = ('status', 'success', 'category')
+    ordering = ('-created_at',)
+
+class CompletionCacheAdmin(admin.ModelAdmin):
+    list_display = ('key', 'client', 'model', 'hits', 'created_at', 'last_used_at')
+    search_fields = ('key', 'model')
+    list_filter = ('client', 'model', 'created_at')
+    ordering = ('-last_used_at',)
+
+class FacetCountAdmin(admin.ModelAdmin):
+    list_display = ('facet', 'item_id', 'count', 'draft_count')
+    list_filter = ('facet',)
+    ordering = ('facet', '-count')
+
+class TaskStateAdmin(admin.ModelAdmin):
+    list_display = ('key', 'modified_at', 'expires_at')
+    search_fields = ('key',)
+    ordering = ('-modified_at',)
+
 class OpenaiModelAdmin(admin.ModelAdmin):
     list_display = ('model_name', 'context_length', 'accepts_json', 'default')
     ordering = ('model_name',)
@@ -66,7 +165,13 @@ admin.site.register(LoggedDoc, LoggedDocAdmin)
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Author, AuthorAdmin)
 admin.site.register(DocImage, DocImageAdmin)
+admin.site.register(StoredImage, StoredImageAdmin)
 admin.site.register(Country, CountryAdmin)
 admin.site.register(ChatFormat, ChatFormatAdmin)
 admin.site.register(ProcessingLog, ProcessingLogAdmin)
 admin.site.register(OpenaiModel, OpenaiModelAdmin)
+admin.site.register(ProcessingTask, ProcessingTaskAdmin)
+admin.site.register(ProcessingJob, ProcessingJobAdmin)
+admin.site.register(CompletionCache, CompletionCacheAdmin)
+admin.site.register(FacetCount, FacetCountAdmin)
+admin.site.register(TaskState, TaskStateAdmin)
@@ -0,0 +1,61 @@
+from django.db import transaction
+from django.db.models import Min
+
+# Moves the authors, categories and countries from one row per (name, document) to one row per name linked to
+# the documents by DocAuthor, DocCategory and DocCountry (migrations 0008 and 0009).
+# Rows are read by batches of ids, each batch in its own transaction: the first row of each name is kept,
+# the documents of the other rows are linked to it and the other rows are deleted. Running it again resumes the work.
+# It works on the models of migration 0008 (apps of the migration state), the doc column is gone after 0009.
+
+DEDUPE_BATCH_SIZE=5000
+
+# model, name field, link model, field of the link to the model
+RELATED=[("Author", "name", "DocAuthor", "author"),
+         ("Category", "category_name", "DocCategory", "category"),
+         ("Country", "country_name", "DocCountry", "country")]
+
+
+def dedupe_batch(model, field, link, link_field, rows):
+    ''' Links the documents of a batch of (id, name, doc id) rows to the first row of each name and deletes the other rows
+    Returns the number of rows deleted '''
+
+    names={name for _, name, _ in rows}
+    # the first row of a name has the lowest id, so it is in this batch or in one already done and never deleted
+    first=dict(model.objects.filter(**{f"{field}__in":names}).values(field).annotate(first=Min("id")).values_list(field, "first"))
+
+    link.objects.bulk_create([link(doc_id=doc_id, **{f"{link_field}_id":first[name]}) for _, name, doc_id in rows],
+                             ignore_conflicts=True)
+
+    duplicates=[row_id for row_id, name, _ in rows if row_id != first[name]]
+    if not duplicates:
+        return 0
+
+    # an embedding of a duplicate is kept if the first row has none
+    embeddings=dict(model.objects.filter(id__in=duplicates, name_embedding__isnull=False).values_list(field, "name_embedding"))
+    for name, embedding in embeddings.items():
+        model.objects.filter(id=first[name], name_embedding__isnull=True).update(name_embedding=embedding)
+
+    model.objects.filter(id__in=duplicates).delete()
+    return len(duplicates)
+
+def dedupe_names(apps, batch_size=DEDUPE_BATCH_SIZE, log=print):
+    ''' De-duplicates the names of the three tables
+    :apps: models of migration 0008 (the apps passed to RunPython, or those of the migration state) '''
+
+    for model_name, field, link_name, link_field in RELATED:
+        model=apps.get_model("backend", model_name)
+        link=apps.get_model("backend", link_name)
+
+        last_id=0
+        read=deleted=0
+        while True:
+            with transaction.atomic():
+                rows=list(model.objects.filter(id__gt=last_id).order_by("id").values_list("id", field, "doc_id")[:batch_size])
+                if not rows:
+                    break
+                last_id=rows[-1][0]
+                read+=len(rows)
+                deleted+=dedupe_batch(model, field, link, link_field, rows)
+
+        if read:
+            log(f"{model_name}: {read} rows, {read-deleted} distinct names")
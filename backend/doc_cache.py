@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from backend.models import LoggedDoc
+
+# Cache of the rendered tile (home page) and page of each document, keyed on its id and LoggedDoc.cache_version.
+# Every write that changes what a document shows increments its version (save_doc, add_docs_to_db, the admin,
+# renamed authors, categories and countries), so the next request renders it again under the new key
+# and the other documents stay cached. Entries of older versions are never read again and expire after DOC_CACHE_TIMEOUT.
+# The version is read from the database, so the cache stays right when another process changed the document.
+
+DOC_CACHE_TIMEOUT=settings.DOC_CACHE_TIMEOUT
+
+
+def doc_cache_enabled():
+    return DOC_CACHE_TIMEOUT>0
+
+def tile_key(doc_id, version):
+    return f"doc_tile_{doc_id}_{version}"
+
+def page_key(doc_id, version):
+    return f"doc_page_{doc_id}_{version}"
+
+def bump_versions(doc_ids):
+    ''' Invalidates the cached tiles and pages of documents
+    :doc_ids: list of ids, or a queryset of ids (values("id")) '''
+
+    return LoggedDoc.objects.filter(id__in=doc_ids).update(cache_version=F("cache_version")+1)
+
+def forget_docs(versions):
+    ''' Removes the cached tiles and pages of deleted documents
+    :versions: list of (doc id, cache_version) '''
+
+    cache.delete_many([key(doc_id, version) for doc_id, version in versions for key in (tile_key, page_key)])
@@ -0,0 +1,87 @@
+from django.db import connection, transaction
+from django.db.models import Count, F
+
+from backend.models import LoggedDoc, Author, Category, Country, DocAuthor, DocCategory, DocCountry, FacetCount
+
+# Number of documents per author, category, country and validation status, shown next to the filters of the home page.
+# Without filters (or with the validation status only) the counts are read from backend_facetcount, kept up to date
+# by triggers on the documents and their link tables (see migration 0010), bulk writes included.
+# With filters, they are counted over the documents that match, through the indexed link tables.
+
+FACET_TABLE="backend_facetcount"
+
+# facet, named model, name field, link model, link column
+FACETS=[("author", Author, "name", DocAuthor, "author_id"),
+        ("category", Category, "category_name", DocCategory, "category_id"),
+        ("country", Country, "country_name", DocCountry, "country_id")]
+
+# counts of the whole base, the triggers of the migration keep the same ones
+REBUILD_COUNTS=[f'''INSERT INTO {FACET_TABLE}(facet, item_id, count, draft_count)
+SELECT '{facet}', l.{column}, count(*), sum(CASE WHEN d.is_draft THEN 1 ELSE 0 END)
+FROM {link._meta.db_table} l JOIN backend_loggeddoc d ON d.id = l.doc_id GROUP BY l.{column}''' for facet, _, _, link, column in FACETS]
+REBUILD_COUNTS.append(f'''INSERT INTO {FACET_TABLE}(facet, item_id, count, draft_count)
+SELECT 'status', 0, count(*), coalesce(sum(CASE WHEN is_draft THEN 1 ELSE 0 END), 0) FROM backend_loggeddoc''')
+
+
+def stored_counts_available():
+    ''' The triggers that maintain the counts are created on SQLite only '''
+    return connection.vendor=="sqlite"
+
+def named_counts(model, field, counts):
+    ''' [(item id, count)] -> [{"name", "count"}] '''
+
+    names=dict(model.objects.filter(id__in=[item_id for item_id, _ in counts]).values_list("id", field))
+    return [{"name":names[item_id], "count":count} for item_id, count in counts if item_id in names]
+
+def stored_counts(status="all", size=10):
+    '''
+    The size authors, categories and countries with the most documents and the number of documents per status, 
+    read from the counts table
+    :status: "all", "draft" or "validated", the documents counted for the authors, categories and countries
+    '''
+
+    facets={}
+    for facet, model, field, _, _ in FACETS:
+        rows=FacetCount.objects.filter(facet=facet)
+        if status=="draft":
+            rows=rows.annotate(n=F("draft_count"))
+        elif status=="validated":
+            rows=rows.annotate(n=F("count")-F("draft_count"))
+        else:
+            rows=rows.annotate(n=F("count"))
+        facets[facet]=named_counts(model, field, list(rows.filter(n__gt=0).order_by("-n", "item_id").values_list("item_id", "n")[:size]))
+
+    total=FacetCount.objects.filter(facet="status", item_id=0).values_list("count", "draft_count").first() or (0, 0)
+    facets["status"]={"all":total[0], "draft":total[1], "validated":total[0]-total[1]}
+
+    return facets
+
+def live_counts(doc_list, all_status_list, size=10):
+    '''
+    Same as stored_counts, counted over the documents of a filtered list
+    :doc_list: LoggedDoc queryset, counted for the authors, categories and countries
+    :all_status_list: the same list without the validation status filter, counted per status
+    '''
+
+    doc_ids=doc_list.values("id")
+
+    facets={}
+    for facet, model, field, link, column in FACETS:
+        counts=(link.objects.filter(doc_id__in=doc_ids).values(column).annotate(n=Count("id"))
+                .order_by("-n", column).values_list(column, "n")[:size])
+        facets[facet]=named_counts(model, field, list(counts))
+
+    status=dict(all_status_list.order_by().values("is_draft").annotate(n=Count("id")).values_list("is_draft", "n"))
+    facets["status"]={"all":sum(status.values()), "draft":status.get(True, 0), "validated":status.get(False, 0)}
+
+    return facets
+
+def rebuild_counts():
+    ''' Counts everything again, returns the number of documents '''
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FACET_TABLE}")
+        for statement in REBUILD_COUNTS:
+            cursor.execute(statement)
+
+    return LoggedDoc.objects.count()
@@ -0,0 +1,49 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('task_id', models.CharField(max_length=50, unique=True)),
+                ('client', models.CharField(max_length=60)),
+                ('chat_format', models.CharField(blank=True, max_length=60, null=True)),
+                ('model', models.CharField(blank=True, max_length=60, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('finished', 'Finished')], db_index=True, default='pending', max_length=20)),
+                ('total_docs', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProcessingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('url', models.CharField(max_length=255)),
+                ('category', models.CharField(max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done')], default='pending', max_length=20)),
+                ('success', models.BooleanField(blank=True, null=True)),
+                ('slug', models.CharField(blank=True, max_length=255, null=True)),
+                ('worker', models.CharField(blank=True, max_length=255, null=True)),
+                ('claim_token', models.CharField(blank=True, db_index=True, max_length=32, null=True)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='backend.processingtask')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'task'], name='backend_pro_status_0b63d1_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 10:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0002_processingtask_processingjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingtask',
+            name='refresh_cache',
+            field=models.BooleanField(default=False),
+        ),
+    ]
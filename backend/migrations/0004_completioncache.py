@@ -0,0 +1,41 @@
+# Generated by Django 5.0.1 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0003_processingtask_refresh_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('client', models.CharField(max_length=60)),
+                ('model', models.CharField(blank=True, max_length=255, null=True)),
+                ('completion', models.JSONField()),
+                ('hits', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='processinglog',
+            name='cache_hits',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='processinglog',
+            name='cache_misses',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='processingtask',
+            name='bypass_llm_cache',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.1 on 2026-10-18 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0004_completioncache'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='processinglog',
+            index=models.Index(fields=['source_url', 'created_at'], name='backend_pro_source__699e7f_idx'),
+        ),
+    ]
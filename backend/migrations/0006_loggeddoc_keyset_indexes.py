@@ -0,0 +1,21 @@
+# Generated by Django 5.0.1 on 2026-10-18 10:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0005_processinglog_source_url_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='loggeddoc',
+            index=models.Index(fields=['publication_date', 'id'], name='backend_log_publica_9aadac_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loggeddoc',
+            index=models.Index(fields=['created_at', 'id'], name='backend_log_created_1c6602_idx'),
+        ),
+    ]
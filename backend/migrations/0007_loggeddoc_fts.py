@@ -0,0 +1,79 @@
+# Full-text index of the documents (SQLite FTS5), see backend/search.py
+
+from django.db import migrations
+
+# text of a document: its own fields and the names of its authors, categories and countries
+DOC_ROW = '''SELECT d.id, d.title, d.overview, d.summary, d.comment, d.llm,
+    (SELECT group_concat(name, ' ') FROM backend_author WHERE doc_id = d.id),
+    (SELECT group_concat(category_name, ' ') FROM backend_category WHERE doc_id = d.id),
+    (SELECT group_concat(country_name, ' ') FROM backend_country WHERE doc_id = d.id)
+FROM backend_loggeddoc d'''
+
+INSERT_ROW = f'''INSERT INTO backend_loggeddoc_fts(rowid, title, overview, summary, comment, llm, authors, categories, countries)
+{DOC_ROW}'''
+
+# related table, fts column, name column
+RELATED = [("backend_author", "authors", "name"),
+           ("backend_category", "categories", "category_name"),
+           ("backend_country", "countries", "country_name")]
+
+
+def create_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    statements = [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS backend_loggeddoc_fts USING fts5(
+            title, overview, summary, comment, llm, authors, categories, countries,
+            tokenize = "unicode61 remove_diacritics 2", prefix = "2 3")''',
+
+        f'''CREATE TRIGGER backend_loggeddoc_fts_insert AFTER INSERT ON backend_loggeddoc BEGIN
+            {INSERT_ROW} WHERE d.id = NEW.id;
+        END''',
+
+        '''CREATE TRIGGER backend_loggeddoc_fts_update AFTER UPDATE OF title, overview, summary, comment, llm ON backend_loggeddoc BEGIN
+            UPDATE backend_loggeddoc_fts SET title = NEW.title, overview = NEW.overview, summary = NEW.summary,
+                comment = NEW.comment, llm = NEW.llm WHERE rowid = NEW.id;
+        END''',
+
+        '''CREATE TRIGGER backend_loggeddoc_fts_delete AFTER DELETE ON backend_loggeddoc BEGIN
+            DELETE FROM backend_loggeddoc_fts WHERE rowid = OLD.id;
+        END''',
+    ]
+
+    # the names of the related rows are concatenated again for the document whenever one of them changes
+    for table, column, name in RELATED:
+        names = f"(SELECT group_concat({name}, ' ') FROM {table} WHERE doc_id = {{doc}})"
+        for event, docs in [("INSERT", ["NEW"]), ("DELETE", ["OLD"]), ("UPDATE", ["OLD", "NEW"])]:
+            updates = " ".join(f"UPDATE backend_loggeddoc_fts SET {column} = {names.format(doc=f'{doc}.doc_id')} WHERE rowid = {doc}.doc_id;"
+                               for doc in docs)
+            statements.append(f'''CREATE TRIGGER {table}_fts_{event.lower()} AFTER {event} ON {table} BEGIN
+                {updates}
+            END''')
+
+    statements.append(f"{INSERT_ROW}")
+
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS backend_loggeddoc_fts")
+        for table in ["backend_loggeddoc"]+[table for table, _, _ in RELATED]:
+            for event in ["insert", "update", "delete"]:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{event}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0006_loggeddoc_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts, drop_fts),
+    ]
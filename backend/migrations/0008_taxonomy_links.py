@@ -0,0 +1,98 @@
+# Generated by Django 5.0.1 on 2026-10-18 10:48
+# Link tables between the documents and their authors, categories and countries, see backend/dedupe.py
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# triggers of migration 0007 that keep the names of the FTS table up to date from the one-row-per-document tables.
+# they are dropped before the rows are de-duplicated (migration 0009 or the dedupe_taxonomy command), which would
+# otherwise remove the names of the documents from the FTS table, and created again on the link tables by 0009
+RELATED = [("backend_author", "authors", "name"),
+           ("backend_category", "categories", "category_name"),
+           ("backend_country", "countries", "country_name")]
+
+
+def drop_related_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        for table, _, _ in RELATED:
+            for event in ["insert", "update", "delete"]:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{event}")
+
+def create_related_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        for table, column, name in RELATED:
+            names = f"(SELECT group_concat({name}, ' ') FROM {table} WHERE doc_id = {{doc}})"
+            for event, docs in [("INSERT", ["NEW"]), ("DELETE", ["OLD"]), ("UPDATE", ["OLD", "NEW"])]:
+                updates = " ".join(f"UPDATE backend_loggeddoc_fts SET {column} = {names.format(doc=f'{doc}.doc_id')} WHERE rowid = {doc}.doc_id;"
+                                   for doc in docs)
+                cursor.execute(f'''CREATE TRIGGER {table}_fts_{event.lower()} AFTER {event} ON {table} BEGIN
+                    {updates}
+                END''')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0007_loggeddoc_fts'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_related_triggers, create_related_triggers),
+        migrations.CreateModel(
+            name='DocAuthor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backend.author')),
+                ('doc', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backend.loggeddoc')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='loggeddoc',
+            name='authors',
+            field=models.ManyToManyField(related_name='docs', through='backend.DocAuthor', to='backend.author'),
+        ),
+        migrations.CreateModel(
+            name='DocCategory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backend.category')),
+                ('doc', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backend.loggeddoc')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='loggeddoc',
+            name='categories',
+            field=models.ManyToManyField(related_name='docs', through='backend.DocCategory', to='backend.category'),
+        ),
+        migrations.CreateModel(
+            name='DocCountry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backend.country')),
+                ('doc', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backend.loggeddoc')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='loggeddoc',
+            name='countries',
+            field=models.ManyToManyField(related_name='docs', through='backend.DocCountry', to='backend.country'),
+        ),
+        migrations.AddConstraint(
+            model_name='docauthor',
+            constraint=models.UniqueConstraint(fields=('doc', 'author'), name='unique_doc_author'),
+        ),
+        migrations.AddConstraint(
+            model_name='doccategory',
+            constraint=models.UniqueConstraint(fields=('doc', 'category'), name='unique_doc_category'),
+        ),
+        migrations.AddConstraint(
+            model_name='doccountry',
+            constraint=models.UniqueConstraint(fields=('doc', 'country'), name='unique_doc_country'),
+        ),
+    ]
@@ -0,0 +1,114 @@
+# Generated by Django 5.0.1 on 2026-10-18 10:49
+# One row per author, category and country name, see backend/dedupe.py
+
+from django.db import migrations, models
+
+from backend.dedupe import dedupe_names
+
+# text of a document, as in 0007, with the names read through the link tables
+INSERT_ROW = '''INSERT INTO backend_loggeddoc_fts(rowid, title, overview, summary, comment, llm, authors, categories, countries)
+SELECT d.id, d.title, d.overview, d.summary, d.comment, d.llm,
+    (SELECT group_concat(a.name, ' ') FROM backend_docauthor l JOIN backend_author a ON a.id = l.author_id WHERE l.doc_id = d.id),
+    (SELECT group_concat(c.category_name, ' ') FROM backend_doccategory l JOIN backend_category c ON c.id = l.category_id WHERE l.doc_id = d.id),
+    (SELECT group_concat(c.country_name, ' ') FROM backend_doccountry l JOIN backend_country c ON c.id = l.country_id WHERE l.doc_id = d.id)
+FROM backend_loggeddoc d'''
+
+# triggers of 0007 keeping the own fields of a document
+DOC_TRIGGERS = ['''CREATE TRIGGER IF NOT EXISTS backend_loggeddoc_fts_update AFTER UPDATE OF title, overview, summary, comment, llm ON backend_loggeddoc BEGIN
+            UPDATE backend_loggeddoc_fts SET title = NEW.title, overview = NEW.overview, summary = NEW.summary,
+                comment = NEW.comment, llm = NEW.llm WHERE rowid = NEW.id;
+        END''',
+
+        '''CREATE TRIGGER IF NOT EXISTS backend_loggeddoc_fts_delete AFTER DELETE ON backend_loggeddoc BEGIN
+            DELETE FROM backend_loggeddoc_fts WHERE rowid = OLD.id;
+        END''']
+
+# link table, named table, fts column, name column, link column
+LINKED = [("backend_docauthor", "backend_author", "authors", "name", "author_id"),
+          ("backend_doccategory", "backend_category", "categories", "category_name", "category_id"),
+          ("backend_doccountry", "backend_country", "countries", "country_name", "country_id")]
+
+
+def dedupe(apps, schema_editor):
+    # already done, batch by batch, if the dedupe_taxonomy command was run after migrating to 0008
+    dedupe_names(apps)
+
+def drop_insert_trigger(apps, schema_editor):
+    # the trigger of 0007 reads the doc column that is removed
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DROP TRIGGER IF EXISTS backend_loggeddoc_fts_insert")
+
+def create_link_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    # the M2M fields added by 0008 copy backend_loggeddoc, which drops the update and delete triggers of 0007 too
+    statements = [f'''CREATE TRIGGER backend_loggeddoc_fts_insert AFTER INSERT ON backend_loggeddoc BEGIN
+            {INSERT_ROW} WHERE d.id = NEW.id;
+        END''',
+
+        *DOC_TRIGGERS]
+    for link, table, column, name, link_column in LINKED:
+        names = f"(SELECT group_concat(t.{name}, ' ') FROM {link} l JOIN {table} t ON t.id = l.{link_column} WHERE l.doc_id = {{doc}})"
+
+        # the names of a document are concatenated again when a link is added, removed or changed
+        for event, docs in [("INSERT", ["NEW"]), ("DELETE", ["OLD"]), ("UPDATE", ["OLD", "NEW"])]:
+            updates = " ".join(f"UPDATE backend_loggeddoc_fts SET {column} = {names.format(doc=f'{doc}.doc_id')} WHERE rowid = {doc}.doc_id;"
+                               for doc in docs)
+            statements.append(f'''CREATE TRIGGER {link}_fts_{event.lower()} AFTER {event} ON {link} BEGIN
+                {updates}
+            END''')
+
+        # and for every document of a name when the name is edited
+        statements.append(f'''CREATE TRIGGER {table}_fts_rename AFTER UPDATE OF {name} ON {table} BEGIN
+            UPDATE backend_loggeddoc_fts SET {column} = {names.format(doc="backend_loggeddoc_fts.rowid")}
+            WHERE rowid IN (SELECT doc_id FROM {link} WHERE {link_column} = NEW.id);
+        END''')
+
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0008_taxonomy_links'),
+    ]
+
+    # the rows deleted as duplicates can't be restored
+    operations = [
+        migrations.RunPython(dedupe),
+        migrations.RunPython(drop_insert_trigger),
+        migrations.RemoveField(
+            model_name='author',
+            name='doc',
+        ),
+        migrations.RemoveField(
+            model_name='category',
+            name='doc',
+        ),
+        migrations.RemoveField(
+            model_name='country',
+            name='doc',
+        ),
+        migrations.AlterField(
+            model_name='author',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='category',
+            name='category_name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='country',
+            name='country_name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.RunPython(create_link_triggers),
+    ]
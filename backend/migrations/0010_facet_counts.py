@@ -0,0 +1,102 @@
+# Generated by Django 5.0.1 on 2026-10-18 11:03
+# Document counts per author, category, country and status, see backend/facets.py
+
+from django.db import migrations, models
+
+# link table, facet, link column
+LINKS = [("backend_docauthor", "author", "author_id"),
+         ("backend_doccategory", "category", "category_id"),
+         ("backend_doccountry", "country", "country_id")]
+
+# adds a document to the count of an item (the count is created if needed)
+ADD = '''INSERT INTO backend_facetcount(facet, item_id, count, draft_count)
+    SELECT '{facet}', {item}, 1, d.is_draft FROM backend_loggeddoc d WHERE d.id = {doc}
+    ON CONFLICT(facet, item_id) DO UPDATE SET count = count + 1, draft_count = draft_count + excluded.draft_count;'''
+
+REMOVE = '''UPDATE backend_facetcount SET count = count - 1,
+    draft_count = draft_count - coalesce((SELECT is_draft FROM backend_loggeddoc WHERE id = {doc}), 0)
+    WHERE facet = '{facet}' AND item_id = {item};'''
+
+
+def create_counts(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    statements = []
+    for link, facet, column in LINKS:
+        add = ADD.format(facet=facet, item=f"NEW.{column}", doc="NEW.doc_id")
+        remove = REMOVE.format(facet=facet, item=f"OLD.{column}", doc="OLD.doc_id")
+        for event, body in [("INSERT", add), ("DELETE", remove), ("UPDATE", remove+add)]:
+            statements.append(f'''CREATE TRIGGER {link}_facets_{event.lower()} AFTER {event} ON {link} BEGIN
+                {body}
+            END''')
+
+    statements += [
+        '''CREATE TRIGGER backend_loggeddoc_facets_insert AFTER INSERT ON backend_loggeddoc BEGIN
+            INSERT INTO backend_facetcount(facet, item_id, count, draft_count) VALUES ('status', 0, 1, NEW.is_draft)
+            ON CONFLICT(facet, item_id) DO UPDATE SET count = count + 1, draft_count = draft_count + excluded.draft_count;
+        END''',
+
+        '''CREATE TRIGGER backend_loggeddoc_facets_delete AFTER DELETE ON backend_loggeddoc BEGIN
+            UPDATE backend_facetcount SET count = count - 1, draft_count = draft_count - OLD.is_draft WHERE facet = 'status' AND item_id = 0;
+        END''',
+    ]
+
+    # a document validated (or back to draft) moves from one count to the other, for all its names
+    moves = ["UPDATE backend_facetcount SET draft_count = draft_count + NEW.is_draft - OLD.is_draft WHERE facet = 'status' AND item_id = 0;"]
+    for link, facet, column in LINKS:
+        moves.append(f'''UPDATE backend_facetcount SET draft_count = draft_count + NEW.is_draft - OLD.is_draft
+                WHERE facet = '{facet}' AND item_id IN (SELECT {column} FROM {link} WHERE doc_id = NEW.id);''')
+    moves = "\n            ".join(moves)
+    statements.append(f'''CREATE TRIGGER backend_loggeddoc_facets_update AFTER UPDATE OF is_draft ON backend_loggeddoc
+        WHEN OLD.is_draft <> NEW.is_draft BEGIN
+            {moves}
+        END''')
+
+    # counts of the documents already saved
+    for link, facet, column in LINKS:
+        statements.append(f'''INSERT INTO backend_facetcount(facet, item_id, count, draft_count)
+            SELECT '{facet}', l.{column}, count(*), sum(d.is_draft) FROM {link} l JOIN backend_loggeddoc d ON d.id = l.doc_id GROUP BY l.{column}''')
+    statements.append('''INSERT INTO backend_facetcount(facet, item_id, count, draft_count)
+        SELECT 'status', 0, count(*), coalesce(sum(is_draft), 0) FROM backend_loggeddoc''')
+
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+def drop_counts(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        for table in ["backend_loggeddoc"]+[link for link, _, _ in LINKS]:
+            for event in ["insert", "update", "delete"]:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {table}_facets_{event}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0009_unique_taxonomy_names'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=20)),
+                ('item_id', models.BigIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('draft_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['facet', 'count'], name='backend_fac_facet_bb6f71_idx'), models.Index(fields=['facet', 'draft_count'], name='backend_fac_facet_328474_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='facetcount',
+            constraint=models.UniqueConstraint(fields=('facet', 'item_id'), name='unique_facet_item'),
+        ),
+        migrations.RunPython(create_counts, drop_counts),
+    ]
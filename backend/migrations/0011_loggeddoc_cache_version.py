@@ -0,0 +1,50 @@
+# Generated by Django 5.0.1 on 2026-10-18 11:09
+# Version of the cached tile and page of each document, see backend/doc_cache.py
+
+from django.db import migrations, models
+
+# Django adds a NOT NULL column to an SQLite table by copying the table, which drops the triggers of the documents
+# (search index and facet counts, migrations 0007 to 0010) and fails on the triggers of the link tables.
+# SQLite can add a column with a constant default in place.
+ADD_COLUMN = '''ALTER TABLE backend_loggeddoc ADD COLUMN "cache_version" integer unsigned NOT NULL DEFAULT 1 CHECK ("cache_version" >= 0)'''
+DROP_COLUMN = '''ALTER TABLE backend_loggeddoc DROP COLUMN "cache_version"'''
+
+
+def cache_version_field():
+    field = models.PositiveIntegerField(default=1, editable=False)
+    field.set_attributes_from_name("cache_version")
+    return field
+
+def add_column(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(ADD_COLUMN)
+    else:
+        schema_editor.add_field(apps.get_model("backend", "LoggedDoc"), cache_version_field())
+
+def drop_column(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(DROP_COLUMN)
+    else:
+        schema_editor.remove_field(apps.get_model("backend", "LoggedDoc"), cache_version_field())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0010_facet_counts'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='loggeddoc',
+                    name='cache_version',
+                    field=models.PositiveIntegerField(default=1, editable=False),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(add_column, drop_column),
+            ],
+        ),
+    ]
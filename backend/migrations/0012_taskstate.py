@@ -0,0 +1,24 @@
+# Generated by Django 5.0.1 on 2026-10-18 11:14
+# Progress of the processing tasks shared by the processes of the app, see newdocs/task_state.py
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0011_loggeddoc_cache_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('value', models.JSONField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.1 on 2026-10-18 11:18
+# Format, size and resized variants of the images of the documents, see newdocs/thumbnails.py
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0012_taskstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='docimage',
+            name='format',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='docimage',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='docimage',
+            name='variants',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='docimage',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.0.1 on 2026-10-18 11:23
+# Images stored once per content and their reference counts, see newdocs/image_store.py
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# the reference count of a stored image follows the DocImage rows pointing to it, bulk writes and cascades included
+# (a later migration that copies backend_docimage, as Django does to alter a column on SQLite, has to create them again)
+INCREMENT = "UPDATE backend_storedimage SET ref_count = ref_count + 1 WHERE id = NEW.stored_id;"
+DECREMENT = "UPDATE backend_storedimage SET ref_count = ref_count - 1 WHERE id = OLD.stored_id;"
+
+TRIGGERS = {
+    "insert": f"AFTER INSERT ON backend_docimage WHEN NEW.stored_id IS NOT NULL BEGIN {INCREMENT} END",
+    "delete": f"AFTER DELETE ON backend_docimage WHEN OLD.stored_id IS NOT NULL BEGIN {DECREMENT} END",
+    "update": f"AFTER UPDATE OF stored_id ON backend_docimage WHEN OLD.stored_id IS NOT NEW.stored_id BEGIN {DECREMENT} {INCREMENT} END",
+}
+
+
+def create_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        for event, body in TRIGGERS.items():
+            cursor.execute(f"CREATE TRIGGER backend_docimage_refs_{event} {body}")
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        for event in TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS backend_docimage_refs_{event}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0013_docimage_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('image_url', models.CharField(max_length=1024)),
+                ('size', models.PositiveIntegerField()),
+                ('format', models.CharField(max_length=10)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('variants', models.JSONField(default=dict)),
+                ('ref_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ref_count'], name='backend_sto_ref_cou_fe36dd_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='docimage',
+            name='stored',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='backend.storedimage'),
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
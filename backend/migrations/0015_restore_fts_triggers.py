@@ -0,0 +1,52 @@
+# Update and delete triggers of the full-text index (0007), for the databases migrated before 0009 created them again
+
+from django.db import migrations
+
+# 0008 adds the M2M fields of the documents by copying backend_loggeddoc, which drops its triggers:
+# 0009 only created the insert trigger again, so edits and deletions left the index stale.
+# The triggers are created if they are missing and the index is rebuilt, as by python manage.py rebuild_search_index
+DOC_TRIGGERS = ['''CREATE TRIGGER IF NOT EXISTS backend_loggeddoc_fts_update AFTER UPDATE OF title, overview, summary, comment, llm ON backend_loggeddoc BEGIN
+            UPDATE backend_loggeddoc_fts SET title = NEW.title, overview = NEW.overview, summary = NEW.summary,
+                comment = NEW.comment, llm = NEW.llm WHERE rowid = NEW.id;
+        END''',
+
+        '''CREATE TRIGGER IF NOT EXISTS backend_loggeddoc_fts_delete AFTER DELETE ON backend_loggeddoc BEGIN
+            DELETE FROM backend_loggeddoc_fts WHERE rowid = OLD.id;
+        END''']
+
+# text of a document, as in 0009
+INSERT_ROW = '''INSERT INTO backend_loggeddoc_fts(rowid, title, overview, summary, comment, llm, authors, categories, countries)
+SELECT d.id, d.title, d.overview, d.summary, d.comment, d.llm,
+    (SELECT group_concat(a.name, ' ') FROM backend_docauthor l JOIN backend_author a ON a.id = l.author_id WHERE l.doc_id = d.id),
+    (SELECT group_concat(c.category_name, ' ') FROM backend_doccategory l JOIN backend_category c ON c.id = l.category_id WHERE l.doc_id = d.id),
+    (SELECT group_concat(c.country_name, ' ') FROM backend_doccountry l JOIN backend_country c ON c.id = l.country_id WHERE l.doc_id = d.id)
+FROM backend_loggeddoc d'''
+
+
+def restore_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='backend_loggeddoc_fts'")
+        if cursor.fetchone() is None:
+            return
+
+        for statement in DOC_TRIGGERS:
+            cursor.execute(statement)
+
+        # rows of deleted documents and old versions of edited ones
+        cursor.execute("DELETE FROM backend_loggeddoc_fts")
+        cursor.execute(INSERT_ROW)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0014_image_store'),
+    ]
+
+    # the triggers belong to 0009 from now on, they are kept when migrating back
+    operations = [
+        migrations.RunPython(restore_triggers, migrations.RunPython.noop),
+    ]
@@ -2,27 +2,23 @@ from django.db import models
 
 # Create your models here. 
 #NOTE : for most models, we added a JSONField for embeddings. It is just a placeholder for the moment but we plan to use it later for retrieval.
+# authors, categories and countries are unique names, linked to the documents by the Doc* tables below LoggedDoc
 class Author(models.Model):
-    name = models.CharField(max_length=255, db_index=True)
-    doc = models.ForeignKey("LoggedDoc", on_delete=models.CASCADE)
+    name = models.CharField(max_length=255, unique=True)
     name_embedding = models.JSONField(null=True, blank=True)
 
     def __str__(self):
         return self.name
 
-# TODO : For now, we're are just building a table of established one-to-many relationships between a doc and its categories without constraints on the categories themselves (e.g. no unique constraint on category_name). Will adjust later and add a unique constraint, and then add a many-to-many relationship between docs and categories.
 class Category(models.Model):
-    category_name = models.CharField(max_length=255, db_index=True)
-    doc = models.ForeignKey("LoggedDoc", on_delete=models.CASCADE)
+    category_name = models.CharField(max_length=255, unique=True)
     name_embedding = models.JSONField(null=True, blank=True)
 
     def __str__(self):
         return self.category_name
 
-# TODO : For now, we're are just building a table of established one-to-many relationships between a doc and its countries without constraints on the countries themselves (e.g. no unique constraint on country_name). Will adjust later and add a unique constraint, and then add a many-to-many relationship between docs and countries.
 class Country(models.Model):
-    country_name = models.CharField(max_length=255, db_index=True)
-    doc = models.ForeignKey("LoggedDoc", on_delete=models.CASCADE)
+    country_name = models.CharField(max_length=255, unique=True)
     name_embedding = models.JSONField(null=True, blank=True)
 
     def __str__(self):
@@ -35,6 +31,43 @@ class DocImage(models.Model):
     image_url = models.URLField(max_length=1024)
     doc = models.ForeignKey("LoggedDoc", on_delete=models.CASCADE)
 
+    # file of the image, shared with the other documents showing the same image (see newdocs/image_store.py)
+    # empty for the images saved before the image store, until `python manage.py migrate_images`
+    stored = models.ForeignKey("StoredImage", on_delete=models.PROTECT, null=True, blank=True)
+
+    # original format and size, and paths of the resized variants (see newdocs/thumbnails.py), copied from stored
+    format = models.CharField(max_length=10, null=True, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    variants = models.JSONField(null=True, blank=True)
+
+    @property
+    def small_variant(self):
+        return (self.variants or {}).get("small")
+
+    @property
+    def large_variant(self):
+        return (self.variants or {}).get("large")
+
+    def __str__(self):
+        return self.image_url
+
+# Index of the image files by the SHA-256 of their content, each image is stored once (see newdocs/image_store.py)
+# ref_count, the number of DocImage rows referencing an image, is kept up to date by triggers (migration 0014)
+class StoredImage(models.Model):
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    image_url = models.CharField(max_length=1024)
+    size = models.PositiveIntegerField()
+    format = models.CharField(max_length=10)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    variants = models.JSONField(default=dict)
+    ref_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["ref_count"])]
 
     def __str__(self):
         return self.image_url
@@ -48,10 +81,93 @@ class ProcessingLog(models.Model):
     llm_output = models.TextField(max_length=1000,null=True, blank=True)
     success = models.BooleanField(default=False)
     llm_turns = models.IntegerField(null=True, blank=True)
+    # LLM calls answered by the completion cache (hits) or sent to the model (misses)
+    cache_hits = models.IntegerField(default=0)
+    cache_misses = models.IntegerField(default=0)
+
+    class Meta:
+        # latest processing of a URL, see newdocs.views.augment_urls
+        indexes = [models.Index(fields=["source_url", "created_at"])]
 
     def __str__(self):
         return self.source_url
 
+# Completions already returned by the LLM, keyed on a hash of (client, model, chat_format, grammar, prompt). See newdocs/llm_cache.py
+class CompletionCache(models.Model):
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    key = models.CharField(max_length=64, unique=True)
+    client = models.CharField(max_length=60)
+    model = models.CharField(max_length=255, null=True, blank=True)
+    completion = models.JSONField()
+    hits = models.IntegerField(default=0)
+
+    def __str__(self):
+        return self.key
+
+# Processing tasks are queued in the DB so that batches survive restarts of the web server. 
+# A task is one launch from the UI, with one job per URL. Jobs are claimed by the workers (see newdocs/task_queue.py)
+class ProcessingTask(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    FINISHED = "finished"
+    STATUS_CHOICES = [(PENDING, "Pending"), (RUNNING, "Running"), (FINISHED, "Finished")]
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    task_id = models.CharField(max_length=50, unique=True)
+    client = models.CharField(max_length=60)
+    chat_format = models.CharField(max_length=60, null=True, blank=True)
+    model = models.CharField(max_length=60, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    total_docs = models.IntegerField(default=0)
+    refresh_cache = models.BooleanField(default=False) # download the documents again instead of using the HTTP cache
+    bypass_llm_cache = models.BooleanField(default=False) # ask the model again instead of reusing cached completions
+
+    def __str__(self):
+        return self.task_id
+
+class ProcessingJob(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    STATUS_CHOICES = [(PENDING, "Pending"), (RUNNING, "Running"), (DONE, "Done")]
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    task = models.ForeignKey(ProcessingTask, on_delete=models.CASCADE, related_name="jobs")
+    url = models.CharField(max_length=255)
+    category = models.CharField(max_length=20) # "youtube", "arxiv" or "others", see newdocs.views.classify_urls
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    success = models.BooleanField(null=True, blank=True)
+    slug = models.CharField(max_length=255, null=True, blank=True)
+
+    # claim of the job by a worker. claimed_at is refreshed by the worker while it is alive
+    worker = models.CharField(max_length=255, null=True, blank=True)
+    claim_token = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "task"])]
+
+    def __str__(self):
+        return self.url
+
+# Progress of the processing tasks, read and written by every process of the app (web workers, process_tasks),
+# which do not share their cache. Entries expire after TASK_STATE_TTL seconds (see newdocs/task_state.py)
+class TaskState(models.Model):
+    key = models.CharField(max_length=255, unique=True)
+    value = models.JSONField()
+    expires_at = models.DateTimeField(db_index=True)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.key
+
 # TODO: automating the update of the LLM prompt, GBNF grammar to reflect any changes to the LoggedDoc model.
 # in the meantime, the LLM prompt, GBNF grammar have to be updated manually (in newdocs/doc_processing.py)
 class LoggedDoc(models.Model):
@@ -73,16 +189,71 @@ class LoggedDoc(models.Model):
     # model used (if any) to generate the fields above:
     llm = models.TextField(max_length=255,null=True, blank=True)
     
-    # TODO : un-comment when we turn on the many-to-many relationships
-    # countries = models.ManyToManyField(Country, related_name="countries")
-    # categories = models.ManyToManyField(Category, related_name="categories")
+    authors = models.ManyToManyField(Author, through="DocAuthor", related_name="docs")
+    categories = models.ManyToManyField(Category, through="DocCategory", related_name="docs")
+    countries = models.ManyToManyField(Country, through="DocCountry", related_name="docs")
 
     default_image = models.ForeignKey('DocImage', on_delete=models.SET_NULL, null=True, blank=True)
     summary_embedding = models.JSONField(null=True, blank=True)
 
+    # incremented whenever the document, its names or its images change, the rendered tile and page are cached under it
+    cache_version = models.PositiveIntegerField(default=1, editable=False)
+
+    class Meta:
+        # keyset pagination of the home page on (date, id)
+        indexes = [models.Index(fields=["publication_date", "id"]),
+                   models.Index(fields=["created_at", "id"])]
+
     def __str__(self):
         return self.slug
     
+# links between the documents and their authors, categories and countries, in the order they were added
+class DocAuthor(models.Model):
+    doc = models.ForeignKey(LoggedDoc, on_delete=models.CASCADE)
+    author = models.ForeignKey(Author, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["doc", "author"], name="unique_doc_author")]
+
+    def __str__(self):
+        return str(self.author)
+
+class DocCategory(models.Model):
+    doc = models.ForeignKey(LoggedDoc, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["doc", "category"], name="unique_doc_category")]
+
+    def __str__(self):
+        return str(self.category)
+
+class DocCountry(models.Model):
+    doc = models.ForeignKey(LoggedDoc, on_delete=models.CASCADE)
+    country = models.ForeignKey(Country, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["doc", "country"], name="unique_doc_country")]
+
+    def __str__(self):
+        return str(self.country)
+
+# number of documents of each author, category and country (facet "author", "category" or "country", item_id their id)
+# and of all the documents (facet "status", item_id 0), kept up to date by triggers (see backend/facets.py)
+class FacetCount(models.Model):
+    facet = models.CharField(max_length=20)
+    item_id = models.BigIntegerField()
+    count = models.IntegerField(default=0)
+    draft_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["facet", "item_id"], name="unique_facet_item")]
+        indexes = [models.Index(fields=["facet", "count"]),
+                   models.Index(fields=["facet", "draft_count"])]
+
+    def __str__(self):
+        return f"{self.facet} {self.item_id}"
+
 class ChatFormat(models.Model):
     chat_name = models.CharField(max_length=60, db_index=True, unique=True)
     chat_description = models.CharField(max_length=255)
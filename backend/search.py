@@ -0,0 +1,117 @@
+import re
+from html import escape
+
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+
+# Keyword search over the documents with the SQLite FTS5 table backend_loggeddoc_fts (see migration 0007).
+# The table holds the title, overview, summary, comment and llm of each document and the names of its authors,
+# categories and countries. It is kept up to date by triggers on these tables and their link tables, bulk writes included.
+# Results are ranked with BM25 and matches are highlighted in a snippet.
+
+FTS_TABLE="backend_loggeddoc_fts"
+
+# BM25 weight of each column of the FTS table, in the order of the table
+COLUMN_WEIGHTS=[10.0, 4.0, 2.0, 2.0, 0.5, 5.0, 5.0, 3.0] # title, overview, summary, comment, llm, authors, categories, countries
+
+# row of a document in the FTS table, the triggers of the migrations (0007, 0009) keep the same one
+INSERT_ROW=f'''INSERT INTO {FTS_TABLE}(rowid, title, overview, summary, comment, llm, authors, categories, countries)
+SELECT d.id, d.title, d.overview, d.summary, d.comment, d.llm,
+    (SELECT group_concat(a.name, ' ') FROM backend_docauthor l JOIN backend_author a ON a.id = l.author_id WHERE l.doc_id = d.id),
+    (SELECT group_concat(c.category_name, ' ') FROM backend_doccategory l JOIN backend_category c ON c.id = l.category_id WHERE l.doc_id = d.id),
+    (SELECT group_concat(c.country_name, ' ') FROM backend_doccountry l JOIN backend_country c ON c.id = l.country_id WHERE l.doc_id = d.id)
+FROM backend_loggeddoc d'''
+
+SNIPPET_TOKENS=24
+_MARK_START, _MARK_END = "\x02", "\x03"
+
+_fts_available=None
+
+
+def fts_available():
+    ''' True if the database has the FTS table (SQLite with FTS5 and migrations applied), checked once per process '''
+
+    global _fts_available
+
+    if _fts_available is None:
+        if connection.vendor != "sqlite":
+            _fts_available=False
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=%s", [FTS_TABLE])
+                _fts_available=cursor.fetchone() is not None
+
+    return _fts_available
+
+def fts_query(kw):
+    '''
+    Turns the keywords typed in the search bar into an FTS5 query: every word must appear in the document,
+    as a word or the beginning of one ("learn" matches "learning"). FTS5 operators are not exposed.
+    Returns None if there is no word to search
+    '''
+
+    words=re.findall(r"\w+", kw or "")
+    if not words:
+        return None
+
+    return " ".join(f'"{word}"*' for word in words)
+
+def match_ids(query):
+    ''' Subquery of the ids of the documents matching an FTS query, to filter a LoggedDoc queryset with id__in '''
+    return RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [query])
+
+def ranked_ids(query, after=None, chunk_size=200):
+    '''
+    Yields (doc id, BM25 score) of the documents matching an FTS query, most relevant first (lowest score), 
+    then by decreasing id. The scores are computed by the FTS table and read in chunks of chunk_size, 
+    so the caller can stop as soon as it has a page, and each chunk is one indexed query.
+    :after: (score, id) of the last document of the previous page
+    '''
+
+    weights=", ".join(str(weight) for weight in COLUMN_WEIGHTS)
+    score=f"bm25({FTS_TABLE}, {weights})"
+
+    while True:
+        sql=f"SELECT rowid, {score} AS score FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+        params=[query]
+        if after:
+            sql+=f" AND ({score} > %s OR ({score} = %s AND rowid < %s))"
+            params+=[after[0], after[0], after[1]]
+        sql+=" ORDER BY score, rowid DESC LIMIT %s"
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params+[chunk_size])
+            rows=cursor.fetchall()
+
+        yield from rows
+
+        if len(rows)<chunk_size:
+            return
+        after=(rows[-1][1], rows[-1][0])
+
+def snippets(query, doc_ids):
+    ''' Extract of the best matching column of each document, with the matches in <mark> tags
+    Returns a dictionary {doc id: html} '''
+
+    if not doc_ids:
+        return {}
+
+    placeholders=", ".join(["%s"]*len(doc_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f'''SELECT rowid, snippet({FTS_TABLE}, -1, %s, %s, '…', %s) FROM {FTS_TABLE}
+                       WHERE {FTS_TABLE} MATCH %s AND rowid IN ({placeholders})''',
+                       [_MARK_START, _MARK_END, SNIPPET_TOKENS, query, *doc_ids])
+        rows=cursor.fetchall()
+
+    # the text is escaped before the markers are turned into tags
+    return {doc_id:escape(snippet or "").replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>") for doc_id, snippet in rows}
+
+def rebuild_index():
+    ''' Rebuilds the FTS table from the documents and their related names, returns the number of documents indexed '''
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        cursor.execute(INSERT_ROW)
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+        cursor.execute(f"SELECT count(*) FROM {FTS_TABLE}")
+        return cursor.fetchone()[0]
@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, current_thread
+
+from django.conf import settings
+
+# SQLite profile for browsing the app while documents are ingested (see SQLITE_* in settings).
+# In WAL mode readers and the writer do not block each other. synchronous=NORMAL only syncs the WAL at checkpoints,
+# which is safe in WAL mode (a power loss may only undo the last commits). A connection that meets a lock waits up to
+# SQLITE_BUSY_TIMEOUT instead of failing with "database is locked".
+# Transactions take the write lock when they start (BEGIN IMMEDIATE, the transaction_mode option of the database,
+# see backend/sqlite_backend): a transaction that reads before it writes (an edit in the admin) otherwise fails at once,
+# without waiting, when another connection wrote in between.
+# The writes of the ingestion pipeline go through one writer thread per process (run_write), so the batches of
+# concurrent tasks are queued instead of competing for the lock.
+
+SQLITE_CONCURRENCY=settings.SQLITE_CONCURRENCY
+SQLITE_BUSY_TIMEOUT=settings.SQLITE_BUSY_TIMEOUT
+SQLITE_SYNCHRONOUS=settings.SQLITE_SYNCHRONOUS
+SQLITE_MMAP_SIZE=settings.SQLITE_MMAP_SIZE
+SQLITE_CACHE_SIZE=settings.SQLITE_CACHE_SIZE
+SQLITE_SINGLE_WRITER=settings.SQLITE_SINGLE_WRITER
+
+WRITER_THREAD_NAME="db-writer"
+
+_writer=None
+_writer_lock=Lock()
+
+
+def connection_pragmas():
+    return ["PRAGMA journal_mode=WAL",
+            f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}",
+            f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT)}",
+            f"PRAGMA mmap_size={int(SQLITE_MMAP_SIZE)}",
+            f"PRAGMA cache_size={int(SQLITE_CACHE_SIZE)}"]
+
+def configure_connection(sender, connection, **kwargs):
+    ''' connection_created receiver (see backend/apps.py), applies the profile to every new SQLite connection '''
+
+    if connection.vendor!="sqlite" or not SQLITE_CONCURRENCY:
+        return
+
+    with connection.cursor() as cursor:
+        for pragma in connection_pragmas():
+            cursor.execute(pragma)
+
+## SINGLE WRITER
+
+def get_writer():
+    global _writer
+
+    with _writer_lock:
+        if _writer is None:
+            _writer=ThreadPoolExecutor(max_workers=1, thread_name_prefix=WRITER_THREAD_NAME)
+
+    return _writer
+
+def run_write(function, *args, **kwargs):
+    '''
+    Runs a function that writes to the database on the writer thread of the process, with its connection,
+    and returns its result (or raises its exception). Functions submitted by several threads run one after the other.
+    Runs the function in the calling thread if SQLITE_SINGLE_WRITER is off
+    '''
+
+    if not SQLITE_SINGLE_WRITER or current_thread().name.startswith(WRITER_THREAD_NAME):
+        return function(*args, **kwargs)
+
+    return get_writer().submit(function, *args, **kwargs).result()
@@ -0,0 +1,33 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+# SQLite backend of the app (ENGINE "backend.sqlite_backend"): Django's own, plus the "transaction_mode" option
+# that Django 5.1 adds to it. With OPTIONS {"transaction_mode": "IMMEDIATE"}, transaction.atomic() opens its transactions
+# with BEGIN IMMEDIATE instead of BEGIN, see backend/sqlite.py. On Django 5.1 or later, use django.db.backends.sqlite3
+# with the same OPTIONS instead.
+
+TRANSACTION_MODES=("DEFERRED", "IMMEDIATE", "EXCLUSIVE")
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        transaction_mode=self.settings_dict["OPTIONS"].get("transaction_mode")
+        if transaction_mode is not None and transaction_mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(f"settings.DATABASES transaction_mode must be one of {', '.join(TRANSACTION_MODES)}, "
+                                       f"not {transaction_mode}")
+        self.transaction_mode=transaction_mode.upper() if transaction_mode else None
+
+    def get_connection_params(self):
+        # not an option of sqlite3.connect
+        params=super().get_connection_params()
+        params.pop("transaction_mode", None)
+        return params
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute(f"BEGIN {self.transaction_mode}")
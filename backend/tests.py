@@ -1,3 +1,255 @@
-from django.test import TestCase
+import io
+import os
+import sqlite3
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from PIL import Image
+
+from backend.facets import live_counts, rebuild_counts, stored_counts
+from backend.models import Author, Category, DocAuthor, DocCategory, DocImage, LoggedDoc, StoredImage
+from backend.search import FTS_TABLE, fts_query, match_ids
+from backend.sqlite_backend.base import DatabaseWrapper
+from newdocs.image_processing import process_image
+from newdocs.image_store import store_doc_images
+from newdocs.thumbnails import THUMBNAIL_SIZES, image_files
+
+
+def add_doc(slug, **fields):
+    return LoggedDoc.objects.create(slug=slug, title=slug, source_url=f"https://example.com/{slug}", **fields)
+
+
+class TransactionModeTests(SimpleTestCase):
+    ''' transaction_mode option of backend/sqlite_backend '''
+
+    def wrapper(self, path, transaction_mode):
+        wrapper = DatabaseWrapper({**connection.settings_dict, "NAME":path, "OPTIONS":{"transaction_mode":transaction_mode}})
+        self.addCleanup(wrapper.close)
+        wrapper.ensure_connection()
+        wrapper.connection.execute("PRAGMA busy_timeout=0")
+        return wrapper
+
+    def write_while_open(self, transaction_mode):
+        ''' Starts a transaction with the mode then writes from another connection, returns the error of the write '''
+
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        path = os.path.join(db_dir.name, "db.sqlite3")
+
+        first, second = self.wrapper(path, transaction_mode), self.wrapper(path, None)
+        second.connection.execute("CREATE TABLE item (id integer)")
+
+        first._start_transaction_under_autocommit()
+        try:
+            second.connection.execute("INSERT INTO item VALUES (1)")
+        except sqlite3.OperationalError as e:
+            return e
+        finally:
+            first.connection.execute("ROLLBACK")
+
+    def test_immediate_takes_the_write_lock(self):
+        self.assertIn("locked", str(self.write_while_open("immediate")))
+
+    def test_deferred_waits_for_the_first_write(self):
+        self.assertIsNone(self.write_while_open("DEFERRED"))
+        self.assertIsNone(self.write_while_open(None))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ImproperlyConfigured):
+            DatabaseWrapper({**connection.settings_dict, "OPTIONS":{"transaction_mode":"LATER"}})
+
+
+class SearchIndexTests(TestCase):
+    ''' The FTS table follows the documents through the triggers of the migrations '''
+
+    def search(self, kw):
+        return sorted(LoggedDoc.objects.filter(id__in=match_ids(fts_query(kw))).values_list("slug", flat=True))
+
+    def test_insert(self):
+        add_doc("zebra", overview="Stripes of the zebra crossing")
+
+        self.assertEqual(self.search("zebra crossing"), ["zebra"])
+        self.assertEqual(self.search("giraffe"), [])
+
+    def test_edit(self):
+        doc = add_doc("animal", overview="Stripes of the zebra")
+        doc.overview = "Neck of the giraffe"
+        doc.save()
+
+        self.assertEqual(self.search("zebra"), [])
+        self.assertEqual(self.search("giraffe"), ["animal"])
+
+        LoggedDoc.objects.filter(pk=doc.pk).update(title="Walrus")
+        self.assertEqual(self.search("walrus"), ["animal"])
+
+    def indexed_ids(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT rowid FROM {FTS_TABLE} ORDER BY rowid")
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_delete(self):
+        doc = add_doc("zebra", overview="Stripes of the zebra")
+        other = add_doc("other", overview="Stripes of the zebra")
+        doc.delete()
+
+        self.assertEqual(self.search("zebra"), ["other"])
+        self.assertEqual(self.indexed_ids(), [other.pk])
+        LoggedDoc.objects.all().delete()
+        self.assertEqual(self.indexed_ids(), [])
+
+    def test_related_names(self):
+        doc = add_doc("paper")
+        author = Author.objects.create(name="Ada Lovelace")
+        DocAuthor.objects.create(doc=doc, author=author)
+        self.assertEqual(self.search("lovelace"), ["paper"])
+
+        author.name = "Charles Babbage"
+        author.save()
+        self.assertEqual(self.search("lovelace"), [])
+        self.assertEqual(self.search("babbage"), ["paper"])
+
+
+class FacetCountTests(TestCase):
+    ''' The counts table follows the documents and their links through the triggers of migration 0010 '''
+
+    def setUp(self):
+        self.ai, self.climate = Category.objects.create(category_name="AI"), Category.objects.create(category_name="Climate")
+        self.docs = [add_doc(f"doc-{i}", is_draft=True) for i in range(3)]
+        DocCategory.objects.bulk_create([DocCategory(doc=self.docs[0], category=self.ai), DocCategory(doc=self.docs[1], category=self.ai),
+                                         DocCategory(doc=self.docs[2], category=self.climate)])
+
+    def counts(self, status="all"):
+        facets = stored_counts(status)
+
+        # the stored counts match the counts of the whole base
+        docs = {"all":LoggedDoc.objects.all(), "draft":LoggedDoc.objects.filter(is_draft=True),
+                "validated":LoggedDoc.objects.filter(is_draft=False)}
+        self.assertEqual(facets, live_counts(docs[status], docs["all"]))
+        return {item["name"]: item["count"] for item in facets["category"]}, facets["status"]
+
+    def test_counts_after_insert(self):
+        self.assertEqual(self.counts(), ({"AI":2, "Climate":1}, {"all":3, "draft":3, "validated":0}))
+        self.assertEqual(self.counts("validated"), ({}, {"all":3, "draft":3, "validated":0}))
+
+    def test_counts_after_validate(self):
+        doc = self.docs[0]
+        doc.is_draft = False
+        doc.save()
+        LoggedDoc.objects.filter(pk=self.docs[2].pk).update(is_draft=False)
+
+        self.assertEqual(self.counts("validated"), ({"AI":1, "Climate":1}, {"all":3, "draft":1, "validated":2}))
+        self.assertEqual(self.counts("draft"), ({"AI":1}, {"all":3, "draft":1, "validated":2}))
+        self.assertEqual(self.counts()[0], {"AI":2, "Climate":1})
+
+    def test_counts_after_delete(self):
+        self.docs[0].delete()
+        self.assertEqual(self.counts(), ({"AI":1, "Climate":1}, {"all":2, "draft":2, "validated":0}))
+
+        DocCategory.objects.filter(doc=self.docs[2]).delete()
+        LoggedDoc.objects.filter(pk=self.docs[1].pk).delete()
+        self.assertEqual(self.counts(), ({}, {"all":1, "draft":1, "validated":0}))
+
+    def test_rebuild_gives_the_same_counts(self):
+        self.docs[1].delete()
+        before = stored_counts()
+
+        rebuild_counts()
+        self.assertEqual(stored_counts(), before)
+
+
+# the writer thread has its own connection, which does not see the transaction of a test
+@mock.patch("backend.sqlite.SQLITE_SINGLE_WRITER", False)
+class AdminDeleteTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(user)
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        patcher = mock.patch("newdocs.thumbnails.MEDIA_ROOT", media_root.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.media_root = media_root.name
+
+    def post(self, url, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(url, data, HTTP_HOST="localhost")
+
+    def add_image(self, doc):
+        ''' stores a JPEG image shown by the document, returns its DocImage '''
+
+        content = io.BytesIO()
+        Image.new("RGB", (640, 480), "green").save(content, "JPEG")
+        with self.captureOnCommitCallbacks(execute=True):
+            return store_doc_images([(doc, process_image(content.getvalue(), THUMBNAIL_SIZES))])[0]
+
+    def files_exist(self, image):
+        return [os.path.isfile(os.path.join(self.media_root, path)) for path in image_files(image)]
+
+    @mock.patch("backend.admin.unindex_docs")
+    def test_delete_document(self, unindex_docs):
+        doc = add_doc("deleted")
+
+        response = self.post(f"/admin/backend/loggeddoc/{doc.pk}/delete/", {"post":"yes"})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(LoggedDoc.objects.filter(pk=doc.pk).exists())
+        unindex_docs.assert_called_once_with([doc.pk])
+
+    @mock.patch("backend.admin.unindex_docs")
+    def test_delete_selected_documents(self, unindex_docs):
+        docs = [add_doc(f"deleted-{i}") for i in range(3)]
+        kept = add_doc("kept")
+
+        response = self.post("/admin/backend/loggeddoc/", {"action":"delete_selected", "post":"yes",
+                                                           "_selected_action":[doc.pk for doc in docs]})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(LoggedDoc.objects.values_list("pk", flat=True)), [kept.pk])
+        unindex_docs.assert_called_once()
+        self.assertEqual(sorted(unindex_docs.call_args[0][0]), [doc.pk for doc in docs])
+
+    @mock.patch("backend.admin.unindex_docs")
+    def test_delete_document_releases_its_images(self, unindex_docs):
+        doc = add_doc("with-image")
+        image = self.add_image(doc)
+        self.assertTrue(all(self.files_exist(image)))
+
+        self.post(f"/admin/backend/loggeddoc/{doc.pk}/delete/", {"post":"yes"})
+
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertFalse(any(self.files_exist(image)))
+
+    def test_delete_image_released_after_commit(self):
+        image = self.add_image(add_doc("with-image"))
+
+        # the admin deletes in a transaction, the image is only released once it is committed
+        with mock.patch("backend.admin.release_unreferenced") as release_unreferenced:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.client.post(f"/admin/backend/docimage/{image.pk}/delete/", {"post":"yes"}, HTTP_HOST="localhost")
+            release_unreferenced.assert_not_called()
+
+            for callback in callbacks:
+                callback()
+            release_unreferenced.assert_called_once()
+
+    def test_delete_selected_images(self):
+        shared = self.add_image(add_doc("first"))
+        other = self.add_image(add_doc("second"))
+
+        self.post("/admin/backend/docimage/", {"action":"delete_selected", "post":"yes", "_selected_action":[shared.pk]})
+
+        # the same image shown by another document is kept
+        self.assertFalse(DocImage.objects.filter(pk=shared.pk).exists())
+        self.assertEqual(StoredImage.objects.get().ref_count, 1)
+        self.assertTrue(all(self.files_exist(other)))
+
+        self.post("/admin/backend/docimage/", {"action":"delete_selected", "post":"yes", "_selected_action":[other.pk]})
+
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertFalse(any(self.files_exist(other)))
@@ -1,3 +1,72 @@
-from django.test import TestCase
+from datetime import date
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+
+from backend.models import LoggedDoc
+from homepage.views import keyset_page
+
+
+def add_doc(slug, publication_date=None, **fields):
+    return LoggedDoc.objects.create(slug=slug, title=slug, source_url=f"https://example.com/{slug}",
+                                    publication_date=publication_date, **fields)
+
+
+# the tiles of the test documents are not written to the cache shared with the server
+@override_settings(CACHES={"default":{"BACKEND":"django.core.cache.backends.locmem.LocMemCache"}})
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        # ties on the date and documents without a date, the order is (publication_date desc, nulls last, id desc)
+        dates = [date(2024, 1, 1), date(2024, 3, 1), date(2024, 3, 1), None, date(2023, 6, 1), date(2024, 3, 1), None]
+        self.docs = [add_doc(f"doc-{i}", publication_date) for i, publication_date in enumerate(dates)]
+
+    def walk(self, page_size):
+        ''' ids of every page, following the cursors '''
+
+        pages = []
+        docs, cursor = keyset_page(LoggedDoc.objects.all(), "publication_date", page_size=page_size)
+        pages.append([doc.id for doc in docs])
+        while cursor:
+            docs, cursor = keyset_page(LoggedDoc.objects.all(), "publication_date", cursor, page_size=page_size)
+            pages.append([doc.id for doc in docs])
+        return pages
+
+    def test_pages_follow_the_order(self):
+        expected = [doc.id for doc in sorted(self.docs, key=lambda doc: (doc.publication_date is not None, doc.publication_date or date.min, doc.id), reverse=True)]
+
+        for page_size in (1, 2, 3, 7, 10):
+            with self.subTest(page_size=page_size):
+                pages = self.walk(page_size)
+                self.assertEqual([doc_id for page in pages for doc_id in page], expected)
+                self.assertTrue(all(len(page) == page_size for page in pages[:-1]))
+
+    def test_creation_date_cursor(self):
+        docs, cursor = keyset_page(LoggedDoc.objects.all(), "created_at", page_size=4)
+        rest, last = keyset_page(LoggedDoc.objects.all(), "created_at", cursor, page_size=4)
+
+        self.assertIsNone(last)
+        self.assertEqual(sorted(doc.id for doc in docs+rest), sorted(doc.id for doc in self.docs))
+
+    def test_bad_cursor(self):
+        for cursor in ("not-a-cursor", "W251bGwsICJ4Il0=", "WyJub3QgYSBkYXRlIiwgMV0="):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    keyset_page(LoggedDoc.objects.all(), "publication_date", cursor)
+
+                response = self.client.get("/api/docs", {"cursor":cursor}, HTTP_HOST="localhost")
+                self.assertEqual(response.status_code, 400)
+
+                # the page without javascript starts again from the first page
+                self.assertEqual(self.client.get("/", {"cursor":cursor}, HTTP_HOST="localhost").status_code, 200)
+
+    def test_api_next_pages(self):
+        response = self.client.get("/api/docs", HTTP_HOST="localhost").json()
+        self.assertIn("facets", response)
+
+        seen = [doc["slug"] for doc in response["docs"]]
+        while response["next_cursor"]:
+            response = self.client.get("/api/docs", {"cursor":response["next_cursor"]}, HTTP_HOST="localhost").json()
+            self.assertNotIn("facets", response)
+            seen += [doc["slug"] for doc in response["docs"]]
+
+        self.assertEqual(sorted(seen), sorted(doc.slug for doc in self.docs))
@@ -5,5 +5,6 @@ app_name = "homepage"
 
 urlpatterns = [
     path("", views.index, name="index"),
+    path("api/docs", views.doc_list_api, name="doc_list_api"),
     path('save-document', views.save_doc, name='save_doc')
 ]
\ No newline at end of file
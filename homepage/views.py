@@ -1,32 +1,284 @@
 import os
-import re
+import json
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import date, datetime
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.shortcuts import render, redirect, get_object_or_404
-from django.db.models import Q
+from django.http import JsonResponse
+from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.urls import reverse
+from django.db.models import Q, F, Prefetch
 from articles.forms import AuthorFormset, CategoryFormset, CountryFormset, LoggedDocForm
-from backend.models import LoggedDoc, DocImage
+from backend.models import LoggedDoc, DocImage, Author, Category, Country, DocAuthor, DocCategory, DocCountry
+from backend.search import fts_available, fts_query, match_ids, ranked_ids, snippets
+from backend.doc_cache import DOC_CACHE_TIMEOUT, doc_cache_enabled, tile_key, bump_versions
+from backend.facets import stored_counts_available, stored_counts, live_counts
+from newdocs.embeddings import embeddings_enabled, semantic_ranking, index_docs
+from newdocs.doc_processing import transcode_images
+from newdocs.thumbnails import delete_image_files
+from newdocs.image_store import store_doc_images, release_unreferenced
+from backend.sqlite import run_write
 
 
 MEDIA_ROOT = settings.MEDIA_ROOT
+HOMEPAGE_PAGE_SIZE = settings.HOMEPAGE_PAGE_SIZE
+HOMEPAGE_FACET_SIZE = settings.HOMEPAGE_FACET_SIZE
+
+
 ## UTILS
 
-def img_index(array_img_docs, doc_slug):
+def filter_docs(params):
     '''
-    Returns the max index of an image given a document slug
-    the objective is to avoid duplicate names when adding images
+    Returns the documents matching the search and validation params of the home page (GET parameters),
+    the field they are sorted on ("search_rank", "publication_date" or "created_at"),
+    the full-text query of the keywords (None if there are none) and, when the documents are sorted by relevance,
+    the ranking that yields their ids (see keyset_page)
     '''
-    
-    indexes = []
-    for i in range(len(array_img_docs)):
-        file_name=array_img_docs[i].image_url
-        match = re.search(rf"{doc_slug}_(\d+).png", file_name)
-        if match:
-            index = int(match.group(1))
-            indexes.append(index)
 
-    # Find the maximum index
-    return max(indexes, default=0)
+    doc_list=LoggedDoc.objects.all()
+
+    #retrieve search params and apply filters
+    #semantic searches rank all documents by similarity to the keywords (see newdocs/embeddings.py)
+    #keywords are otherwise searched in the full-text index, or with LIKE if it is not available (e.g. not SQLite)
+    #when sorting by relevance, the matches are read from the index in keyset_page
+    kw=params.get("kw")
+    query=None
+    ranking=semantic_ranking(kw) if kw and semantic_search(params) else None
+    date_sorting="relevance" if ranking else params.get("sort-by-date", default_sorting(params))
+
+    if kw and not ranking:
+        query=fts_query(kw) if fts_available() else None
+        if query and date_sorting=="relevance":
+            ranking=lambda after, chunk_size: ranked_ids(query, after, chunk_size)
+        elif query:
+            doc_list=doc_list.filter(id__in=match_ids(query))
+        else:
+            doc_list=doc_list.filter(
+                Q(title__icontains=kw)|
+                Q(overview__icontains=kw)|
+                Q(summary__icontains=kw)|
+                Q(comment__icontains=kw)|
+                Q(llm__icontains=kw))
+
+    #a document matching several authors, categories or countries is only listed once
+    author=params.get("author")
+    if author:
+        doc_list=doc_list.filter(id__in=DocAuthor.objects.filter(author__in=Author.objects.filter(name__icontains=author)).values('doc_id'))
+
+    category=params.get("category")
+    if category:
+        doc_list=doc_list.filter(id__in=DocCategory.objects.filter(category__in=Category.objects.filter(category_name__icontains=category)).values('doc_id'))
+
+    country=params.get("country")
+    if country:
+        doc_list=doc_list.filter(id__in=DocCountry.objects.filter(country__in=Country.objects.filter(country_name__icontains=country)).values('doc_id'))
+
+    #retrieve sorting params, set default values and apply filters/sorting
+    validation_filter=params.get("sort-by-status","all")
+    if validation_filter=="draft":
+        doc_list=doc_list.filter(is_draft=True)
+    elif validation_filter=="validated":
+        doc_list=doc_list.filter(is_draft=False)
+
+    #keyword searches are sorted by relevance unless a date sorting is picked, semantic searches always are
+    if ranking:
+        sort_field="search_rank"
+    elif date_sorting=="creation_date":
+        sort_field="created_at"
+    else:
+        sort_field="publication_date"
+
+    return doc_list, sort_field, query, ranking
+
+def semantic_search(params):
+    return params.get("mode")=="semantic" and embeddings_enabled()
+
+def default_sorting(params):
+    ''' Keyword searches are sorted by relevance by default, the other lists by publication date '''
+    return "relevance" if params.get("kw") else "publication_date"
+
+def encode_cursor(doc, sort_field):
+    ''' Opaque cursor of the last document of a page: its sort value and its id '''
+
+    value=getattr(doc, sort_field)
+    if isinstance(value, (date, datetime)):
+        value=value.isoformat()
+    return urlsafe_b64encode(json.dumps([value, doc.id]).encode()).decode()
+
+def decode_cursor(cursor, sort_field):
+    ''' Returns (sort value, id) of a cursor, raises ValueError if it is invalid '''
+
+    try:
+        value, doc_id=json.loads(urlsafe_b64decode(cursor.encode()))
+        if sort_field=="search_rank":
+            value=float(value)
+        elif value is not None:
+            value=datetime.fromisoformat(value) if sort_field=="created_at" else date.fromisoformat(value)
+        return value, int(doc_id)
+
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"invalid cursor {cursor}") from e
+
+def keyset_page(doc_list, sort_field, cursor=None, page_size=HOMEPAGE_PAGE_SIZE, ranking=None):
+    '''
+    One page of documents ordered on (sort_field, id) so that the order is total: most recent first,
+    documents without a date coming last, or most relevant first for a search sorted by relevance.
+    The page starts after the cursor with a range condition on the index instead of an OFFSET,
+    so every page costs the same whatever its depth.
+    Returns the documents and the cursor of the next page (None on the last page)
+    '''
+
+    after=decode_cursor(cursor, sort_field) if cursor else None
+
+    if sort_field=="search_rank":
+        return ranked_page(doc_list, ranking, after, page_size)
+
+    doc_list=doc_list.order_by(F(sort_field).desc(nulls_last=True), "-id")
+
+    if after:
+        value, doc_id=after
+        if value is None:
+            doc_list=doc_list.filter(**{f"{sort_field}__isnull":True, "id__lt":doc_id})
+        else:
+            doc_list=doc_list.filter(Q(**{f"{sort_field}__lt":value}) | 
+                                     Q(**{sort_field:value, "id__lt":doc_id}) | 
+                                     Q(**{f"{sort_field}__isnull":True}))
+
+    #only the ids are read, the tiles of the page come from the cache (see page_tiles)
+    docs=list(doc_list.only("id", "cache_version", sort_field)[:page_size+1])
+
+    next_cursor=encode_cursor(docs[page_size-1], sort_field) if len(docs)>page_size else None
+    return docs[:page_size], next_cursor
+
+def ranked_page(doc_list, ranking, after, page_size):
+    '''
+    Page of a search sorted by relevance. The matches are read by decreasing relevance from the full-text index
+    or the vector store, in chunks, and the other filters are applied to each chunk until the page is full
+    :ranking: function (after, chunk_size) yielding (doc id, score) by increasing score, then decreasing id
+    '''
+
+    chunk_size=max(4*page_size, 200)
+    page=[]
+    chunk=[]
+    for doc_id, score in ranking(after, chunk_size):
+        chunk.append((doc_id, score))
+        if len(chunk)==chunk_size:
+            page+=filter_chunk(doc_list, chunk)
+            chunk=[]
+            if len(page)>page_size:
+                break
+    else:
+        page+=filter_chunk(doc_list, chunk)
+
+    scores=dict(page[:page_size])
+    docs=doc_list.filter(id__in=scores).only("id", "cache_version")
+    docs=sorted(docs, key=lambda doc: (scores[doc.id], -doc.id))
+    for doc in docs:
+        doc.search_rank=scores[doc.id]
+
+    next_cursor=encode_cursor(docs[page_size-1], "search_rank") if len(page)>page_size else None
+    return docs, next_cursor
+
+def related_names():
+    ''' Prefetch of the authors, categories and countries of the documents, in the order they were linked '''
+
+    return [Prefetch('authors', queryset=Author.objects.defer('name_embedding').order_by('docauthor')),
+            Prefetch('categories', queryset=Category.objects.defer('name_embedding').order_by('doccategory')),
+            Prefetch('countries', queryset=Country.objects.defer('name_embedding').order_by('doccountry'))]
+
+def filter_chunk(doc_list, chunk):
+    ''' Matches of the ranking that pass the other filters of the home page, in the same order '''
+
+    if not chunk:
+        return []
+    kept=set(doc_list.filter(id__in=[doc_id for doc_id, _ in chunk]).values_list('id', flat=True))
+    return [match for match in chunk if match[0] in kept]
+
+def page_tiles(docs, query, request):
+    '''
+    Tile (html) and JSON of each document of a page, in the same order, read from the cache (see backend/doc_cache.py)
+    Only the documents missing from the cache are loaded and rendered, and the documents with a highlighted extract
+    of the keywords, shown instead of the overview, which are not cached
+    '''
+
+    doc_snippets=snippets(query, [doc.id for doc in docs]) if query else {}
+    keys={doc.id:tile_key(doc.id, doc.cache_version) for doc in docs}
+    tiles=cache.get_many([key for doc_id, key in keys.items() if doc_id not in doc_snippets]) if doc_cache_enabled() else {}
+
+    missing=[doc_id for doc_id, key in keys.items() if key not in tiles]
+    if missing:
+        rendered={}
+        for doc in LoggedDoc.objects.filter(id__in=missing).select_related('default_image').prefetch_related(*related_names()):
+            doc.snippet=doc_snippets.get(doc.id)
+            tile={"html":render_to_string("homepage/doc_tile.html", {"doc":doc}, request=request), "data":doc_to_dict(doc)}
+            tiles[keys[doc.id]]=tile
+            if doc.snippet is None:
+                rendered[keys[doc.id]]=tile
+        if rendered and doc_cache_enabled():
+            cache.set_many(rendered, DOC_CACHE_TIMEOUT)
+
+    #a document deleted since its id was read is left out
+    return [tiles[keys[doc.id]] for doc in docs if keys[doc.id] in tiles]
+
+def facet_counts(params, doc_list, query, ranking):
+    '''
+    Number of documents per author, category, country and validation status for the filters of the home page,
+    with the link that adds each author, category or country to the filters
+    '''
+
+    #semantic searches rank the documents without filtering them, keyword searches sorted by relevance filter them in keyset_page
+    keyword_filter=params.get("kw") and not (ranking and query is None)
+    status=params.get("sort-by-status","all")
+
+    if stored_counts_available() and not (keyword_filter or params.get("author") or params.get("category") or params.get("country")):
+        facets=stored_counts(status, HOMEPAGE_FACET_SIZE)
+    else:
+        if query and ranking:
+            doc_list=doc_list.filter(id__in=match_ids(query))
+        #the counts per status are those of the other filters
+        all_status=params.copy()
+        all_status.pop("sort-by-status", None)
+        all_status_list=filter_docs(all_status)[0]
+        if query and ranking:
+            all_status_list=all_status_list.filter(id__in=match_ids(query))
+        facets=live_counts(doc_list, all_status_list, HOMEPAGE_FACET_SIZE)
+
+    for facet in ["author", "category", "country"]:
+        for item in facets[facet]:
+            item_params=params.copy()
+            item_params.pop("cursor", None)
+            item_params[facet]=item["name"]
+            item["url"]=f"?{item_params.urlencode()}"
+
+    return facets
+
+def thumbnail_url(image):
+    ''' url of the small JPEG variant of an image (see newdocs/thumbnails.py), of the original if it has no variants '''
+
+    if image is None:
+        return None
+    if image.small_variant:
+        return f"{settings.MEDIA_URL}{image.small_variant['jpeg']}"
+    return f"{settings.MEDIA_URL}{image}"
+
+def doc_to_dict(doc):
+    ''' JSON representation of a document of the list '''
+
+    return {"slug":doc.slug,
+            "title":doc.title,
+            "url":reverse('articles:document_details', args=[doc.slug]),
+            "publication_date":doc.publication_date.isoformat() if doc.publication_date else None,
+            "created_at":doc.created_at.isoformat(),
+            "overview":doc.overview,
+            "snippet":getattr(doc, "snippet", None),
+            "is_draft":doc.is_draft,
+            "thumbnail":thumbnail_url(doc.default_image),
+            "authors":[item.name for item in doc.authors.all()],
+            "categories":[item.category_name for item in doc.categories.all()],
+            "countries":[item.country_name for item in doc.countries.all()]}
 
 
 ## VIEWS
@@ -34,64 +286,69 @@ def img_index(array_img_docs, doc_slug):
 def index(request):
     """ home page of the app"""
 
-    #TODO pagination
     if request.method == 'GET':
 
-        doc_list=LoggedDoc.objects.all()
+        doc_list, sort_field, query, ranking=filter_docs(request.GET)
 
-        #TODO: embedding search
+        #first page, or the page after the cursor if the list is loaded without javascript
+        try:
+            docs, next_cursor=keyset_page(doc_list, sort_field, request.GET.get("cursor"), ranking=ranking)
+        except ValueError:
+            docs, next_cursor=keyset_page(doc_list, sort_field, ranking=ranking)
+        tiles=page_tiles(docs, query, request)
 
-        #retrieve search params and apply filters
         kw=request.GET.get("kw")
-        if kw:
-            doc_list=doc_list.filter(
-                Q(title__icontains=kw)|
-                Q(overview__icontains=kw)|
-                Q(summary__icontains=kw)|
-                Q(comment__icontains=kw)|
-                Q(llm__icontains=kw))
-
         author=request.GET.get("author")
-        if author:
-            doc_list=doc_list.filter(author__name__icontains=author)
-
         category=request.GET.get("category")
-        if category:
-            doc_list=doc_list.filter(category__category_name__icontains=category)
-
         country=request.GET.get("country")
-        if country:
-            doc_list=doc_list.filter(country__country_name__icontains=country)
-
-        #retrieve sorting params, set default values and apply filters/sorting
-        validation_filter=request.GET.get("sort-by-status","all")
-        if validation_filter=="draft":
-            doc_list=doc_list.filter(is_draft=True)
-        elif validation_filter=="validated":
-            doc_list=doc_list.filter(is_draft=False)
-
-        date_sorting=request.GET.get("sort-by-date","publication_date")
-        if date_sorting=="publication_date":
-            doc_list=doc_list.order_by("-publication_date")
-        elif date_sorting=="creation_date":
-            doc_list=doc_list.order_by("-created_at")
-
-        #prefetch related fields taking into account all parameters
-        doc_list=doc_list.prefetch_related('author_set', 'country_set', 'category_set')
 
         #dictionaries with params are passed to the template to display values and allow for further filtering in the UI
         search_params=None
         if kw or author or category or country:
             search_params={"kw":kw, "author":author, "category":category, "country":country}
 
-        sort_params={"date":date_sorting, "validation":validation_filter}
+        date_sorting="relevance" if sort_field=="search_rank" else request.GET.get("sort-by-date", default_sorting(request.GET))
+        sort_params={"date":date_sorting, "validation":request.GET.get("sort-by-status","all")}
+
+        #the next pages are loaded with the same params, see doc_list_api
+        next_params=request.GET.copy()
+        next_params.pop("cursor", None)
         
-        context = {'doc_list': doc_list, "search_params":search_params, "sort_params":sort_params}
+        facets=facet_counts(request.GET, doc_list, query, ranking)
+        facet_lists=[("Authors", facets["author"]), ("Categories", facets["category"]), ("Countries", facets["country"])]
+
+        context = {'tiles': tiles, "next_cursor":next_cursor, "next_params":next_params.urlencode(), 
+                   "search_params":search_params, "sort_params":sort_params,
+                   "facets":facets, "facet_lists":facet_lists,
+                   "semantic_enabled":embeddings_enabled(), "semantic":semantic_search(request.GET)}
         return render(request, "homepage/content.html", context)
     
     else:
         redirect('/')
 
+def doc_list_api(request):
+    '''
+    Next page of the home page list for infinite scroll, with the same filters and sorting as the index view
+    returns the documents (JSON), the tiles to append (HTML) and the cursor of the following page,
+    and the facet counts with the first page (without cursor)
+    '''
+
+    doc_list, sort_field, query, ranking=filter_docs(request.GET)
+
+    try:
+        docs, next_cursor=keyset_page(doc_list, sort_field, request.GET.get("cursor"), ranking=ranking)
+    except ValueError as e:
+        return JsonResponse({"error":str(e)}, status=400)
+    tiles=page_tiles(docs, query, request)
+
+    html=render_to_string("homepage/doc_tiles.html", {"tiles":tiles}, request=request)
+
+    response={"docs":[tile["data"] for tile in tiles], "html":html, "next_cursor":next_cursor}
+    if not request.GET.get("cursor"):
+        response["facets"]=facet_counts(request.GET, doc_list, query, ranking)
+
+    return JsonResponse(response)
+
 
 def save_doc(request):
     '''
@@ -136,43 +393,37 @@ def save_doc(request):
                 for image_url in images_to_delete:
                     try:
                         image_to_delete=DocImage.objects.get(image_url=image_url, doc=saved_document)
-                        image_path = os.path.join(MEDIA_ROOT, image_to_delete.image_url)
 
-                        # Check if file exists and delete it
-                        if os.path.isfile(image_path):
-                            os.remove(image_path)
+                        # the files of a stored image are deleted once no document shows it (below),
+                        # those of an image saved before the store belong to this document only
+                        if image_to_delete.stored_id is None:
+                            delete_image_files(image_to_delete)
                     
                         image_to_delete.delete()
                     
                     except DocImage.DoesNotExist:
                         pass
+
+                run_write(release_unreferenced)
             
             # add new images
             images_to_add = request.FILES.getlist('new_images')
             if images_to_add:
 
-                #find the max index of existing images
-                name_pattern = rf"images/{saved_document.slug}_(\d+)\.png"
-                existing_images = img_index(DocImage.objects.filter(image_url__regex=name_pattern), saved_document.slug)
-
                 for image_file in range(len(images_to_add)):
-                    file_name = f"{saved_document.slug}_{image_file+existing_images+1}.png"
-                    image_path = os.path.join(MEDIA_ROOT, 'images', file_name)
-
-                    # Ensure the directory exists
-                    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+                    # transcoded in the parse pool like the thumbnails of the pipeline, a file that is not an image is skipped
+                    transcoded = transcode_images([images_to_add[image_file].read()])
+                    if not transcoded:
+                        print(f"{images_to_add[image_file].name} is not an image")
+                        if default_image_url==f"new_image_{image_file}":
+                            default_image_url = None
+                        continue
 
-                    # Write the image bytes to a file
-                    with open(image_path, 'wb') as img_file:
-                        for chunk in images_to_add[image_file].chunks():
-                            img_file.write(chunk)
-
-                    relative_path=os.path.join('images', file_name)
-
-                    DocImage.objects.get_or_create(image_url=relative_path, doc=saved_document)
+                    # stored once per content, an image already shown by another document is not written again
+                    doc_image = run_write(store_doc_images, [(saved_document, transcoded[0])])[0]
 
                     if default_image_url==f"new_image_{image_file}":
-                        default_image_url = relative_path
+                        default_image_url = doc_image.image_url
             
             # set default image
             if default_image_url:
@@ -189,6 +440,12 @@ def save_doc(request):
                 saved_document.default_image = None
                 saved_document.save()
 
+            #the cached tile and page of the document are rendered again
+            bump_versions([saved_document.pk])
+
+            #the embedding follows the edits of the title, overview and summary
+            index_docs([saved_document])
+
             return redirect(f"/document/{saved_document.slug}")
 
         else:
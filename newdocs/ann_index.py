@@ -0,0 +1,188 @@
+import os
+import tempfile
+
+import numpy as np
+
+# Approximate nearest-neighbour index (IVF, inverted file) over normalized vectors, in NumPy.
+# The vectors are grouped around centroids found by k-means. A query is compared with the centroids,
+# then only with the vectors of its nprobe closest groups, instead of with every vector.
+# Below TRAIN_MIN_VECTORS the index is a plain matrix scanned entirely, which is as fast at that size.
+# Vectors added after training go to their closest group, and the groups are trained again once the index
+# has grown RETRAIN_GROWTH times since the last training.
+
+TRAIN_MIN_VECTORS=2048
+RETRAIN_GROWTH=4
+KMEANS_ITERATIONS=10
+KMEANS_SAMPLE_PER_LIST=64 # vectors per centroid used to train
+
+
+def normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors/norms
+
+def kmeans(vectors, n_lists, iterations=KMEANS_ITERATIONS, seed=0):
+    ''' Spherical k-means: centroids of normalized vectors, compared by dot product '''
+
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), n_lists*KMEANS_SAMPLE_PER_LIST), replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_lists)
+        # an empty list takes a random vector of the sample
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    def __init__(self, nprobe=8):
+        self.nprobe = nprobe
+        self.labels = []
+        self.positions = {} # label -> row
+        self.vectors = None # (capacity, dim), rows [:len(labels)] in use
+        self.centroids = None
+        self.trained_size = 0
+        self.lists = [] # per list: rows of the vectors
+        self.assignments = np.empty(0, dtype=np.int64) # list of each row
+        self.list_vectors = [] # per list: copy of the vectors, contiguous for the scan
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def dim(self):
+        return None if self.vectors is None else self.vectors.shape[1]
+
+    ## INSERT
+
+    def add(self, labels, vectors):
+        ''' Adds labelled vectors, a label already in the index is ignored '''
+
+        vectors = normalize(vectors)
+        new = [(label, vector) for label, vector in zip(labels, vectors) if label not in self.positions]
+        if not new:
+            return
+
+        if self.vectors is None:
+            self.vectors = np.empty((max(1024, len(new)), vectors.shape[1]), dtype=np.float32)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"vectors of size {vectors.shape[1]}, the index holds vectors of size {self.dim}")
+
+        start = len(self.labels)
+        end = start+len(new)
+        if end > len(self.vectors):
+            grown = np.empty((max(2*len(self.vectors), end), self.dim), dtype=np.float32)
+            grown[:start] = self.vectors[:start]
+            self.vectors = grown
+
+        if end > len(self.assignments):
+            self.assignments = np.concatenate([self.assignments, np.full(len(self.vectors)-len(self.assignments), -1)])
+
+        for row, (label, vector) in enumerate(new, start):
+            self.labels.append(label)
+            self.positions[label] = row
+        self.vectors[start:end] = [vector for _, vector in new]
+
+        if len(self) >= TRAIN_MIN_VECTORS and (self.centroids is None or len(self) >= RETRAIN_GROWTH*self.trained_size):
+            self.train()
+        elif self.centroids is not None:
+            self._assign(np.arange(start, end))
+
+    def train(self):
+        ''' Finds the centroids (about 4 per square root of the size) and groups every vector around them '''
+
+        n_lists = max(1, int(4*np.sqrt(len(self))))
+        self.centroids = kmeans(self.vectors[:len(self)], n_lists)
+        self.trained_size = len(self)
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(n_lists)]
+        self.list_vectors = [np.empty((0, self.dim), dtype=np.float32) for _ in range(n_lists)]
+        self._assign(np.arange(len(self)))
+
+    def _assign(self, rows, assignments=None):
+        ''' Adds rows to the list of their closest centroid (or to the lists given) '''
+
+        if assignments is None:
+            assignments = np.argmax(self.vectors[rows] @ self.centroids.T, axis=1)
+        self.assignments[rows] = assignments
+
+        # rows sorted by list, then split at the boundaries of the lists
+        order = np.argsort(assignments, kind="stable")
+        list_ids, starts = np.unique(assignments[order], return_index=True)
+        for list_id, added in zip(list_ids, np.split(rows[order], starts[1:])):
+            self.lists[list_id] = np.concatenate([self.lists[list_id], added])
+            self.list_vectors[list_id] = np.concatenate([self.list_vectors[list_id], self.vectors[added]])
+
+    ## SEARCH
+
+    def search(self, queries, k=1, exact=False):
+        ''' k nearest labels of each query, list (per query) of lists of (label, cosine similarity)
+        :exact: scans every vector, to measure the recall of the index '''
+
+        if not len(self):
+            return [[] for _ in range(len(np.atleast_2d(queries)))]
+
+        queries = normalize(queries)
+
+        if exact or self.centroids is None:
+            return [self._top(row_scores, np.arange(len(self)), k) for row_scores in queries @ self.vectors[:len(self)].T]
+
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :self.nprobe]
+        results = []
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([self.lists[list_id] for list_id in lists])
+            candidates = np.concatenate([self.list_vectors[list_id] for list_id in lists])
+            results.append(self._top(candidates @ query, rows, k))
+
+        return results
+
+    def _top(self, scores, rows, k):
+        if len(scores) > k:
+            best = np.argpartition(-scores, k-1)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        return [(self.labels[rows[index]], float(scores[index])) for index in best]
+
+    ## PERSISTENCE
+
+    def save(self, path):
+        ''' Writes the labels, vectors, centroids and list of each vector to a .npz file (atomically) '''
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npz")
+        with os.fdopen(fd, "wb") as index_file:
+            np.savez(index_file,
+                     labels=np.array(self.labels, dtype=str),
+                     vectors=self.vectors[:len(self)] if self.vectors is not None else np.empty((0, 0), dtype=np.float32),
+                     centroids=self.centroids if self.centroids is not None else np.empty((0, 0), dtype=np.float32),
+                     assignments=self.assignments[:len(self)],
+                     trained_size=self.trained_size,
+                     nprobe=self.nprobe)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls(nprobe=int(data["nprobe"]))
+            labels = data["labels"].tolist()
+            if labels:
+                index.vectors = data["vectors"].copy()
+                index.labels = labels
+                index.positions = {label: row for row, label in enumerate(labels)}
+                index.assignments = np.full(len(labels), -1)
+            if data["centroids"].size:
+                index.centroids = data["centroids"]
+                index.trained_size = int(data["trained_size"])
+                index.lists = [np.empty(0, dtype=np.int64) for _ in range(len(index.centroids))]
+                index.list_vectors = [np.empty((0, index.dim), dtype=np.float32) for _ in range(len(index.centroids))]
+                index._assign(np.arange(len(index)), data["assignments"])
+
+        return index
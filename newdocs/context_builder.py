@@ -0,0 +1,145 @@
+import re
+from functools import lru_cache
+from threading import Lock
+
+import requests
+from django.conf import settings
+
+from backend.models import OpenaiModel
+from newdocs.llm_dispatch import estimate_tokens
+
+# Packs the text extracted from a document into the token budget of the model.
+# Tokens are counted with tiktoken for OpenAI models (if installed), with the /tokenize endpoint of the llama.cpp server,
+# or estimated (4 characters per token) if neither is available.
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+LLAMA_CPP_SERVER_URL=settings.LLAMA_CPP_SERVER_URL
+LLAMA_CPP_CONTEXT_LENGTH=settings.LLAMA_CPP_CONTEXT_LENGTH
+CONTEXT_MAX_TOKENS=settings.CONTEXT_MAX_TOKENS
+
+PROMPT_OVERHEAD_TOKENS=300 # instructions, chat template and system prompt around the document
+MAX_CHARS_PER_TOKEN=6 # upper bound used to stop the extraction early, actual text is cut on tokens
+
+
+## BUDGET
+
+def parse_context_length(context_length):
+    ''' "16k", "128K", "4096"... as stored in OpenaiModel.context_length, to a number of tokens (None if unknown) '''
+
+    match = re.match(r'\s*(\d+(?:\.\d+)?)\s*([kK]?)', context_length or "")
+    if not match:
+        return None
+
+    tokens = float(match.group(1))
+    if match.group(2):
+        tokens *= 1000
+
+    return int(tokens)
+
+_llama_props = {}
+
+def llama_context_length():
+    ''' Context of a slot of the llama.cpp server, LLAMA_CPP_CONTEXT_LENGTH if the server does not say
+    Only a successful answer is kept, the server may not be up yet '''
+
+    if "n_ctx" not in _llama_props:
+        try:
+            props = requests.get(f"{LLAMA_CPP_SERVER_URL}/props", timeout=5).json()
+            _llama_props["n_ctx"] = int(props["default_generation_settings"]["n_ctx"])
+
+        except Exception:
+            return LLAMA_CPP_CONTEXT_LENGTH
+
+    return _llama_props["n_ctx"]
+
+def context_budget(client, model, completion_tokens):
+    ''' Number of tokens of the document that fit in the prompt of the model,
+    after the completion and the instructions, and at most CONTEXT_MAX_TOKENS to keep the latency per document down
+    :client: "openai" or "llama_cpp_server"
+    :model: name of the OpenAI model (see OpenaiModel), ignored for llama.cpp
+    :completion_tokens: max tokens of the completion '''
+
+    if client == "openai":
+        openai_model = OpenaiModel.objects.filter(model_name=model).first()
+        context_length = parse_context_length(openai_model.context_length) if openai_model else None
+
+    else:
+        context_length = llama_context_length()
+
+    if not context_length:
+        return CONTEXT_MAX_TOKENS
+
+    return max(min(context_length-completion_tokens-PROMPT_OVERHEAD_TOKENS, CONTEXT_MAX_TOKENS), 0)
+
+def max_chars(budget):
+    ''' Characters to extract from a document to be sure to fill the budget '''
+    return budget*MAX_CHARS_PER_TOKEN
+
+## TOKENS
+
+_tokenize_session = None
+_tokenize_lock = Lock()
+
+def _llama_tokenize(text):
+    global _tokenize_session
+
+    with _tokenize_lock:
+        if _tokenize_session is None:
+            _tokenize_session = requests.Session()
+
+    response = _tokenize_session.post(f"{LLAMA_CPP_SERVER_URL}/tokenize", json={"content": text}, timeout=30)
+    response.raise_for_status()
+    return len(response.json()["tokens"])
+
+@lru_cache(maxsize=None)
+def _tiktoken_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text, client, model=None):
+    ''' Number of tokens of a text for the model, estimated if no tokenizer is available '''
+
+    try:
+        if client == "openai" and tiktoken is not None:
+            return len(_tiktoken_encoding(model or "gpt-3.5-turbo").encode(text))
+
+        if client == "llama_cpp_server":
+            return _llama_tokenize(text)
+
+    except Exception:
+        pass
+
+    return estimate_tokens(text)
+
+## PACKING
+
+def pack_context(text, budget, client, model=None):
+    ''' Cuts the text to the budget in tokens, on a paragraph boundary when possible
+    The text is tokenized once if it fits, otherwise the cut is estimated from its characters per token and checked again '''
+
+    if not text:
+        return text
+
+    tokens = count_tokens(text, client, model)
+
+    while tokens > budget:
+        chars = int(len(text)*budget/tokens*0.95)
+        cut = text.rfind("\n\n", 0, chars)
+        # no paragraph boundary in the last 20% of the text, cut on a word
+        if cut < chars*0.8:
+            cut = text.rfind(" ", 0, chars)
+        if cut <= 0:
+            cut = chars
+
+        text = text[:cut].rstrip()
+        if not text:
+            break
+        tokens = count_tokens(text, client, model)
+
+    return text
@@ -0,0 +1,330 @@
+import re
+from datetime import datetime
+
+import fitz
+from bs4 import BeautifulSoup, SoupStrainer
+
+# lxml is optional, it speeds up fast_parse but the pure-Python parser is used otherwise
+try:
+    import lxml
+    FAST_PARSER = "lxml"
+except ImportError:
+    FAST_PARSER = "html.parser"
+
+# CPU-bound parsing of downloaded documents (BeautifulSoup and PyMuPDF).
+# These functions run in the processes of the parse pool (see doc_processing.run_parser): 
+# they only take and return plain data (bytes, str, lists, dicts) and must not import Django.
+
+
+## HTML
+
+def parse_html(html, category, max_chars=25000):
+    ''' Parses a downloaded page and returns what the pipeline needs as plain data (no soup object)
+    Youtube and Arxiv pages go through fast_parse first, and are parsed entirely if its selectors miss
+    :category: "Youtube", "Arxiv" or "Others"
+    :max_chars: max characters of text returned '''
+
+    if category in STRAINERS:
+        page = fast_parse(html, category)
+        if page:
+            return page
+
+    return full_parse(html, category, max_chars)
+
+def full_parse(html, category, max_chars=25000):
+    ''' Parses the whole page. Arxiv pages also return the text of the page, 
+    in case the scraping is incomplete and the page has to be processed by the LLM like other documents '''
+
+    soup = BeautifulSoup(html, 'html.parser')
+    page = {"youtube": None, "arxiv": None, "text": None, "og_image": og_image(soup), "first_image": None}
+
+    if category=="Youtube":
+        page["youtube"] = youtube_soup(soup)
+    elif category=="Arxiv":
+        page["arxiv"] = arxiv_soup(soup)
+
+    # first image of the page, a potential thumbnail
+    page_image = soup.find("img")
+    if page_image:
+        page["first_image"] = page_image.get("src")
+
+    # last, as it removes the boilerplate from the tree
+    if category!="Youtube":
+        page["text"] = main_content(soup, max_chars)
+
+    return page
+
+def fast_parse(html, category):
+    ''' Only builds the nodes read by arxiv_soup or youtube_soup (<head> and the main block of the page, see STRAINERS),
+    with lxml if it is installed. Returns None if the selectors miss, so that the page is parsed entirely '''
+
+    soup = BeautifulSoup(html, FAST_PARSER, parse_only=STRAINERS[category])
+    page = {"youtube": None, "arxiv": None, "text": None, "og_image": og_image(soup), "first_image": None}
+
+    try:
+        if category=="Youtube":
+            page["youtube"] = youtube_soup(soup)
+        
+        else:
+            page["arxiv"] = arxiv_soup(soup)
+            # the text of the page is only needed when the scraping is incomplete
+            if not all(page["arxiv"].get(key) for key in ("title", "authors", "publication_date", "categories", "abstract_with_links")):
+                return None
+
+    except Exception:
+        return None
+
+    return page
+
+def og_image(soup):
+    ''' url of the thumbnail in the header of the page, if any '''
+
+    try:
+        illustration = soup.select_one('head').find("meta", attrs={'property':'og:image'})
+        if illustration:
+            return illustration.get("content")
+    except:
+        pass
+
+    return None
+
+def _classes(attrs):
+    # class attribute as a string, whatever the tree builder passes to the strainer
+    classes = attrs.get("class") or ""
+    return " ".join(classes) if isinstance(classes, list) else classes
+
+# nodes kept by fast_parse, everything else is skipped while parsing
+STRAINERS = {
+    "Arxiv": SoupStrainer(lambda name, attrs: name=="head" or (name=="div" and "leftcolumn" in _classes(attrs).split())),
+    "Youtube": SoupStrainer(lambda name, attrs: name in ("head", "ytd-channel-name") or "ytd-watch-metadata" in _classes(attrs).split()),
+}
+
+def arxiv_soup(soup):
+    ''' 
+    Extracting data from an arxiv page.
+    If this specific usecase is what you are interested in,
+    checkout, this arxiv-focussed project : https://github.com/Nearcyan/papers.day
+    '''
+
+    page_content = soup.select_one('div.leftcolumn')
+    authors = [author.get_text(strip=True) for author in page_content.select('div.authors a')]
+    title = page_content.select_one('h1.title').get_text(strip=True)
+    #title can be null or blank in theory (according to the model) but it is not practical for the admin interface
+    if not title:
+        title = "_" 
+
+    categories = [category.get_text(strip=True) for category in page_content.select('.tablecell.subjects .primary-subject')]
+    publication_dates =page_content.select_one('div.submission-history').get_text(strip=True)
+    position=publication_dates.find("[v1]")
+    
+    if position!=-1:
+        publication_date=publication_dates[position+len("[v1]"):position+len("[v1]")+18]
+    
+    else:
+        publication_date=publication_dates
+    
+    match=re.search(r'\w\w\w, \d+ \w\w\w \d\d\d\d', publication_date)
+    
+    if match:
+        date_part = match.group()
+
+        # Parsing the date
+        date_obj = datetime.strptime(date_part, '%a, %d %b %Y')
+
+        # Formatting the date as YYYY/MM/DD
+        formatted_date = date_obj.strftime('%Y/%m/%d')
+        publication_date=formatted_date
+
+    abstract_with_links = page_content.select_one('blockquote.abstract')
+    
+    #voluntarily keeping the links but changing the attributes to reuse the entire HTML tag withthe app's css
+    # for link in abstract_with_links.find_all('a'):
+    #     link['class'] = ['external-link']
+    #     link['target'] = '_blank'
+    #     link['rel'] = 'noopener noreferrer nofollow'
+    
+    #commented-out the above out of security concerns. should be fine for Arxiv but activate it at your own risk
+    # you would need to add |safe in the articles:document_details template {{document.summary}} to render the HTML with tags
+    # in the meantime, we just extract the text
+    abstract_with_links=abstract_with_links.get_text(strip=True)
+
+    match=re.search(r'Abstract:</span>(.*?)</blockquote>', str(abstract_with_links), re.DOTALL)
+    
+    if match:
+        abstract_with_links = match.group(1).strip()
+    
+    else:
+        abstract_with_links = str(abstract_with_links)
+    
+    output={
+        'title': title[6:],
+        'authors': authors,
+        'publication_date': publication_date,
+        'categories': categories,
+        'abstract_with_links': abstract_with_links
+    }
+
+    # Return the extracted data
+    return output
+
+def youtube_soup(soup):
+    ''' Extracting the data from a youtube page '''
+
+    page_head = soup.select_one('head')
+    title=page_head.find("title").get_text(strip=True)
+    #title can be null or blank in theory (according to the model) but it is not practical for the admin interface
+    if not title:
+        title = "_"
+
+    description=page_head.find("meta",attrs={'name': 'description'}).get("content")
+    categories=page_head.find("meta",attrs={'name': 'keywords'}).get("content")
+    publication_date=soup.select_one(".ytd-watch-metadata #date-text")
+    
+    if publication_date:
+        publication_date=publication_date.get_text(strip=True)
+    
+    
+    #author not working, to be investigated
+    author=soup.find("ytd-channel-name", id="channel-name")
+    
+    if author:
+        author=[author.get_text(strip=True)]
+
+    output={
+        'title': title,
+        'authors': author,
+        'abstract': description,
+        'publication_date': publication_date,
+        'categories':categories.split(", ")
+    }
+
+    return output
+
+## MAIN CONTENT
+
+# tags that never hold the content of a document
+BOILERPLATE_TAGS = ["script", "style", "noscript", "template", "nav", "header", "footer", "aside", "form", "iframe", "svg", "button", "select"]
+# tags holding the text of a document, their score goes to their parent and grandparent
+TEXT_TAGS = ["p", "pre", "li", "blockquote", "td", "dd", "figcaption", "h1", "h2", "h3", "h4", "h5", "h6"]
+# hints in the class or id of an element
+NEGATIVE_HINTS = re.compile(r"nav|menu|footer|masthead|cookie|consent|gdpr|banner|sidebar|comment|share|social|related|promo|sponsor|advert|popup|modal|newsletter|subscribe|breadcrumb|skip", re.I)
+POSITIVE_HINTS = re.compile(r"article|content|main|post|entry|story|text|body|paper|abstract", re.I)
+
+def _hint_weight(tag):
+    hints = " ".join(tag.get("class") or []) + " " + (tag.get("id") or "")
+    weight = 0
+    if NEGATIVE_HINTS.search(hints):
+        weight -= 25
+    if POSITIVE_HINTS.search(hints):
+        weight += 25
+    return weight
+
+def _link_density(tag, text_length):
+    link_length = sum(len(link.get_text(strip=True)) for link in tag.find_all("a"))
+    return link_length/max(text_length, 1)
+
+def _clean_text(text):
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+def main_content(soup, max_chars=25000):
+    ''' Text of the main content of a page, without navigation, cookie banners, footers...
+    Readability-style scoring: every paragraph scores on its length and commas, its score goes to its parent (and half to its grandparent),
+    containers are weighted by their class/id and penalised by their density of links, and the best one is kept with its good siblings
+    Falls back to the text of the whole body if nothing stands out. The title of the page comes first
+    Returns None if the page has no body '''
+
+    body = soup.body
+    if body is None:
+        return None
+
+    title = soup.title.get_text(strip=True) if soup.title else ""
+
+    for tag in body.find_all(BOILERPLATE_TAGS):
+        if not tag.decomposed:
+            tag.decompose()
+
+    for tag in body.find_all(True):
+        if not tag.decomposed and tag is not body and _hint_weight(tag) < 0:
+            tag.decompose()
+
+    # paragraphs stay separated in the text, even when there is no whitespace between the tags
+    for block in body.find_all(TEXT_TAGS + ["div", "section", "article", "tr", "br"]):
+        block.insert_after("\n\n")
+
+    candidates = {} # id(tag) -> [tag, score]
+    for block in body.find_all(TEXT_TAGS):
+        text = block.get_text(" ", strip=True)
+        if len(text) < 25:
+            continue
+
+        score = 1 + text.count(",") + min(len(text)//100, 3)
+        for level, ancestor in enumerate(block.parents):
+            if level == 2 or ancestor is None or ancestor.name == "[document]":
+                break
+            if id(ancestor) not in candidates:
+                candidates[id(ancestor)] = [ancestor, _hint_weight(ancestor)]
+            candidates[id(ancestor)][1] += score if level == 0 else score/2
+
+    body_text = _clean_text(body.get_text())
+    content = body_text
+
+    if candidates:
+        for candidate in candidates.values():
+            tag = candidate[0]
+            candidate[1] *= 1 - _link_density(tag, len(tag.get_text(strip=True)))
+
+        top, top_score = max(candidates.values(), key=lambda candidate: candidate[1])
+
+        # siblings scoring well enough are part of the content (e.g. sections of an article split in several divs)
+        parts = [top]
+        if top.parent is not None and top is not body:
+            threshold = max(10, top_score*0.2)
+            parts = [sibling for sibling in top.parent.find_all(True, recursive=False)
+                     if sibling is top or candidates.get(id(sibling), [None, 0])[1] >= threshold]
+
+        text = _clean_text("\n\n".join(part.get_text() for part in parts))
+
+        # too little text compared to the page, the scoring probably missed the article
+        if len(text) >= 1000 or len(text) >= 0.2*len(body_text):
+            content = text
+
+    if title and title not in content[:len(title)+200]:
+        content = f"{title}\n\n{content}"
+
+    return content[:max_chars]
+
+## PDF
+
+def iter_pdf(pdf_path, max_pages=5, max_images=2):
+    ''' Yields (text, images) lazily: the metadata first, then one page at a time
+    The PDF is opened from disk, MuPDF only reads the objects of the pages that are requested. 
+    Stop iterating once you have enough text, the remaining pages are never extracted
+    :max_pages: only the first 5 pages, more will likely be too much for the LLM
+    :max_images: images kept per page as potential thumbnails '''
+
+    doc = fitz.open(pdf_path, filetype="pdf")
+
+    try:
+        yield "".join(f"{key}: {value}\n" for key, value in doc.metadata.items()), []
+
+        for page_number in range(min(max_pages, len(doc))):
+            page = doc[page_number]
+            images = [doc.extract_image(image[0])["image"] for image in page.get_images(full=True)[:max_images]]
+            yield page.get_text(), images
+
+    finally:
+        doc.close()
+
+def parse_pdf(pdf_path, max_chars=25000):
+    ''' Text of the first pages of a PDF, up to max_chars, and the images of the extracted pages '''
+
+    text = ""
+    images = []
+    for page_text, page_images in iter_pdf(pdf_path):
+        text += page_text
+        images.extend(page_images)
+        if len(text) >= max_chars:
+            break
+
+    return {"text": text[:max_chars], "images": images}
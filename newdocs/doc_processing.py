@@ -1,15 +1,24 @@
 import json
-from bs4 import BeautifulSoup
 import requests
+from requests.adapters import HTTPAdapter
 from openai import OpenAI
 from datetime import datetime
 import re
 import os
-import fitz
 import django
-import random
+import traceback
+import tempfile
+import time
+from collections import Counter
+from queue import Queue, Empty
+from threading import Thread, Lock, Timer, Condition
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from django.utils.text import slugify
-from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 's_a_k_b.settings')
 django.setup()
@@ -20,9 +29,31 @@ LLM_API_KEY=settings.LLM_API_KEY
 LLM_API_URL=settings.LLM_API_URL
 LLAMA_CPP_SERVER_URL=settings.LLAMA_CPP_SERVER_URL
 MEDIA_ROOT=settings.MEDIA_ROOT
-
-from backend.models import LoggedDoc, Author, Category, DocImage, Country, ProcessingLog
-from articles.forms import AuthorFormset, CategoryFormset, CountryFormset, LoggedDocForm
+FETCH_MAX_WORKERS=settings.FETCH_MAX_WORKERS
+FETCH_TIMEOUT=settings.FETCH_TIMEOUT
+PIPELINE_QUEUE_SIZE=settings.PIPELINE_QUEUE_SIZE
+HTTP_CACHE_ENABLED=settings.HTTP_CACHE_ENABLED
+PDF_MAX_BYTES=settings.PDF_MAX_BYTES
+THUMBNAIL_QUALITY=settings.THUMBNAIL_QUALITY
+PARSE_MAX_WORKERS=settings.PARSE_MAX_WORKERS
+PERSIST_BATCH_SIZE=settings.PERSIST_BATCH_SIZE
+PROGRESS_MIN_INTERVAL=settings.PROGRESS_MIN_INTERVAL
+
+from newdocs.http_cache import cached_get
+from newdocs.doc_parsing import parse_html, parse_pdf
+from newdocs.image_processing import process_images
+from newdocs.thumbnails import THUMBNAIL_SIZES
+from newdocs.image_store import store_doc_images
+from newdocs.context_builder import CONTEXT_MAX_TOKENS, context_budget, max_chars, pack_context
+from newdocs.llm_cache import completion_key, get_completion, store_completion
+from newdocs.llm_dispatch import get_dispatcher, estimate_tokens
+from newdocs.embeddings import index_docs
+from newdocs.taxonomy import resolve_terms, index_terms, save_indexes
+from newdocs.task_state import progress_key, set_state
+from backend.sqlite import run_write
+from backend.doc_cache import bump_versions
+from backend.models import LoggedDoc, Author, Category, DocImage, Country, DocAuthor, DocCategory, DocCountry, ProcessingLog
+from articles.forms import AuthorFormset, CategoryFormset, CountryFormset, PipelineDocForm
 
 
 class OutputTemplate:
@@ -97,174 +128,219 @@ def date_reformat(date_string): #LLM sometimes returns dates separated by wrong
 
 ## SCRAPING
 
-def get_soup(url):
-    ''' Getting the HTML content of a page '''
+_http_session = None
+_http_session_lock = Lock()
+
+def get_http_session():
+    ''' Returns the requests session shared by all fetch workers. 
+    Connections are pooled so that documents and thumbnails from the same host reuse the same sockets '''
+
+    global _http_session
+
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            # one pooled connection per fetch worker and per host
+            adapter = HTTPAdapter(pool_connections=FETCH_MAX_WORKERS, pool_maxsize=FETCH_MAX_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+
+    return _http_session
+
+def http_get(url, refresh=False):
+    ''' GET request through the shared session and, if enabled, the on-disk HTTP cache 
+    :refresh: bypasses the cached copy (see ProcessingTask.refresh_cache) '''
+
+    if HTTP_CACHE_ENABLED:
+        return cached_get(get_http_session(), url, timeout=FETCH_TIMEOUT, refresh=refresh)
+    
+    # streamed so that the body is only downloaded when read, see spool_pdf
+    return get_http_session().get(url, timeout=FETCH_TIMEOUT, stream=True)
+
+def get_image(url, refresh=False):
+    ''' Downloads an illustration and returns the bytes, or None if it can't be retrieved '''
+
+    try:
+        with http_get(url, refresh) as r:
+            if r.status_code==200:
+                return r.content
+
+    except requests.RequestException:
+        pass
+
+    return None
+
+class PdfTooLarge(Exception):
+    pass
+
+def spool_pdf(r):
+    ''' Streams a PDF response to a temp file in chunks, so that large PDFs are never held in memory
+    Raises PdfTooLarge above PDF_MAX_BYTES. The file is deleted when it is closed (or garbage collected) '''
+
+    if int(r.headers.get('Content-Length') or 0) > PDF_MAX_BYTES:
+        r.close()
+        raise PdfTooLarge(r.url)
+
+    pdf_file = tempfile.NamedTemporaryFile(suffix=".pdf")
+    size = 0
+
+    try:
+        for chunk in r.iter_content(chunk_size=64*1024):
+            size += len(chunk)
+            if size > PDF_MAX_BYTES:
+                raise PdfTooLarge(r.url)
+            pdf_file.write(chunk)
+
+    except:
+        r.close()
+        pdf_file.close()
+        raise
+
+    pdf_file.flush()
+    return pdf_file
+
+def get_doc(url, refresh=False):
+    ''' Downloading a document. Parsing is left to the parse stage (see parse_doc), which runs it in the parse pool
+    :refresh: if True, the cached copy of the document is ignored'''
 
     new_article = OutputTemplate()
     new_article.url = url
 
     # Make a request to the URL. 
-    r = requests.get(url)
+    try:
+        r = http_get(url, refresh)
+        status_code = r.status_code
+    
+    except requests.RequestException:
+        status_code = None
 
     # If the request failed, an entry will still be created in the DB so users can manually add the data
     # but the rest of the pipeline will not be executed
-    if r.status_code != 200:
+    if status_code != 200:
         new_article.overview = "Could not retrieve article (url could not be parsed)"
         new_article.summary = "Could not retrieve article (url could not be parsed)"
         # add an attribute to the object to indicate that the request failed
         new_article.error = True
+        # the body is never read, the connection goes back to the pool of the shared session now
+        if status_code is not None:
+            r.close()
     
     #if request is successful and doc is a pdf
     elif r.headers.get('Content-Type') == 'application/pdf':
-        # Parse the PDF
-        doc = fitz.open(stream=r.content, filetype="pdf")
-
-        text = ""   
-        # get the metadata and append the text from the PDF
-        metadata = doc.metadata
-        for key, value in metadata.items():
-            text += f"{key}: {value}\n"
-
-        for page in range(min(5,len(doc))): #only the first 5 pages, more will likely be too much for the LLM
-            text += doc[page].get_text()
-            image_list = doc[page].get_images(full=True)
+        # the PDF is streamed to a temp file and only read when the document is parsed, see doc_parsing.iter_pdf
+        try:
+            new_article.pdf = spool_pdf(r)
 
-            for img in range(min(2,len(image_list))): #only the first 2 images per page
-                xref = image_list[img][0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                new_article.thumbnail.append(image_bytes)
+        except (PdfTooLarge, requests.RequestException):
+            new_article.overview = "Could not retrieve article (PDF too large or download failed)"
+            new_article.summary = "Could not retrieve article (PDF too large or download failed)"
+            new_article.error = True
 
-        # add an attribute to the object to pass the text
-        new_article.pdf = text 
-    
-        doc.close()
- 
+        finally:
+            r.close()
     
     #if request is successful and doc is not a pdf
     else:
-        # Parse the HTML
-        soup = BeautifulSoup(r.content, 'html.parser')
-        # add an attribute to the object to pass the parsed HTML
-        new_article.soup = soup
-        
         try:
-            # get thumbnail url in header if any
-            page_head = soup.select_one('head')
-            illustration=page_head.find("meta",attrs={'property':'og:image'})
-
-            # stores the image if any
-            if illustration:
-                new_r=requests.get(illustration.get("content"))
-                if new_r.status_code==200:
-                    new_article.thumbnail.append(new_r.content)
-        
-        except:
-            pass
+            # add an attribute to the object to pass the raw HTML
+            new_article.html = r.content
+
+        except requests.RequestException:
+            new_article.overview = "Could not retrieve article (url could not be parsed)"
+            new_article.summary = "Could not retrieve article (url could not be parsed)"
+            new_article.error = True
 
-    # Return the pre-filled dictionary including the BeautifulSoup object or pdf text
+        finally:
+            r.close()
+
+    # Return the pre-filled dictionary including the raw HTML or pdf file
     return new_article
 
-def arxiv_soup(soup):
-    ''' 
-    Extracting data from an arxiv page.
-    If this specific usecase is what you are interested in,
-    checkout, this arxiv-focussed project : https://github.com/Nearcyan/papers.day
-    '''
+_parse_pool = None
+_parse_pool_lock = Lock()
 
-    page_content = soup.select_one('div.leftcolumn')
-    authors = [author.get_text(strip=True) for author in page_content.select('div.authors a')]
-    title = page_content.select_one('h1.title').get_text(strip=True)
-    #title can be null or blank in theory (according to the model) but it is not practical for the admin interface
-    if not title:
-        title = "_" 
+def get_parse_pool():
+    ''' Returns the process pool parsing documents (see doc_parsing), or None if PARSE_MAX_WORKERS is 0
+    Processes are spawned rather than forked, as forking a process running threads (web server, pipeline) is unsafe '''
 
-    categories = [category.get_text(strip=True) for category in page_content.select('.tablecell.subjects .primary-subject')]
-    publication_dates =page_content.select_one('div.submission-history').get_text(strip=True)
-    position=publication_dates.find("[v1]")
-    
-    if position!=-1:
-        publication_date=publication_dates[position+len("[v1]"):position+len("[v1]")+18]
-    
-    else:
-        publication_date=publication_dates
-    
-    match=re.search(r'\w\w\w, \d+ \w\w\w \d\d\d\d', publication_date)
-    
-    if match:
-        date_part = match.group()
+    global _parse_pool
 
-        # Parsing the date
-        date_obj = datetime.strptime(date_part, '%a, %d %b %Y')
+    with _parse_pool_lock:
+        if _parse_pool is None and PARSE_MAX_WORKERS > 0:
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_MAX_WORKERS, mp_context=multiprocessing.get_context("spawn"))
 
-        # Formatting the date as YYYY/MM/DD
-        formatted_date = date_obj.strftime('%Y/%m/%d')
-        publication_date=formatted_date
+    return _parse_pool
 
-    abstract_with_links = page_content.select_one('blockquote.abstract')
-    
-    #voluntarily keeping the links but changing the attributes to reuse the entire HTML tag withthe app's css
-    # for link in abstract_with_links.find_all('a'):
-    #     link['class'] = ['external-link']
-    #     link['target'] = '_blank'
-    #     link['rel'] = 'noopener noreferrer nofollow'
-    
-    #commented-out the above out of security concerns. should be fine for Arxiv but activate it at your own risk
-    # you would need to add |safe in the articles:document_details template {{document.summary}} to render the HTML with tags
-    # in the meantime, we just extract the text
-    abstract_with_links=abstract_with_links.get_text(strip=True)
+def run_parser(parser, *args):
+    ''' Runs a function of doc_parsing in the parse pool and waits for its result, so that several cores parse at once
+    while the pipeline threads only orchestrate. Parses in the calling thread if the pool is disabled '''
 
-    match=re.search(r'Abstract:</span>(.*?)</blockquote>', str(abstract_with_links), re.DOTALL)
-    
-    if match:
-        abstract_with_links = match.group(1).strip()
-    
-    else:
-        abstract_with_links = str(abstract_with_links)
-    
-    output={
-        'title': title[6:],
-        'authors': authors,
-        'publication_date': publication_date,
-        'categories': categories,
-        'abstract_with_links': abstract_with_links
-    }
+    global _parse_pool
 
-    # Return the extracted data
-    return output
+    pool = get_parse_pool()
+    if pool is None:
+        return parser(*args)
 
-def youtube_soup(soup):
-    ''' Extracting the data from a youtube page '''
+    try:
+        return pool.submit(parser, *args).result()
 
-    page_head = soup.select_one('head')
-    title=page_head.find("title").get_text(strip=True)
-    #title can be null or blank in theory (according to the model) but it is not practical for the admin interface
-    if not title:
-        title = "_"
+    except BrokenProcessPool:
+        # a process died (e.g. out of memory on a huge document), the pool is replaced for the next documents
+        with _parse_pool_lock:
+            if _parse_pool is pool:
+                _parse_pool = None
+        pool.shutdown(wait=False)
+        raise
 
-    description=page_head.find("meta",attrs={'name': 'description'}).get("content")
-    categories=page_head.find("meta",attrs={'name': 'keywords'}).get("content")
-    publication_date=soup.select_one(".ytd-watch-metadata #date-text")
-    
-    if publication_date:
-        publication_date=publication_date.get_text(strip=True)
-    
-    
-    #author not working, to be investigated
-    author=soup.find("ytd-channel-name", id="channel-name")
-    
-    if author:
-        author=[author.get_text(strip=True)]
+def transcode_images(images):
+    ''' Downloaded images in the formats and sizes served by the app (see newdocs/thumbnails.py), transcoded in the parse pool
+    The bytes that are not an image are dropped '''
+
+    if not images:
+        return []
+
+    return run_parser(process_images, images, THUMBNAIL_SIZES, THUMBNAIL_QUALITY)
+
+def fetch_docs(urls, refresh=False):
+    ''' Downloads the documents in parallel and yields (url, OutputTemplate) in completion order
+    At most FETCH_MAX_WORKERS documents are downloading or waiting to be consumed at any time, 
+    so a slow consumer (e.g. the LLM) does not let fetched pages pile up in memory 
+    :refresh: passed to get_doc '''
+
+    urls = iter(urls)
+
+    with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as executor:
+        pending = {}
+
+        def submit_next():
+            url = next(urls, None)
+            if url is not None:
+                pending[executor.submit(get_doc, url, refresh)] = url
 
-    output={
-        'title': title,
-        'authors': author,
-        'abstract': description,
-        'publication_date': publication_date,
-        'categories':categories.split(", ")
-    }
+        for _ in range(FETCH_MAX_WORKERS):
+            submit_next()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                url = pending.pop(future)
+                
+                try:
+                    new_article = future.result()
+                
+                except Exception:
+                    # get_doc already handles network errors, this is a last resort (e.g. parsing crash)
+                    new_article = OutputTemplate()
+                    new_article.url = url
+                    new_article.overview = "Could not retrieve article (url could not be parsed)"
+                    new_article.summary = "Could not retrieve article (url could not be parsed)"
+                    new_article.error = True
+
+                yield url, new_article
+                submit_next()
 
-    return output
 
 ## LLM UTILS
 
@@ -305,7 +381,7 @@ def get_grammar(grammar_size):
      :grammar_size: "long" or "short" '''
 
     #TODO : for now the list of categories and countries are omitted. TBC if we want to add constraints on the outputs to match the vales in DB. 
-    #For now, the working assumption is that the model will set categories and countries, and we will retrieve the most relevant ones from the DB using embeddings
+    #For now, the working assumption is that the model will set categories and countries, and we will retrieve the most relevant ones from the DB using embeddings (see newdocs/taxonomy.py)
 
     # grammar to extract information from scraping data that haven't been be-processed
     if grammar_size=="long":
@@ -346,13 +422,44 @@ def get_grammar(grammar_size):
 
 ## LLM CALLS
 
+MAX_NEW_TOKENS=2000 # maximum length of the completion
+
+_openai_clients = {}
+_llm_session = None
+_llm_clients_lock = Lock()
+
+def get_openai_client(api_url, api_key):
+    ''' Returns an OpenAI client reused across calls (and threads) so that connections are kept alive '''
+
+    with _llm_clients_lock:
+        if (api_url, api_key) not in _openai_clients:
+            _openai_clients[(api_url, api_key)] = OpenAI(base_url=f"{api_url}", api_key=api_key)
+    
+    return _openai_clients[(api_url, api_key)]
+
+def get_llm_session():
+    ''' Returns the requests session used to call the llama.cpp server, with one pooled connection per slot '''
+
+    global _llm_session
+
+    with _llm_clients_lock:
+        if _llm_session is None:
+            pool_size = get_dispatcher("llama_cpp_server").max_in_flight
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _llm_session = session
+
+    return _llm_session
+
 def run_openai(prompt, api_url, api_key, model="gpt-3.5-turbo-1106"): 
     ''' Calls the OpenAI API 
     :model: gpt-3.5-turbo-1106 or gpt-4-1106-preview only for now as it is the only one that returns a JSON object
     list of models here: https://platform.openai.com/docs/models.
     '''
     
-    client = OpenAI(base_url=f"{api_url}", api_key=api_key)
+    client = get_openai_client(api_url, api_key)
     
     try : 
         # call to the API
@@ -362,7 +469,7 @@ def run_openai(prompt, api_url, api_key, model="gpt-3.5-turbo-1106"):
             model=model,
             messages=prompt,
             temperature=0.8,
-            max_tokens=2000,
+            max_tokens=MAX_NEW_TOKENS,
             top_p=0.95,
             frequency_penalty=0.0,
             presence_penalty=0.0,
@@ -393,7 +500,7 @@ def run_ggml(prompt, api_url, grammar, chat_format="chatml"):
           "top_p":0.95,
           "frequency_penalty":0.0,
           "presence_penalty":0.0,
-          "n_predict":2000,
+          "n_predict":MAX_NEW_TOKENS,
           "stop":[completion_params["stop_token"]],
           "grammar":grammar,
           "prompt":prompt_format
@@ -403,7 +510,7 @@ def run_ggml(prompt, api_url, grammar, chat_format="chatml"):
 
     try:
         #actual call to the server
-        response = requests.post(
+        response = get_llm_session().post(
             f"{api_url}/completion",headers=headers, data=json.dumps(data),
         ).json()
         
@@ -413,28 +520,52 @@ def run_ggml(prompt, api_url, grammar, chat_format="chatml"):
         # building a response object to match the one returned when request is successful so that it can be processed in the same way
         return {"model - error":str(e),"content":{}, "model":"llama.cpp server"}
 
-def get_chat_completion(complete_prompt, client, grammar, chat_format, model): 
+def get_chat_completion(complete_prompt, client, grammar, chat_format, model, use_cache=True): 
     ''' Calls the appropriate API based on user choice 
+    Can be called from several threads at once: the dispatcher of the client caps the number of requests
+    in flight and, if configured, the requests/tokens per minute (see settings.LLM_CLIENTS)
+    Completions are cached (see llm_cache) and the returned dictionary has a "cached" key telling if the cache answered.
+    A new completion is only stored once its JSON is validated: it carries its "cache_key", see cache_completion
     :client: "openai" or "llama_cpp_server"
+    :use_cache: if False, the model is called even if the same prompt was already answered (the new answer is still cached)
     '''
 
+    key=completion_key(client, model, chat_format, grammar, complete_prompt)
+    
+    if use_cache:
+        completion=get_completion(key)
+        if completion is not None:
+            completion["cached"]=True
+            return completion
+
     if client == "openai":
         # TODO: add chat format choice when other LLM API providers can provide json
         # for now, chat format is not releavant for OpenAI
-        completion = run_openai(complete_prompt, LLM_API_URL, LLM_API_KEY, model)
+        with get_dispatcher(client).slot(estimate_tokens(complete_prompt, MAX_NEW_TOKENS)):
+            completion = run_openai(complete_prompt, LLM_API_URL, LLM_API_KEY, model)
         
     elif client == "llama_cpp_server":
         # Note : model choice is not relevant for llama.cpp server as model is defined when the server is launched. 
         # A model able to process at least 16k tokens is recommended (gpt-3.5-turbo-1106 is 16k)
-        completion = run_ggml(complete_prompt, LLAMA_CPP_SERVER_URL, grammar, chat_format) 
+        with get_dispatcher(client).slot(estimate_tokens(complete_prompt, MAX_NEW_TOKENS)):
+            completion = run_ggml(complete_prompt, LLAMA_CPP_SERVER_URL, grammar, chat_format) 
 
     else:
         #TODO: add others?
         completion = {"model - error": "Invalid client type", "content": {}, "model": "Invalid client type"}
     
+    completion["cache_key"]=key
+    completion["cached"]=False
     return completion
 
-def generate_llm(prompt_input, client, chat_format, model):
+def cache_completion(response, client, model):
+    ''' Stores a new completion returned by get_chat_completion, once llm_doc has parsed its JSON '''
+
+    if response.get("cache_key"):
+        completion={key: value for key, value in response.items() if key not in ("cache_key", "cached")}
+        store_completion(response["cache_key"], client, model, completion)
+
+def generate_llm(prompt_input, client, chat_format, model, use_cache=True):
     ''' Prepares the prompt, calls the API and returns the response in an appropriate JSON format 
      :client: "openai" or "llama_cpp_server"
     '''
@@ -456,11 +587,11 @@ def generate_llm(prompt_input, client, chat_format, model):
 
     grammar=get_grammar("long")
 
-    completion=get_chat_completion(complete_prompt, client, grammar, chat_format, model) 
+    completion=get_chat_completion(complete_prompt, client, grammar, chat_format, model, use_cache) 
     
     return json.dumps(completion)
 
-def generate_short_llm(prompt_input, client, chat_format, model): 
+def generate_short_llm(prompt_input, client, chat_format, model, use_cache=True): 
     ''' Prepares the prompt for what couldn't be scraped from Arxiv, calls the API and returns the response in an appropriate JSON format 
      :client: "openai" or "llama_cpp_server"'''
 
@@ -480,11 +611,11 @@ def generate_short_llm(prompt_input, client, chat_format, model):
 
     grammar=get_grammar("short")
 
-    completion=get_chat_completion(complete_prompt, client, grammar, chat_format, model) 
+    completion=get_chat_completion(complete_prompt, client, grammar, chat_format, model, use_cache) 
     
     return json.dumps(completion)
 
-def check_llm(prompt_input, client, chat_format, model): 
+def check_llm(prompt_input, client, chat_format, model, use_cache=True): 
     ''' Prepares the prompt to check a wrong json, calls the API and returns the response in an appropriate JSON format 
      :client: "openai" or "llama_cpp_server"'''
 
@@ -502,11 +633,11 @@ def check_llm(prompt_input, client, chat_format, model):
 
     grammar=get_grammar("long")
 
-    completion=get_chat_completion(complete_prompt, client, grammar, chat_format, model) 
+    completion=get_chat_completion(complete_prompt, client, grammar, chat_format, model, use_cache) 
     
     return json.dumps(completion)
 
-def check_short_llm(prompt_input, client, chat_format, model): 
+def check_short_llm(prompt_input, client, chat_format, model, use_cache=True): 
     ''' Prepares the prompt to check a wrong json, calls the API and returns the response in an appropriate JSON format
       :client: "openai" or "llama_cpp_server" '''
 
@@ -524,7 +655,7 @@ def check_short_llm(prompt_input, client, chat_format, model):
 
     grammar=get_grammar("short")
 
-    completion=get_chat_completion(complete_prompt, client, grammar, chat_format, model) 
+    completion=get_chat_completion(complete_prompt, client, grammar, chat_format, model, use_cache) 
     
     return json.dumps(completion)
 
@@ -584,40 +715,44 @@ def response_log(process_log, response):
     else:
         process_log["llm_output"]=response.get("content",{})
 
+    # completion cache statistics
+    cache_stat="cache_hits" if response.get("cached") else "cache_misses"
+    process_log[cache_stat]=process_log.get(cache_stat,0)+1
+
     return process_log
 
-def check_slug(slug):
-    ''' Check if the slug is unique and append a random number at the end if it is not'''
+def allocate_slug(slug, current=None, taken=()):
+    ''' Returns a free slug: the slug itself, or the slug with the next free numeric suffix (slug-2, slug-3...)
+    The slugs already used are read with a single query on the unique index (the slug and the range slug-...)
+    Two writers can still pick the same slug at the same time: the unique constraint rejects the second one, see add_docs_to_db
+    :current: slug of the document being updated, kept if it is a variant of the slug so that reprocessing does not change the URL
+    :taken: slugs already allocated in the same batch '''
 
-    #make sure slugs provided by llm do not incude special characters
-    slug=slugify(slug)
+    #make sure slugs provided by llm do not incude special characters. Room is kept for the suffix
+    base=slugify(slug)[:240].strip("-") or "document"
+    pattern=re.compile(rf"^{re.escape(base)}(?:-(\d+))?$")
 
-    #recursive function to add a random number at the end of the slug until it is unique
-    try:
-        LoggedDoc.objects.get(slug=slug)
-        return check_slug(slug+str(random.randint(0, 9)))
-    
-    except LoggedDoc.DoesNotExist:
-        return slug
+    if current and pattern.match(current):
+        return current
 
-## DATABASE ENTRY
+    # '.' comes right after '-', so the range holds every slug starting with base-
+    used=set(LoggedDoc.objects.filter(Q(slug=base) | Q(slug__gte=f"{base}-", slug__lt=f"{base}."))
+             .values_list("slug", flat=True))
+    used.update(taken)
 
-def add_to_db(article, process_log):
-    ''' Adding the data to the DB 
-    article and process_logs are dictionaries populated in the pipeline'''
-    
-    #add log to DB
-    to_log=ProcessingLog(task_id=process_log["task_id"],
-                        source_url=process_log["url"], 
-                        success=process_log.get("success",True), 
-                        llm=article.get("model_used",None), 
-                        llm_output=process_log.get("llm_output",None), 
-                        llm_turns=process_log.get("turns",None))
+    if base not in used:
+        return base
 
-    to_log.save()
+    suffixes=[int(match.group(1)) for match in map(pattern.match, used) if match and match.group(1)]
+    return f"{base}-{max(suffixes, default=1)+1}"
 
-    # make sure slugs are unique
-    slug=check_slug(article["slug"])
+## DATABASE ENTRY
+
+SLUG_ATTEMPTS=3 # transactions attempted by add_docs_to_db when a concurrent writer takes the same slug
+
+def prepare_doc(article, logged_doc, slug):
+    ''' Validates the fields of a document with PipelineDocForm and returns the unsaved LoggedDoc (None if the form is invalid)
+    :logged_doc: the document already stored for this URL, if any, which is updated '''
 
     try:
         date_reformat(article["date_published"])
@@ -635,11 +770,6 @@ def add_to_db(article, process_log):
         title="_" 
     else:
         title=article["title"]
-
-    try:
-        logged_doc = LoggedDoc.objects.get(source_url=article["url"])
-    except LoggedDoc.DoesNotExist:
-        logged_doc = None
         
     form_input={'slug':slug,
                     'title':title, 
@@ -652,66 +782,151 @@ def add_to_db(article, process_log):
                     'llm':article["model_used"], 
                     'is_draft':True}
         
-    form=LoggedDocForm(form_input, instance=logged_doc)
+    form=PipelineDocForm(form_input, instance=logged_doc)
 
     #only try to save the document if the form is valid
     if form.is_valid():
-        to_add=form.save()
-
-        #LLM may not return an empty list but None. Youtube may not identify the authors at all
-        #only create an entry if the pair (author, doc) does not exist already
-        if article["authors"] is None:
-            article["authors"]=[]
-        for author in article["authors"]:
-            Author.objects.get_or_create(name=author, doc=to_add)
-
-        if article["categories"] is None:
-            article["categories"]=[]
-        for category in article["categories"]:
-            Category.objects.get_or_create(category_name=category, doc=to_add)
-
-        if article["countries"] is None:
-            article["countries"]=[]
-        for country in article["countries"]:
-            Country.objects.get_or_create(country_name=country, doc=to_add)
-
-        if len(article["thumbnail"])>0:
-            #create new images in DB
-            for index in range(len(article["thumbnail"])):
-                file_name = f"{to_add.slug}_{index}.png"
-                image_path = os.path.join(MEDIA_ROOT, 'images', file_name)
-
-                # Ensure the directory exists
-                os.makedirs(os.path.dirname(image_path), exist_ok=True)
-
-                # Write the image bytes to a file.
-                with open(image_path, 'wb') as image_file:
-                    image_file.write(article["thumbnail"][index])
-
-                relative_path=os.path.join('images', file_name)
+        return form.save(commit=False)
+
+    print("form invalid", form.errors)
+    return None
+
+def bulk_add_related(model, field, link_model, docs_values, updated_ids):
+    ''' Links the documents to their related names (authors, categories, countries), creating the names that do not exist yet
+    :model: Author, Category or Country, with a unique name field
+    :link_model: DocAuthor, DocCategory or DocCountry
+    :docs_values: list of (LoggedDoc, list of values)
+    :updated_ids: documents that existed before the batch, the only ones that may already have links '''
+
+    link_field=f"{model._meta.model_name}_id"
+
+    #LLM may not return an empty list but None. Youtube may not identify the authors at all
+    names={value for _, values in docs_values for value in values or []}
+    if not names:
+        return
+
+    # one row per name: the missing ones are created (a concurrent writer may have created some, hence the ignore)
+    ids=dict(model.objects.filter(**{f"{field}__in":names}).values_list(field, "id"))
+    missing=names-set(ids)
+    if missing:
+        model.objects.bulk_create([model(**{field:name}) for name in missing], ignore_conflicts=True)
+        ids.update(model.objects.filter(**{f"{field}__in":missing}).values_list(field, "id"))
+
+    existing=set(link_model.objects.filter(doc_id__in=updated_ids).values_list("doc_id", link_field)) if updated_ids else set()
+
+    links=[]
+    for doc, values in docs_values:
+        for value in values or []:
+            #only create a link if the pair (doc, name) does not exist already
+            if (doc.pk, ids[value]) not in existing:
+                existing.add((doc.pk, ids[value]))
+                links.append(link_model(doc=doc, **{link_field:ids[value]}))
+
+    link_model.objects.bulk_create(links, ignore_conflicts=True)
+
+def save_thumbnails(docs):
+    ''' Stores the thumbnails of the documents (see newdocs/image_store.py), links them to the documents
+    and sets the first image of each document as its default image
+    :docs: list of (LoggedDoc, article), the thumbnails of the article being transcoded by transcode_images '''
+
+    pairs=[(doc, thumbnail) for doc, article in docs for thumbnail in article["thumbnail"]]
+    images=store_doc_images(pairs)
+
+    with_default={}
+    for (doc, _), image in zip(pairs, images):
+        if doc.pk not in with_default:
+            #set first image as default
+            doc.default_image=image
+            with_default[doc.pk]=doc
+
+    LoggedDoc.objects.bulk_update(list(with_default.values()), ["default_image"])
+
+def add_docs_to_db(entries):
+    ''' Adding a batch of documents to the DB in a single transaction 
+    :entries: list of (article, process_log), dictionaries populated in the pipeline
+    Documents, logs and related rows are inserted in bulk, so a batch costs a few queries per table 
+    instead of dozens of write transactions per document. Returns the saved documents '''
+
+    # a URL listed twice in the batch: the last one wins, as if they had been added one after the other
+    articles={}
+    for article, process_log in entries:
+        articles[article["url"]]=article
+
+    for attempt in range(SLUG_ATTEMPTS):
+        try:
+            return write_docs(entries, articles)
+
+        # another writer took one of the slugs (or added one of the URLs) since they were read, the batch is allocated again
+        except IntegrityError:
+            if attempt==SLUG_ATTEMPTS-1:
+                raise
+
+def write_docs(entries, articles):
+    ''' Transaction of add_docs_to_db, all or nothing: an attempt that raises is rolled back entirely (logs included),
+    so the logs of a batch are only recorded by the attempt that commits '''
+
+    with transaction.atomic():
+        logged_docs=LoggedDoc.objects.in_bulk(list(articles), field_name="source_url")
+
+        docs=[]
+        taken=set()
+        for url, article in articles.items():
+            logged_doc=logged_docs.get(url)
+
+            # make sure slugs are unique, in the DB and in the batch
+            slug=allocate_slug(article["slug"], current=logged_doc.slug if logged_doc else None, taken=taken)
+            taken.add(slug)
+
+            doc=prepare_doc(article, logged_doc, slug)
+            if doc is not None:
+                docs.append((doc, article))
+
+        updated_ids=[doc.pk for doc, _ in docs if doc.pk is not None]
+        for doc, _ in docs:
+            if doc.pk is not None:
+                doc.save()
+        LoggedDoc.objects.bulk_create([doc for doc, _ in docs if doc.pk is None])
+
+        bulk_add_related(Author, "name", DocAuthor, [(doc, article["authors"]) for doc, article in docs], updated_ids)
+        bulk_add_related(Category, "category_name", DocCategory, [(doc, article["categories"]) for doc, article in docs], updated_ids)
+        bulk_add_related(Country, "country_name", DocCountry, [(doc, article["countries"]) for doc, article in docs], updated_ids)
+        save_thumbnails(docs)
+
+        #the documents processed again are rendered again on the home page and their page
+        bump_versions(updated_ids)
+
+        #add logs to DB, last: an attempt that fails before this point has written nothing
+        ProcessingLog.objects.bulk_create([ProcessingLog(task_id=process_log["task_id"],
+                                                         source_url=process_log["url"], 
+                                                         success=process_log.get("success",True), 
+                                                         llm=article.get("model_used",None), 
+                                                         llm_output=process_log.get("llm_output",None), 
+                                                         llm_turns=process_log.get("turns",None),
+                                                         cache_hits=process_log.get("cache_hits",0),
+                                                         cache_misses=process_log.get("cache_misses",0))
+                                           for article, process_log in entries])
+
+    return [doc for doc, _ in docs]
 
-                new_image, created=DocImage.objects.get_or_create(image_url=relative_path, doc=to_add)
+def add_to_db(article, process_log):
+    ''' Adding the data to the DB 
+    article and process_logs are dictionaries populated in the pipeline'''
 
-                if index==0:
-                    #set first image as default
-                    to_add.default_image=new_image
-                    to_add.save()
-
-    else:
-        print("form invalid", form.errors)
+    add_docs_to_db([(article, process_log)])
 
 
 ## PROCESSING
     
-def progress_update(task_id, total_docs, processed_docs, failed_docs, doc_category, current_doc, processing_step):
-    ''' Updates the progress of the task in the cache 
+def progress_update(task_id, total_docs, processed_docs, failed_docs, doc_category, current_doc, processing_step, queue_depths=None):
+    ''' Updates the progress of the task in the task state store shared by the processes (see newdocs/task_state.py)
     :task_id: string generated by process is launched. See template newdocs.pre_processing_block
     :total_docs: total number of documents to process
     :processed_docs: number of documents already processed
     :failed_docs: dictionary including a count and a list of documents that failed during the process
     :doc_category: "Arxiv", "Youtube" or "Others" for each for loop in the processing pipeline
     :current_doc: url of the document currently being processed
-    :processing_step: information about the current step of the pipeline'''
+    :processing_step: information about the current step of the pipeline
+    :queue_depths: number of documents waiting in front of each stage of the pipeline'''
 
     progress={"completed":processed_docs,
               "total":total_docs,
@@ -719,261 +934,459 @@ def progress_update(task_id, total_docs, processed_docs, failed_docs, doc_catego
               "progress":processed_docs/max(total_docs,1)*100, 
               "current_category":doc_category, 
               "current_doc":current_doc, 
-              "processing_step":processing_step}
+              "processing_step":processing_step,
+              "queues":queue_depths or {}}
     
-    cache.set(f"progress_task_{task_id}", progress)
+    set_state(progress_key(task_id), progress)
+
+    #wakes up the progress streams of this process (see newdocs.views.progress_events), which read the progress
+    #of the tasks processed here from memory rather than from the task state store
+    with progress_published:
+        if task_id in running_tasks:
+            local_progress[task_id]=progress
+        progress_published.notify_all()
+
+progress_published=Condition()
+running_tasks=Counter() # task id -> pipelines of this process processing it
+local_progress={} # task id -> latest progress published by this process, while it processes the task
+
+def task_running(task_id, running=True):
+    ''' Records that a pipeline of this process starts or stops processing a task '''
+
+    with progress_published:
+        running_tasks[task_id]+=1 if running else -1
+        if running_tasks[task_id]<=0:
+            del running_tasks[task_id]
+            local_progress.pop(task_id, None)
+        # the streams of a task no longer processed here go back to the task state store
+        progress_published.notify_all()
+
+class ProcessingProgress:
+    '''
+    Progress of a task shared by all the stages of the pipeline. 
+    Stages run in different threads so counters are protected by a lock
+    and changes are published to the task state store with progress_update, at most once per PROGRESS_MIN_INTERVAL seconds:
+    the updates made in between are coalesced and only the latest one is published, at the end of the interval
+    '''
+    def __init__(self, task_id, total_docs):
+        self.task_id = task_id
+        self.total_docs = total_docs
+        self.processed_docs = 0
+        self.failed_docs = {"count":0, "docs":[]}
+        self.queues = {}
+        self.lock = Lock()
+        self.pending = None # (category, doc, step) of the latest update not published yet
+        self.published_at = 0
+        self.timer = None
+
+    def queue_depths(self):
+        '''number of documents waiting in front of each stage'''
+        return {stage: (depth() if callable(depth) else depth.qsize()) for stage, depth in self.queues.items()}
+
+    def update(self, doc_category, current_doc, processing_step):
+        with self.lock:
+            self.pending = (doc_category, current_doc, processing_step)
+            wait = self.published_at+PROGRESS_MIN_INTERVAL-time.monotonic()
+            if wait>0:
+                if self.timer is None:
+                    self.timer = Timer(wait, self.publish_later)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+
+        self.publish()
+
+    def refresh(self):
+        ''' called before each publication, to read counters kept elsewhere (see task_queue.TaskProgress) '''
+        pass
+
+    def publish(self):
+        ''' publishes the latest update now '''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.pending is None:
+                return
+
+            self.refresh()
+            progress_update(self.task_id, self.total_docs, self.processed_docs, self.failed_docs, 
+                            *self.pending, self.queue_depths())
+            self.pending = None
+            self.published_at = time.monotonic()
+
+    def publish_later(self):
+        self.publish()
+        # refresh may have opened a DB connection in the thread of the timer
+        connection.close()
+
+    def fail(self, url, slug):
+        with self.lock:
+            self.failed_docs["count"]+=1
+            self.failed_docs["docs"].append([url,slug])
+
+    def done(self, job):
+        ''' called once the document of a job has been added to the DB '''
+        with self.lock:
+            self.processed_docs+=1
+
+    def finish(self):
+        self.update(None, None, "finished")
+        self.publish()
+
+## PIPELINE STAGES
+
+def mark_failed(job, progress, slug):
+    ''' Flags a document as failed. It will still be added to the DB so users can manually add the data '''
+
+    job["article"].slug=slug
+    job["process_log"]["success"]=False
+    progress.fail(job["url"], slug)
+
+def extract_doc(job, chars=25000):
+    ''' Parses the downloaded document in the parse pool, downloads its thumbnails and transcodes them in the pool.
+    Returns the plain data extracted by doc_parsing.parse_html or doc_parsing.parse_pdf 
+    :chars: max characters of text extracted '''
+
+    new_article=job["article"]
+
+    # in case of pdf
+    if hasattr(new_article, 'pdf'):
+        try:
+            page = run_parser(parse_pdf, new_article.pdf.name, chars)
 
-## MAIN
+        finally:
+            # deletes the temp file
+            new_article.pdf.close()
 
-def processing_start(docs, client, chat_format, model, task_id):
-    ''' Going through the list of URLs and extracting the data from each of them'''
-    print("Received", docs, client) 
-    total_docs=len(docs['youtube'])+len(docs['arxiv'])+len(docs['others'])
-    processed_docs = []
-    failed_docs={"count":0, "docs":[]}
+        new_article.thumbnail.extend(transcode_images(page["images"]))
+        return page
 
-    #logging progress in cache so that it can be displayed in the UI
-    progress_update(task_id, total_docs, len(processed_docs), failed_docs, None, None, "starting...")
+    # in case of any other format
+    page = run_parser(parse_html, new_article.html, job["category"], chars)
 
-    #Youtube URLs
-    for article in docs["youtube"]:
+    # thumbnail in header if any and, for other websites, the first image of the page as a potential thumbnail
+    image_urls = [page["og_image"]]
+    if job["category"]=="Others":
+        image_urls.append(page["first_image"])
 
-        #logging progress in cache so that it can be displayed in the UI
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Youtube", article, "scraping started")
-        new_article = get_soup(article) 
+    images=[]
+    for image_url in image_urls:
+        if image_url:
+            image_bytes=get_image(urljoin(job["url"], image_url), job.get("refresh", False))
+            if image_bytes:
+                images.append(image_bytes)
+
+    new_article.thumbnail.extend(transcode_images(images))
+
+    return page
+
+def parse_doc(job, progress, client=None, model=None, budget=CONTEXT_MAX_TOKENS):
+    ''' Parse stage : extracts what can be scraped from the downloaded document 
+    and prepares the prompt if the LLM is needed (job["llm"] is "short", "long" or None) 
+    :client: and :model: the tokenizer used to fit the document in the budget
+    :budget: max tokens of the document in the prompt, see context_builder.context_budget '''
+
+    article=job["url"]
+    new_article=job["article"]
+    job["llm"]=None
+
+    if hasattr(new_article, 'error'):
+        mark_failed(job, progress, url_to_slug(article))
+        return job
+
+    try:
+        page=extract_doc(job, max_chars(budget))
+
+    except:
+        new_article.overview = "Could not retrieve article (parsing error)"
+        new_article.summary = "Could not retrieve article (parsing error)"
+        mark_failed(job, progress, url_to_slug(article))
+        return job
+
+    if job["category"]=="Youtube":
+        youtube=page["youtube"]
+        new_article.authors=youtube.get("authors",[])  
+        new_article.title=youtube.get("title",None)
+        new_article.slug=slugify(new_article.title)
+        new_article.summary_type="Youtube video"
+        new_article.summary=youtube.get("abstract",None)
+        new_article.date_published=youtube.get("publication_date",None)
+        new_article.categories=youtube.get("categories",[])
+        return job
+    
+    if job["category"]=="Arxiv":
+        arxiv=page["arxiv"]
+        new_article.authors=arxiv.get("authors",[])  
+        new_article.title=arxiv.get("title",None)
+        new_article.summary_type="Arxiv abstract"
+        new_article.summary=arxiv.get("abstract_with_links",None)
+        new_article.date_published=arxiv.get("publication_date",None)
+        new_article.categories=arxiv.get("categories",[])
+
+        if new_article.summary is None or new_article.title is None or new_article.authors==[] or new_article.date_published is None or new_article.categories==[]:
+            # scraping failed, the page is processed entirely by the LLM like other documents (parse_html already returned its text)
+            job["category"]="Others"
 
-        # process logs (task_id, url, model, success, model_output.... ) are stored in DB for analysis and debugging purposes
-        process_log={"task_id":task_id,"url":article}
-        
-        if not hasattr(new_article, 'error'):
-            youtube=youtube_soup(new_article.soup)
-            new_article.authors=youtube.get("authors",[])  
-            new_article.title=youtube.get("title",None)
-            new_article.slug=slugify(new_article.title)
-            new_article.summary_type="Youtube video"
-            new_article.summary=youtube.get("abstract",None)
-            new_article.date_published=youtube.get("publication_date",None)
-            new_article.categories=youtube.get("categories",[])
-        
         else:
-            new_article.slug=url_to_slug(article)
-            failed_docs["count"]+=1
-            failed_docs["docs"].append([article,new_article.slug])
-            process_log["success"]=False
-        
-        #remove BeautifulSoup object and errors (and anything else we may have added to the object during the pipeline) to avoid JSON serialisation error
-        new_article=new_article.to_dict() 
+            # scraping successful, but some data is missing. We use the LLM to fill the gaps
+            job["prompt"]=f'''Please extract metadata from the article provided below and write a short summary: \n
+                            {new_article.title} \n 
+                            {new_article.summary}'''
+            job["llm"]="short"
+            return job
+
+    # other documents (and arxiv pages that could not be scraped), main content only, cut to the token budget of the model
+    context = pack_context(page["text"], budget, client, model)
+
+    # no body, or nothing left once the boilerplate is removed: there is nothing to send to the model
+    if context is None or not context.strip():
+        new_article.overview = "Could not retrieve article (bs4 error)"
+        new_article.summary = "Could not retrieve article (bs4 error)"
+        mark_failed(job, progress, url_to_slug(article))
+        return job
+    
+    new_article.summary_type="Description"
+    job["prompt"]=f"Please extract metadata from the article provided below and write two summaries: \n {context}"
+    job["llm"]="long"
+
+    return job
 
-        #adds the article and process log to DB
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Youtube", article, "adding to database")
-        add_to_db(new_article, process_log)
+def llm_doc(job, client, chat_format, model, progress, use_cache=True):
+    ''' LLM stage : sends the prompt prepared by parse_doc to the LLM, with one healing attempt if the JSON is invalid 
+    :use_cache: False to ask the model again even if the prompt was already answered '''
 
-        processed_docs.append(new_article)
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Youtube", article, "complete")
+    article=job["url"]
+    doc_category=job["category"]
+    new_article=job["article"]
+    process_log=job["process_log"]
 
-    #Arxiv URLs
-    for article in docs["arxiv"]:
+    # Arxiv pages only need the LLM to fill the gaps, other documents are entirely processed by the LLM
+    if job["llm"]=="short":
+        generate, check, extract = generate_short_llm, check_short_llm, short_extract_to_OutputTemplate
+    else:
+        generate, check, extract = generate_llm, check_llm, extract_to_OutputTemplate
 
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Arxiv", article, "scraping started")
-        new_article = get_soup(article)
+    progress.update(doc_category, article, "sent to LLM, awaiting response")
+    response = json.loads(generate(job["prompt"], client, chat_format, model, use_cache))
+    print(response)
 
-        # process logs (task_id, url, model, success, model_output.... ) are stored in DB for analysis and debugging purposes
-        process_log={"task_id":task_id,"url":article}
+    progress.update(doc_category, article, "LLM response received")
+    new_article.model_used=response.get("model",None)
+    process_log["turns"]=1
+    process_log=response_log(process_log, response)
+    
+    try:
+        new_article=extract(new_article, response)
+        # this throws an error if the JSON is invalid
+        cache_completion(response, client, model)
+    
+    except json.JSONDecodeError as e:
+        # json healing attempt
+        progress.update(doc_category, article, "LLM response was invalid, attempting healing, awaiting second response")
+        response = json.loads(check(response.get("content",{}), client, chat_format, model, use_cache))
+        print(response)
+        process_log["turns"]+=1
+        process_log=response_log(process_log, response)
         
-        if not hasattr(new_article, 'error'):
-            arxiv=arxiv_soup(new_article.soup)
-            new_article.authors=arxiv.get("authors",[])  
-            new_article.title=arxiv.get("title",None)
-            new_article.summary_type="Arxiv abstract"
-            new_article.summary=arxiv.get("abstract_with_links",None)
-            new_article.date_published=arxiv.get("publication_date",None)
-            new_article.categories=arxiv.get("categories",[])
-
-            progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Arxiv", article, "scraping complete")
-
-            if new_article.summary is None or new_article.title is None or new_article.authors==[] or new_article.date_published is None or new_article.categories==[]:
-                # scraping failed, append to others to be processed entirely by the LLM
-                docs["others"].append(article)
+        try:
+            new_article=extract(new_article, response)
+            # this throws an error if the JSON is invalid
+            cache_completion(response, client, model)
+            if not response.get("model - error"):
+                process_log["success"]=True
+        
+        except json.JSONDecodeError as err:
+            progress.update(doc_category, article, "second LLM response was invalid")
             
+            if job["llm"]=="short":
+                new_article.overview = f'''{new_article.model_used} could not generate a valid JSON despite GBNF grammar.'''
+                mark_failed(job, progress, slugify(new_article.title))
             else:
-                # scraping successful, but some data is missing. We use the LLM to fill the gaps
-                prompt=f'''Please extract metadata from the article provided below and write a short summary: \n
-                            {new_article.title} \n 
-                            {new_article.summary}'''
-                
-                progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Arxiv", article, "sent to LLM, awaiting response")
+                new_article.overview = "Model could not generate a valid JSON"
+                new_article.summary = f'''{new_article.model_used} could not generate a valid JSON despite GBNF grammar.'''
+                mark_failed(job, progress, url_to_slug(article))
 
-                response = json.loads(generate_short_llm(prompt, client, chat_format, model))
+    job["article"]=new_article
+    job["process_log"]=process_log
+    return job
 
-                progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Arxiv", article, "LLM response received")
-                print(response)
-                new_article.model_used=response.get("model",None)
-                process_log["turns"]=1
-                process_log=response_log(process_log, response)
-                
-                try:
-                    new_article=short_extract_to_OutputTemplate(new_article, response)
-                    # this throws an error if the JSON is invalid
-                
-                except json.JSONDecodeError as e:
-                    # json healing attempt
-                    progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Arxiv", article, "LLM response was invalid, attempting healing, awaiting second response")
-                    response = json.loads(check_short_llm(response.get("content",{}), client, chat_format, model))
-                    print(response)
-                    process_log["turns"]+=1
-                    process_log=response_log(process_log, response)
-                    
-                    try:
-                        new_article=short_extract_to_OutputTemplate(new_article, response)
-                        # this throws an error if the JSON is invalid
-                        
-                        if not response.get("model - error"):
-                            process_log["success"]=True
-                    
-                    except json.JSONDecodeError as err:
-                        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Arxiv", article, "second LLM response was invalid")
-                        new_article.slug=slugify(new_article.title)
-                        new_article.overview = f'''{new_article.model_used} could not generate a valid JSON despite GBNF grammar.'''
-                        failed_docs["count"]+=1
-                        failed_docs["docs"].append([article,new_article.slug])
-                        process_log["success"]=False
-        
-        else:
-            new_article.slug=url_to_slug(article)
-            failed_docs["count"]+=1
-            failed_docs["docs"].append([article,new_article.slug])
-            process_log["success"]=False
+def persist_docs(jobs, progress):
+    ''' Persistence stage : adds a batch of articles and process logs to DB in one transaction '''
+
+    progress.update(jobs[-1]["category"], jobs[-1]["url"], "adding to database")
+    #to_dict removes the pdf attribute and errors (and anything else we may have added to the object during the pipeline) to avoid JSON serialisation error
+    entries=[(job["article"].to_dict(), job["process_log"]) for job in jobs]
 
-        #remove BeautifulSoup object and errors (and anything else we may have added to the object during the pipeline) to avoid JSON serialisation error
-        new_article=new_article.to_dict()
+    #authors, categories and countries are matched to the existing names (no-op if EMBEDDING_CLIENT is not set)
+    new_terms=resolve_terms([article for article, _ in entries])
 
-        #adds the article and process log to DB
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Arxiv", article, "adding to database")
-        add_to_db(new_article, process_log)
+    #the writes of every pipeline of the process are queued on one writer thread (see backend/sqlite.py)
+    docs=run_write(add_docs_to_db, entries)
 
-        processed_docs.append(new_article)
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Arxiv", article, "complete")
+    # the batch is committed: nothing below may raise, run_persist_stage would write its documents (and logs) again
+    try:
+        #once committed, the documents are embedded for semantic search and the new names are indexed
+        index_docs(docs)
+        index_terms(new_terms)
 
-    #Other URLs
-    for article in docs["others"]:
+        for job in jobs:
+            progress.done(job)
+        progress.update(jobs[-1]["category"], jobs[-1]["url"], "complete")
 
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Others", article, "scraping started")
-        new_article = get_soup(article)
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Others", article, "scraping complete")
-        
-        # process logs (task_id, url, model, success, model_output.... ) are stored in DB for analysis and debugging purposes
-        process_log={"task_id":task_id,"url":article}
-        
-        if not hasattr(new_article, 'error'):
-                
-            # in case of pdf
-            if hasattr(new_article, 'pdf'):
+    except Exception as e:
+        traceback.print_exc()
+        print(f"{len(jobs)} document(s) saved but their progress could not be updated: {e}")
+
+def run_persist_stage(inbox, progress, batch_size=PERSIST_BATCH_SIZE):
+    ''' Consumes jobs until it receives STOP and writes them in batches: the jobs waiting in the inbox are written together,
+    up to batch_size, but the stage never waits to fill a batch. 
+    If the transaction of a batch fails (nothing of it is committed), its documents are written one by one
+    so that one bad document does not fail the others. Once a batch is committed, persist_docs does not raise '''
+
+    stop=False
+    while not stop:
+        jobs=[inbox.get()]
+        while len(jobs)<batch_size:
+            try:
+                jobs.append(inbox.get_nowait())
+            except Empty:
+                break
+
+        stop=any(job is STOP for job in jobs)
+        jobs=[job for job in jobs if job is not STOP]
+        if not jobs:
+            continue
 
-                text=new_article.pdf
+        try:
+            persist_docs(jobs, progress)
 
-                #max characters with a bit of headroom for 16k context (could be tight for 8k). 
-                #TODO: use tokenizer wih small vocab size to get a better approximation
+        except Exception:
+            traceback.print_exc()
+            for job in jobs:
                 try:
-                    context = text[:25000]
+                    persist_docs([job], progress)
                 
-                except:
-                    new_article.overview = "Could not retrieve article (parsing error)"
-                    new_article.summary = "Could not retrieve article (parsing error)"
-                    # add an attribute to the object to indicate that the request failed
-                    new_article.error = True
-                    new_article.slug=url_to_slug(article)
-                    failed_docs["count"]+=1
-                    failed_docs["docs"].append([article,new_article.slug])
-                    process_log["success"]=False
+                except Exception as e:
+                    traceback.print_exc()
+                    print(f"persist stage failed for {job['url']}: {e}")
+                    mark_failed(job, progress, url_to_slug(job["url"]))
 
-            # in case of  any other format 
-            elif hasattr(new_article, 'soup'):
+    # names added to the taxonomy indexes during the batch are written to disk
+    try:
+        save_indexes(force=True)
+    except OSError as e:
+        print("could not save the taxonomy indexes", e)
 
-                soup=new_article.soup
-                
-                # retreiving the url of first image on the page, if any
-                progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Others", article, "retrieving illustration")
-                try:
-                    first_image=soup.find("img")
-                    if first_image:
-                        new_r=requests.get(first_image.get("src"))
-                        if new_r.status_code==200:
-                            new_article.thumbnail.append(new_r.content)
-                
-                except:
-                    pass
-                
-                #max characters with a bit of headroom for 16k context (could be tight for 8k). 
-                #TODO: use tokenizer wih small vocab size to get a better approximation
-                try:
-                    context = soup.body.get_text()[:25000]
-                    # This throws an error if beautifulsoup fails to parse the page
-                
-                except:
-                    new_article.overview = "Could not retrieve article (bs4 error)"
-                    new_article.summary = "Could not retrieve article (bs4 error)"
-                    # add an attribute to the object to indicate that the request failed
-                    new_article.error = True
-                    new_article.slug=url_to_slug(article)
-                    failed_docs["count"]+=1
-                    failed_docs["docs"].append([article,new_article.slug])
-                    process_log["success"]=False
+    # each thread uses its own DB connection, which must be closed when the thread ends
+    connection.close()
+
+def run_stage(name, inbox, handler, progress):
+    ''' Consumes jobs from the inbox until it receives STOP. 
+    A job that raises is logged and flagged as failed so that one bad document never stalls the pipeline '''
+
+    while True:
+        job = inbox.get()
+        if job is STOP:
+            break
+
+        try:
+            handler(job)
+        
+        except Exception as e:
+            traceback.print_exc()
+            print(f"{name} stage failed for {job['url']}: {e}")
+            job["article"].overview = f"Could not process article ({name} error)"
+            mark_failed(job, progress, url_to_slug(job["url"]))
             
-            if not hasattr(new_article, 'error'):
-                new_article.summary_type="Description"
-                prompt=f"Please extract metadata from the article provided below and write two summaries: \n {context}"
-
-                progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Others", article, "sent to LLM, awaiting response")
-                response = json.loads(generate_llm(prompt, client, chat_format, model))
-                print(response)
-
-                progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Others", article, "LLM response received")
-                new_article.model_used=response.get("model",None)
-                process_log["turns"]=1
-                process_log=response_log(process_log, response)
-                
-                try:
-                    new_article=extract_to_OutputTemplate(new_article, response)
-                    # this throws an error if the JSON is invalid
-                
-                except json.JSONDecodeError as e:
-                    # json healing attempt
-                    progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Others", article, "LLM response was invalid, attempting healing, awaiting second response")
-                    response = json.loads(check_llm(response.get("content",{}), client, chat_format, model))
-                    print(response)
-                    process_log["turns"]+=1
-                    process_log=response_log(process_log, response)
-                    
-                    try:
-                        new_article=extract_to_OutputTemplate(new_article, response)
-                        # this throws an error if the JSON is invalid
-                        if not response.get("model - error"):
-                            process_log["success"]=True
-                    
-                    except json.JSONDecodeError as err:
-                        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Others", article, "second LLM response was invalid")
-                        new_article.slug=url_to_slug(article)
-                        new_article.overview = "Model could not generate a valid JSON"
-                        new_article.summary = f'''{new_article.model_used} could not generate a valid JSON despite GBNF grammar.'''
-                        failed_docs["count"]+=1
-                        failed_docs["docs"].append([article,new_article.slug])
-                        process_log["success"]=False
+            # the document is still added to the DB (unless the DB itself is failing)
+            progress.queues["persist"].put(job)
+
+    # each thread uses its own DB connection, which must be closed when the thread ends
+    connection.close()
+
+## MAIN
+
+STOP = object() # sentinel closing the queues of the pipeline
+
+def processing_start(docs, client, chat_format, model, task_id, progress=None, refresh_cache=False, bypass_llm_cache=False):
+    ''' Going through the list of URLs and extracting the data from each of them
+    Documents flow through a pipeline of stages connected by bounded queues, so all stages work at the same time: 
+    fetch (thread pool, see fetch_docs) -> parse (process pool, see run_parser) -> LLM (one thread per slot of the client, see llm_dispatch) -> persist (single DB writer, in batches) 
+    When a queue is full, the stage feeding it waits, so a slow LLM never lets downloaded pages pile up in memory
+    :progress: ProcessingProgress tracking the task, created for the docs received if None (see task_queue.TaskProgress)
+    :refresh_cache: downloads the documents again instead of using the HTTP cache
+    :bypass_llm_cache: asks the model again instead of reusing completions cached for the same prompt'''
+    
+    print("Received", docs, client) 
+    total_docs=len(docs['youtube'])+len(docs['arxiv'])+len(docs['others'])
+    if progress is None:
+        progress=ProcessingProgress(task_id, total_docs)
+
+    parse_queue=Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    llm_queue=Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    persist_queue=Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    to_fetch={"count":total_docs}
+    progress.queues={"fetch":lambda: to_fetch["count"], "parse":parse_queue, "llm":llm_queue, "persist":persist_queue}
+
+    #logging progress in cache so that it can be displayed in the UI
+    progress.update(None, None, "starting...")
+
+    # tokens of each document sent to the model
+    budget=context_budget(client, model, MAX_NEW_TOKENS)
+
+    def fetch():
+        # Youtube, Arxiv and other URLs
+        for doc_category, urls in [("Youtube", docs["youtube"]), ("Arxiv", docs["arxiv"]), ("Others", docs["others"])]:
+            if urls:
+                progress.update(doc_category, None, "scraping started")
+
+            for article, new_article in fetch_docs(urls, refresh=refresh_cache):
+                to_fetch["count"]-=1
+                progress.update(doc_category, article, "scraping complete")
+                # process logs (task_id, url, model, success, model_output.... ) are stored in DB for analysis and debugging purposes
+                parse_queue.put({"url":article, "category":doc_category, "article":new_article, "refresh":refresh_cache, "process_log":{"task_id":task_id,"url":article}})
+    
+    def parse(job):
+        job=parse_doc(job, progress, client, model, budget)
+        # the downloaded page is not needed anymore, only the prompt is passed to the next stages
+        for attribute in ("html", "pdf"):
+            if hasattr(job["article"], attribute):
+                delattr(job["article"], attribute)
         
+        if job["llm"]:
+            llm_queue.put(job)
         else:
-            new_article.slug=url_to_slug(article)
-            failed_docs["count"]+=1
-            failed_docs["docs"].append([article,new_article.slug])
-            process_log["success"]=False
+            persist_queue.put(job)
 
-        #remove BeautifulSoup object and pdf attribute and errors (and anything else we may have added to the object during the pipeline) to avoid JSON serialisation error
-        new_article=new_article.to_dict() 
-        
-        #adds the article and process log to DB
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Others", article, "adding to database")
-        add_to_db(new_article, process_log)
+    def llm(job):
+        persist_queue.put(llm_doc(job, client, chat_format, model, progress, use_cache=not bypass_llm_cache))
+
+    # one LLM thread per request the client accepts at the same time (llama.cpp slots, OpenAI concurrency)
+    llm_workers=get_dispatcher(client).max_in_flight
 
-        processed_docs.append(new_article)
-        progress_update(task_id, total_docs, len(processed_docs), failed_docs, "Others", article, "complete")
+    # one parse thread per process of the parse pool, each one waits for its document to be parsed
+    parse_workers=max(PARSE_MAX_WORKERS, 1)
 
+    stages=[([Thread(target=run_stage, args=("parse", parse_queue, parse, progress)) for _ in range(parse_workers)], parse_queue),
+            ([Thread(target=run_stage, args=("llm", llm_queue, llm, progress)) for _ in range(llm_workers)], llm_queue),
+            ([Thread(target=run_persist_stage, args=(persist_queue, progress))], persist_queue)]
 
-    progress_update(task_id, total_docs, len(processed_docs), failed_docs, None, None, "finished")
+    for threads, inbox in stages:
+        for thread in threads:
+            thread.start()
+
+    task_running(task_id)
+    try:
+        fetch()
+
+    finally:
+        # closing the stages in order, each one only stops once the previous one has handed over all its documents
+        for threads, inbox in stages:
+            for thread in threads:
+                inbox.put(STOP)
+            for thread in threads:
+                thread.join()
+        task_running(task_id, False)
+
+    progress.finish()
@@ -0,0 +1,148 @@
+import traceback
+from functools import lru_cache
+from threading import Lock
+
+import numpy as np
+import requests
+from openai import OpenAI
+from django.conf import settings
+
+from backend.models import LoggedDoc
+from backend.sqlite import run_write
+from newdocs.vector_store import VectorStore
+
+# Embeddings of the documents (title, overview and summary) for the semantic search of the home page.
+# They are computed by the OpenAI embeddings API or by the /embedding endpoint of the llama.cpp server
+# (start it with --embedding), kept in LoggedDoc.summary_embedding and in the vector store used for search.
+
+LLM_API_KEY=settings.LLM_API_KEY
+LLM_API_URL=settings.LLM_API_URL
+LLAMA_CPP_SERVER_URL=settings.LLAMA_CPP_SERVER_URL
+EMBEDDING_CLIENT=settings.EMBEDDING_CLIENT
+EMBEDDING_MODEL=settings.EMBEDDING_MODEL
+EMBEDDING_DIMENSIONS=settings.EMBEDDING_DIMENSIONS
+VECTOR_STORE_DIR=settings.VECTOR_STORE_DIR
+
+EMBEDDING_BATCH_SIZE=64 # texts per request to the OpenAI API
+EMBEDDING_MAX_CHARS=8000 # the start of the text is enough to place a document
+
+_openai_client = None
+_client_lock = Lock()
+_store = None
+
+
+def embeddings_enabled():
+    return EMBEDDING_CLIENT in ("openai", "llama_cpp_server")
+
+def get_vector_store():
+    ''' Vector store shared by the threads of the process '''
+
+    global _store
+
+    with _client_lock:
+        if _store is None:
+            _store = VectorStore(VECTOR_STORE_DIR)
+
+    return _store
+
+def doc_text(doc):
+    ''' Text of a document that is embedded '''
+    return "\n".join(part for part in [doc.title, doc.overview, doc.summary] if part)[:EMBEDDING_MAX_CHARS]
+
+## MODELS
+
+def _openai_embeddings(texts):
+    global _openai_client
+
+    with _client_lock:
+        if _openai_client is None:
+            _openai_client = OpenAI(base_url=f"{LLM_API_URL}", api_key=LLM_API_KEY)
+
+    # dimensions shortens the vectors of text-embedding-3 models, older models do not accept it
+    extra_body = {"dimensions": EMBEDDING_DIMENSIONS} if EMBEDDING_DIMENSIONS else None
+
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        response = _openai_client.embeddings.create(model=EMBEDDING_MODEL, input=texts[start:start+EMBEDDING_BATCH_SIZE], extra_body=extra_body)
+        vectors += [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    return vectors
+
+def _llama_cpp_embeddings(texts):
+    vectors = []
+    for text in texts:
+        response = requests.post(f"{LLAMA_CPP_SERVER_URL}/embedding", json={"content": text}, timeout=60)
+        response.raise_for_status()
+        embedding = response.json()
+        # depending on the version of the server: {"embedding": [...]} or [{"embedding": [...]}]
+        if isinstance(embedding, list):
+            embedding = embedding[0]
+        vectors.append(embedding["embedding"])
+
+    return vectors
+
+def embed_texts(texts):
+    ''' Embeddings of a list of texts, array (len(texts), dim)
+    Raises if embeddings are disabled or the model can't be reached '''
+
+    if EMBEDDING_CLIENT == "openai":
+        vectors = _openai_embeddings(texts)
+    elif EMBEDDING_CLIENT == "llama_cpp_server":
+        vectors = _llama_cpp_embeddings(texts)
+    else:
+        raise RuntimeError("embeddings are disabled, set EMBEDDING_CLIENT")
+
+    return np.asarray(vectors, dtype=np.float32)
+
+@lru_cache(maxsize=256)
+def embed_query(text):
+    ''' Embedding of a search, kept so that the next pages of the results do not call the model again '''
+    return embed_texts([text])[0]
+
+## INDEXING
+
+def index_docs(docs):
+    ''' Embeds saved documents, stores the vectors in summary_embedding and adds them to the vector store
+    Errors are printed and do not propagate: a document without embedding is only missing from semantic search
+    until the vector store is rebuilt (python manage.py rebuild_vector_store --embed-missing) '''
+
+    docs = [doc for doc in docs if doc.pk is not None]
+    if not docs or not embeddings_enabled():
+        return
+
+    try:
+        vectors = embed_texts([doc_text(doc) for doc in docs])
+
+        for doc, vector in zip(docs, vectors):
+            doc.summary_embedding = vector.tolist()
+        run_write(LoggedDoc.objects.bulk_update, docs, ["summary_embedding"])
+
+        get_vector_store().add([doc.pk for doc in docs], vectors)
+
+    except Exception as e:
+        traceback.print_exc()
+        print(f"could not index {len(docs)} document(s) for semantic search: {e}")
+
+def unindex_docs(doc_ids):
+    ''' Removes deleted documents from the vector store '''
+
+    if not embeddings_enabled():
+        return
+
+    try:
+        get_vector_store().remove(doc_ids)
+    except Exception as e:
+        print(f"could not remove {doc_ids} from the vector store: {e}")
+
+def semantic_ranking(text):
+    ''' Ranking of the documents by similarity to a search, for the home page (see VectorStore.ranked)
+    Returns None if the search can't be embedded '''
+
+    try:
+        vector = embed_query(text)
+    except Exception as e:
+        print(f"semantic search unavailable: {e}")
+        return None
+
+    store = get_vector_store()
+    return lambda after, chunk_size: store.ranked(vector, after, chunk_size)
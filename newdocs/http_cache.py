@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+from threading import Lock
+
+from django.conf import settings
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+# On-disk cache of HTTP responses used by the scraper (pages, PDFs and thumbnails).
+# Bodies are stored once per content hash under bodies/, and each URL has a small JSON entry under entries/
+# with the hash of its body and the validators (ETag, Last-Modified) used to revalidate it with a conditional GET.
+# When the bodies exceed HTTP_CACHE_MAX_BYTES, the least recently used ones are deleted.
+# Responses are streamed: bodies are written to disk as the caller reads them and served from disk, never buffered by the cache.
+
+HTTP_CACHE_DIR=settings.HTTP_CACHE_DIR
+HTTP_CACHE_MAX_BYTES=settings.HTTP_CACHE_MAX_BYTES
+
+_size_lock = Lock()
+_cache_size = None # total size of the bodies, computed once per process then kept up to date
+
+
+## STORAGE
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _entry_path(url):
+    return os.path.join(HTTP_CACHE_DIR, "entries", f"{_hash(url.encode())}.json")
+
+def _body_path(body_hash):
+    return os.path.join(HTTP_CACHE_DIR, "bodies", body_hash[:2], body_hash)
+
+def _write_atomic(path, data):
+    ''' Writes to a temp file then renames it, so that readers (other threads or processes) never see a partial file '''
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_path, path)
+
+def _iter_bodies():
+    for root, _, files in os.walk(os.path.join(HTTP_CACHE_DIR, "bodies")):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield path, stat
+
+def load_entry(url):
+    ''' Returns the cached entry of a url and the path of its body, or (None, None) if it is missing '''
+
+    try:
+        with open(_entry_path(url)) as entry_file:
+            entry = json.load(entry_file)
+
+        body_path = _body_path(entry["body_hash"])
+
+        # the modification time of the body is its last use, for LRU eviction
+        os.utime(body_path)
+        return entry, body_path
+
+    except (FileNotFoundError, ValueError, KeyError):
+        return None, None
+
+def store_entry(url, headers, tmp_path, body_hash, size):
+    ''' Moves a downloaded body to its content-addressed path (unless the same content is already stored) 
+    and writes the entry of the url with its validators '''
+
+    global _cache_size
+
+    body_path = _body_path(body_hash)
+    added = 0
+
+    if os.path.exists(body_path):
+        os.remove(tmp_path)
+        os.utime(body_path)
+    else:
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        os.replace(tmp_path, body_path)
+        added = size
+
+    entry = {"url": url,
+             "body_hash": body_hash,
+             "etag": headers.get("ETag"),
+             "last_modified": headers.get("Last-Modified"),
+             "content_type": headers.get("Content-Type")}
+    _write_atomic(_entry_path(url), json.dumps(entry).encode())
+
+    with _size_lock:
+        if _cache_size is None:
+            _cache_size = sum(stat.st_size for _, stat in _iter_bodies())
+        else:
+            _cache_size += added
+
+        if _cache_size > HTTP_CACHE_MAX_BYTES:
+            _cache_size = evict(HTTP_CACHE_MAX_BYTES)
+
+class CachingReader:
+    '''
+    Wraps the raw stream of a response and copies what the caller reads to a temp file of the cache,
+    so that large bodies (e.g. PDFs) are never held in memory by the cache.
+    Once the stream has been read to the end, the body is stored under its hash. 
+    An incomplete read (e.g. a PDF above the size cap) is discarded.
+    '''
+    def __init__(self, raw, url, headers):
+        self.raw = raw
+        self.url = url
+        self.headers = headers
+        tmp_dir = os.path.join(HTTP_CACHE_DIR, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        self.tmp_file = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.finished = False
+
+    def read(self, amt=None):
+        data = self.raw.read(amt, decode_content=True)
+
+        if data:
+            self.tmp_file.write(data)
+            self.sha.update(data)
+            self.size += len(data)
+        elif not self.finished:
+            self.finish()
+
+        return data
+
+    def finish(self):
+        self.finished = True
+        self.tmp_file.close()
+
+        try:
+            store_entry(self.url, self.headers, self.tmp_file.name, self.sha.hexdigest(), self.size)
+        except OSError as e:
+            print("http cache could not store", self.url, e)
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self.tmp_file.close()
+            os.remove(self.tmp_file.name)
+        self.raw.close()
+
+    def release_conn(self):
+        self.raw.release_conn()
+
+def evict(max_bytes):
+    ''' Deletes the least recently used bodies until the cache fits in max_bytes (a bit less to avoid evicting at every write)
+    Entries pointing to a deleted body are treated as misses by load_entry. Returns the new size '''
+
+    # temp files left by interrupted downloads
+    for root, _, files in os.walk(os.path.join(HTTP_CACHE_DIR, "tmp")):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if time.time()-os.stat(path).st_mtime > 24*3600:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    bodies = sorted(_iter_bodies(), key=lambda body: body[1].st_mtime)
+    size = sum(stat.st_size for _, stat in bodies)
+    target = max_bytes*0.9
+
+    for path, stat in bodies:
+        if size <= target:
+            break
+        try:
+            os.remove(path)
+            size -= stat.st_size
+        except FileNotFoundError:
+            pass
+
+    return size
+
+## REQUESTS
+
+def cached_response(url, entry, body_path):
+    ''' Rebuilds a requests Response streaming its body from the cache, so that callers can't tell the difference '''
+
+    response = Response()
+    response.url = url
+    response.status_code = 200
+    response.raw = open(body_path, "rb")
+    response.headers = CaseInsensitiveDict({"Content-Type": entry.get("content_type") or ""})
+    response.from_cache = True
+    return response
+
+def cached_get(session, url, timeout=None, refresh=False):
+    ''' Streamed GET through the cache. A cached url is revalidated with a conditional GET (If-None-Match / If-Modified-Since)
+    and its body is streamed from disk if the server answers 304 Not Modified. 
+    The body is only downloaded when the caller reads it (r.content or r.iter_content) 
+    :refresh: ignores the cached body and downloads the url again (the new response is still stored) '''
+
+    entry, body_path = (None, None) if refresh else load_entry(url)
+
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = session.get(url, headers=headers, timeout=timeout, stream=True)
+
+    if response.status_code == 304 and entry:
+        response.close()
+        try:
+            return cached_response(url, entry, body_path)
+        except FileNotFoundError:
+            # evicted in the meantime
+            return cached_get(session, url, timeout, refresh=True)
+
+    # only responses that can be revalidated later are stored
+    cacheable = response.status_code == 200 and (response.headers.get("ETag") or response.headers.get("Last-Modified"))
+    if cacheable and "no-store" not in response.headers.get("Cache-Control", ""):
+        try:
+            response.raw = CachingReader(response.raw, url, response.headers)
+        except OSError as e:
+            print("http cache unavailable", e)
+
+    return response
@@ -0,0 +1,89 @@
+import hashlib
+import io
+
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+# Transcoding of the thumbnails (Pillow). Like doc_parsing, these functions run in the processes of the parse pool
+# (see doc_processing.run_parser): they only take and return plain data (bytes, dicts) and must not import Django.
+
+# extension of the original file given the format detected by Pillow
+EXTENSIONS={"JPEG":"jpg", "MPO":"jpg", "PNG":"png", "GIF":"gif", "WEBP":"webp", "BMP":"bmp", "TIFF":"tif", "ICO":"ico", "JPEG2000":"jp2"}
+
+WEBP_AVAILABLE=features.check("webp")
+
+ORIENTATION_TAG=0x0112 # EXIF orientation, 5 to 8 are rotated by 90 degrees
+
+
+def process_images(images, sizes, quality=80):
+    ''' Transcodes a list of downloaded images, see process_image. The images that can't be decoded are dropped '''
+
+    processed=[process_image(image_bytes, sizes, quality) for image_bytes in images]
+    return [image for image in processed if image]
+
+def process_image(image_bytes, sizes, quality=80):
+    '''
+    Detects the format of an image and resizes it to each size, encoded in WebP and JPEG
+    Returns None if the bytes are not an image Pillow can decode (e.g. an error page, an SVG), otherwise
+    {"sha256": hash of the original bytes, "format", "extension", "width", "height", "content": the original bytes,
+     "variants": {size name: {"width", "height", "webp": bytes, "jpeg": bytes}}}
+    :sizes: {size name: (max width, max height)}, images are never enlarged
+    :quality: of the WebP and JPEG variants (1-100)
+    '''
+
+    try:
+        image=Image.open(io.BytesIO(image_bytes))
+        image_format=image.format
+        width, height=image.size
+        if image.getexif().get(ORIENTATION_TAG) in (5, 6, 7, 8):
+            width, height=height, width
+
+        # JPEGs are decoded directly at a reduced scale, still above the largest size
+        if image_format=="JPEG" and sizes:
+            image.draft("RGB", max(sizes.values(), key=lambda box: box[0]*box[1]))
+
+        image=ImageOps.exif_transpose(image)
+        image=image.convert("RGBA" if has_alpha(image) else "RGB")
+
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError, SyntaxError):
+        return None
+
+    variants={}
+    previous=None
+    # largest size first, each smaller size is resized from the previous one
+    for name, box in sorted(sizes.items(), key=lambda item: item[1][0]*item[1][1], reverse=True):
+        image.thumbnail(box, Image.LANCZOS, reducing_gap=3.0)
+
+        if previous and previous["width"]==image.width and previous["height"]==image.height:
+            # smaller than both boxes, the same files serve both sizes
+            variants[name]=previous
+            continue
+
+        variants[name]=previous={"width":image.width, "height":image.height, "jpeg":encode_jpeg(image, quality)}
+        if WEBP_AVAILABLE:
+            previous["webp"]=encode(image, "WEBP", quality=quality, method=4)
+
+    return {"sha256":hashlib.sha256(image_bytes).hexdigest(),
+            "format":image_format.lower(),
+            "extension":EXTENSIONS.get(image_format, image_format.lower()),
+            "width":width,
+            "height":height,
+            "content":image_bytes,
+            "variants":variants}
+
+def has_alpha(image):
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode=="P" and "transparency" in image.info)
+
+def encode(image, image_format, **options):
+    buffer=io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+def encode_jpeg(image, quality):
+    ''' JPEG has no transparency, transparent areas are shown on white '''
+
+    if image.mode=="RGBA":
+        background=Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image=background
+
+    return encode(image, "JPEG", quality=quality, optimize=True, progressive=True)
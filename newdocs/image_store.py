@@ -0,0 +1,118 @@
+from django.db import connection, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from backend.models import DocImage, StoredImage
+from newdocs.thumbnails import write_image, delete_image_files, move_staged, delete_staged
+
+# Content-addressed storage of the images of the documents. An image is written once, under the SHA-256 of its
+# original bytes (images/<2 first hex digits>/<hash>.<extension>, its variants next to it, see newdocs/thumbnails.py),
+# and StoredImage is the index from the hash to the files: the documents of a site showing the same logo or og:image
+# all reference one entry through DocImage.stored, and an image already stored is not written again.
+# StoredImage.ref_count is maintained by triggers on backend_docimage on SQLite (migration 0014) and counted again
+# before each collection on other databases. release_unreferenced deletes the entries no document references any more.
+# store_doc_images looks the images up and creates the DocImage referencing them in one transaction: a collection
+# of another thread or process can't delete an image in between (with BEGIN IMMEDIATE the write lock is held from
+# the lookup, otherwise the insert fails instead of referencing a deleted image, see backend/sqlite_backend).
+# The files of new images are written under a temporary name and only moved into place once the transaction
+# storing them is committed: a rollback leaves no file in the store.
+
+def store_path(sha256):
+    ''' file name of an image in MEDIA_ROOT/images, without extension '''
+    return f"{sha256[:2]}/{sha256}"
+
+def stored_fields(stored):
+    ''' fields of a DocImage showing a stored image '''
+
+    return {"stored":stored,
+            "image_url":stored.image_url,
+            "format":stored.format,
+            "width":stored.width,
+            "height":stored.height,
+            "variants":stored.variants}
+
+def store_images(images):
+    '''
+    Adds transcoded images (see image_processing.process_image) to the store, only writing the files of the new ones
+    The files are moved into place when the transaction is committed, right away outside of a transaction
+    Returns {sha256: StoredImage}
+    '''
+
+    hashes={image["sha256"] for image in images}
+    stored=StoredImage.objects.in_bulk(hashes, field_name="sha256") if hashes else {}
+
+    new_images={}
+    staged=[]
+    for image in images:
+        if image["sha256"] not in stored and image["sha256"] not in new_images:
+            fields=write_image(store_path(image["sha256"]), image, staged)
+            new_images[image["sha256"]]=StoredImage(sha256=image["sha256"], size=len(image["content"]), **fields)
+
+    if new_images:
+        # another process may have stored the same image in the meantime, its entry is used
+        # and its files are replaced by the same bytes
+        StoredImage.objects.bulk_create(new_images.values(), ignore_conflicts=True)
+        stored.update(StoredImage.objects.in_bulk(list(new_images), field_name="sha256"))
+        transaction.on_commit(lambda: move_staged(staged))
+
+    return stored
+
+def store_doc_images(doc_images):
+    '''
+    Stores transcoded images and links them to their documents, a document showing an image once
+    Returns the DocImage of each pair, in the same order, in a transaction of its own outside of one
+    :doc_images: list of (LoggedDoc, transcoded image)
+    '''
+
+    # an unreferenced image found here is not collected before it is referenced, see above
+    with transaction.atomic():
+        stored=store_images([image for _, image in doc_images])
+
+        existing={(image.doc_id, image.stored_id): image for image in
+                  DocImage.objects.filter(doc_id__in={doc.pk for doc, _ in doc_images}, stored__in=list(stored.values()))}
+
+        new_images=[]
+        linked=[]
+        for doc, image in doc_images:
+            entry=stored[image["sha256"]]
+            doc_image=existing.get((doc.pk, entry.pk))
+            if doc_image is None:
+                doc_image=existing[(doc.pk, entry.pk)]=DocImage(doc=doc, **stored_fields(entry))
+                new_images.append(doc_image)
+            linked.append(doc_image)
+
+        DocImage.objects.bulk_create(new_images)
+
+    return linked
+
+def count_references():
+    ''' Counts the references of every stored image again, where no trigger maintains them '''
+
+    references=DocImage.objects.filter(stored=OuterRef("pk")).order_by().values("stored").annotate(n=Count("id")).values("n")
+    StoredImage.objects.update(ref_count=Coalesce(Subquery(references), 0))
+
+def release_unreferenced():
+    '''
+    Deletes the stored images that no document references any more and their files
+    The files are deleted before the deletion of the entries is committed: the write lock taken by the transaction
+    keeps another process from storing the same image again until then.
+    The files staged by rolled back transactions (see store_images) are deleted too
+    Returns the number of images deleted
+    '''
+
+    delete_staged()
+
+    with transaction.atomic():
+        if connection.vendor!="sqlite":
+            count_references()
+
+        # the join guards against a count gone wrong, a file still shown is never deleted
+        unreferenced=list(StoredImage.objects.filter(ref_count__lte=0, docimage__isnull=True))
+        if not unreferenced:
+            return 0
+
+        StoredImage.objects.filter(id__in=[image.pk for image in unreferenced]).delete()
+        for image in unreferenced:
+            delete_image_files(image)
+
+    return len(unreferenced)
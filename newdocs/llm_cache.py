@@ -0,0 +1,81 @@
+import json
+import time
+import hashlib
+from datetime import timedelta
+from threading import Lock
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import F
+from django.utils import timezone
+
+from backend.models import CompletionCache
+
+LLM_CACHE_ENABLED=settings.LLM_CACHE_ENABLED
+LLM_CACHE_TTL=timedelta(days=settings.LLM_CACHE_TTL_DAYS)
+LLM_CACHE_MAX_ENTRIES=settings.LLM_CACHE_MAX_ENTRIES
+EVICTION_INTERVAL=60 # seconds between two evictions by a process
+
+# Persistent cache of LLM completions. The same prompt sent with the same grammar to the same model
+# (e.g. when a document is reprocessed or a batch is rerun after a parser fix) is answered from the DB.
+# Only completions whose JSON was parsed by the pipeline are stored (see doc_processing.cache_completion), errors never are.
+# The cache is best-effort: a DB error is treated as a miss.
+
+_last_eviction=0
+_eviction_lock=Lock()
+
+
+def completion_key(client, model, chat_format, grammar, prompt):
+    ''' Hash of everything that determines the completion '''
+
+    payload = json.dumps([client, model, chat_format, grammar, prompt], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def get_completion(key):
+    ''' Returns the cached completion or None if it is missing or expired '''
+
+    if not LLM_CACHE_ENABLED:
+        return None
+
+    try:
+        entry = CompletionCache.objects.filter(key=key, created_at__gte=timezone.now()-LLM_CACHE_TTL).first()
+        if entry is None:
+            return None
+
+        CompletionCache.objects.filter(pk=entry.pk).update(last_used_at=timezone.now(), hits=F('hits')+1)
+        return entry.completion
+
+    except DatabaseError as e:
+        print("LLM cache unavailable", e)
+        return None
+
+def store_completion(key, client, model, completion):
+    ''' Stores a valid completion, then drops expired entries and the least recently used ones above LLM_CACHE_MAX_ENTRIES (see evict) '''
+
+    if not LLM_CACHE_ENABLED or completion.get("model - error"):
+        return
+
+    try:
+        CompletionCache.objects.update_or_create(key=key, defaults={"client":client, "model":model, "completion":completion,
+                                                                    "created_at":timezone.now(), "last_used_at":timezone.now()})
+        evict()
+
+    except DatabaseError as e:
+        print("LLM cache unavailable", e)
+
+def evict(force=False):
+    ''' Drops the expired entries and the overflow, at most once per EVICTION_INTERVAL per process unless forced '''
+
+    global _last_eviction
+
+    with _eviction_lock:
+        if not force and time.monotonic()-_last_eviction<EVICTION_INTERVAL:
+            return
+        _last_eviction=time.monotonic()
+
+    CompletionCache.objects.filter(created_at__lt=timezone.now()-LLM_CACHE_TTL).delete()
+
+    overflow = CompletionCache.objects.count()-LLM_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        oldest = CompletionCache.objects.order_by('last_used_at').values_list('pk', flat=True)[:overflow]
+        CompletionCache.objects.filter(pk__in=list(oldest)).delete()
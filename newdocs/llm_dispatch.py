@@ -0,0 +1,95 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+
+from django.conf import settings
+
+
+class RateLimiter:
+    '''
+    Sliding-window limiter for requests per minute and tokens per minute.
+    A limit set to 0 is ignored. A single request larger than the token limit
+    is let through once the window is empty, otherwise it would wait forever
+    '''
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, window=60):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self.events = deque() # (timestamp, tokens) of the requests sent during the window
+        self.tokens_in_window = 0
+        self.lock = Lock()
+
+    def _expire(self, now):
+        while self.events and now - self.events[0][0] >= self.window:
+            self.tokens_in_window -= self.events.popleft()[1]
+
+    def acquire(self, tokens=0):
+        ''' Blocks until a request of `tokens` tokens fits in the limits, then records it '''
+
+        if not self.requests_per_minute and not self.tokens_per_minute:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._expire(now)
+
+                requests_ok = not self.requests_per_minute or len(self.events) < self.requests_per_minute
+                tokens_ok = not self.tokens_per_minute or not self.events or self.tokens_in_window + tokens <= self.tokens_per_minute
+
+                if requests_ok and tokens_ok:
+                    self.events.append((now, tokens))
+                    self.tokens_in_window += tokens
+                    return
+
+                # wait until the oldest request leaves the window
+                wait = self.window - (now - self.events[0][0])
+
+            time.sleep(min(max(wait, 0.01), 1))
+
+
+class LLMDispatcher:
+    '''
+    Gate in front of one LLM client. At most max_in_flight completions run at the same time
+    (e.g. the number of slots of the llama.cpp server) and the optional rate limiter
+    keeps the client below its requests/tokens per minute limits
+    '''
+    def __init__(self, max_in_flight=1, requests_per_minute=0, tokens_per_minute=0):
+        self.max_in_flight = max(max_in_flight, 1)
+        self.semaphore = BoundedSemaphore(self.max_in_flight)
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+    @contextmanager
+    def slot(self, tokens=0):
+        ''' Waits for a free slot and for the rate limiter before running the completion '''
+
+        with self.semaphore:
+            self.limiter.acquire(tokens)
+            yield
+
+
+_dispatchers = {}
+_dispatchers_lock = Lock()
+
+def get_dispatcher(client):
+    ''' Returns the dispatcher shared by all the threads calling a client, as configured in settings.LLM_CLIENTS
+    :client: "openai" or "llama_cpp_server" '''
+
+    with _dispatchers_lock:
+        if client not in _dispatchers:
+            params = settings.LLM_CLIENTS.get(client, {})
+            _dispatchers[client] = LLMDispatcher(params.get("max_in_flight", 1),
+                                                 params.get("requests_per_minute", 0),
+                                                 params.get("tokens_per_minute", 0))
+
+    return _dispatchers[client]
+
+def estimate_tokens(prompt, max_tokens=0):
+    ''' Rough token count of a prompt (4 characters per token) plus the completion budget,
+    which is what OpenAI counts against the tokens per minute limit '''
+
+    if isinstance(prompt, list):
+        prompt = " ".join(message["content"] for message in prompt)
+
+    return len(prompt)//4 + max_tokens
@@ -0,0 +1,81 @@
+import os
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+
+from newdocs.doc_parsing import FAST_PARSER, full_parse, fast_parse
+from newdocs.parsing_fixtures import fixture_pages
+
+
+class Command(BaseCommand):
+    help = '''Compares the parse time and peak memory of the full parse and of the fast path (partial tree)
+    of Arxiv and Youtube pages. Without paths, representative pages are generated (see newdocs/parsing_fixtures.py).
+    To measure real pages, save a few with your browser or curl and pass their paths, e.g.
+    python manage.py benchmark_parsing --category Arxiv fixtures/arxiv/*.html'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('pages', nargs='*', help='saved HTML pages, or directories of pages (default: generated pages)')
+        parser.add_argument('--count', type=int, default=3, help='pages generated when no path is given')
+        parser.add_argument('--category', choices=['Arxiv', 'Youtube'], default='Arxiv')
+        parser.add_argument('--repeat', type=int, default=10, help='parses of each page, the best time is kept')
+
+    def measure(self, parser, html, category, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parser(html, category)
+            elapsed = time.perf_counter()-start
+            best = elapsed if best is None else min(best, elapsed)
+
+        tracemalloc.start()
+        result = parser(html, category)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return result, best, peak
+
+    def saved_pages(self, paths):
+        ''' [(name, html bytes)] of the pages given on the command line '''
+
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(('.html', '.htm')))
+            elif os.path.isfile(path):
+                files.append(path)
+            else:
+                raise CommandError(f"{path} not found")
+
+        pages = []
+        for path in files:
+            with open(path, 'rb') as page_file:
+                pages.append((os.path.basename(path), page_file.read()))
+
+        return pages
+
+    def handle(self, *args, **options):
+        category = options['category']
+        if options['pages']:
+            pages = self.saved_pages(options['pages'])
+        else:
+            pages = fixture_pages(category, options['count'])
+
+        self.stdout.write(f"fast path parser: {FAST_PARSER}")
+        self.stdout.write(f"{'page':<40}{'size KB':>9}{'full ms':>10}{'fast ms':>10}{'full peak KB':>14}{'fast peak KB':>14}  fast path")
+
+        for name, html in pages:
+            full, full_time, full_peak = self.measure(full_parse, html, category, options['repeat'])
+            fast, fast_time, fast_peak = self.measure(fast_parse, html, category, options['repeat'])
+
+            # the fast path must extract the same data, otherwise parse_html falls back to the full parse
+            key = category.lower()
+            if fast is None:
+                outcome = "missed (falls back)"
+            elif fast[key] == full[key] and fast["og_image"] == full["og_image"]:
+                outcome = "same output"
+            else:
+                outcome = "DIFFERENT output"
+
+            self.stdout.write(f"{name[:39]:<40}{len(html)/1024:>9.0f}{full_time*1000:>10.1f}{fast_time*1000:>10.1f}"
+                              f"{full_peak/1024:>14.0f}{fast_peak/1024:>14.0f}  {outcome}")
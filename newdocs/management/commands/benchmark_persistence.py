@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from backend.models import LoggedDoc, Author, Category, Country, DocAuthor, DocCategory, DocCountry, ProcessingLog
+from newdocs.doc_processing import add_docs_to_db, allocate_slug, prepare_doc
+
+
+class Command(BaseCommand):
+    help = '''Inserts synthetic documents (3 authors, 2 categories, 1 country each, no thumbnail) in a throwaway SQLite database
+    and compares the row-by-row autocommit writes used before (one get_or_create per related row) with add_docs_to_db in batches.
+    The database of the app is not touched'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--docs', type=int, default=10000)
+        parser.add_argument('--batch', type=int, default=100, help='documents per transaction')
+        parser.add_argument('--skip-row-by-row', action='store_true', help='only run the batched path (the row-by-row one is slow)')
+
+    def synthetic_entries(self, prefix, count):
+        for index in range(count):
+            article = {"url": f"https://example.com/{prefix}/{index}", "slug": f"{prefix}-document-{index}", "title": f"Document {index}",
+                       "overview": "Short summary", "summary": "Long summary "*20, "summary_type": "Description",
+                       "date_published": "2024/01/01", "model_used": "benchmark",
+                       "authors": [f"Author {index%500}", f"Author {index%77}", "Jane Doe"],
+                       "categories": [f"Category {index%40}", "benchmark"], "countries": ["France"], "thumbnail": []}
+            process_log = {"task_id": "benchmark", "url": article["url"], "llm_output": "{}", "turns": 1}
+            yield article, process_log
+
+    def row_by_row(self, article, process_log):
+        # the writes of add_to_db before batching, each one in its own transaction
+        ProcessingLog.objects.create(task_id=process_log["task_id"], source_url=process_log["url"], success=True,
+                                     llm=article["model_used"], llm_output=process_log["llm_output"], llm_turns=process_log["turns"])
+        doc = prepare_doc(article, LoggedDoc.objects.filter(source_url=article["url"]).first(), allocate_slug(article["slug"]))
+        doc.save()
+        for author in article["authors"]:
+            DocAuthor.objects.get_or_create(doc=doc, author=Author.objects.get_or_create(name=author)[0])
+        for category in article["categories"]:
+            DocCategory.objects.get_or_create(doc=doc, category=Category.objects.get_or_create(category_name=category)[0])
+        for country in article["countries"]:
+            DocCountry.objects.get_or_create(doc=doc, country=Country.objects.get_or_create(country_name=country)[0])
+
+    def run(self, label, docs, write):
+        queries = [0]
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            start = time.perf_counter()
+            write()
+            elapsed = time.perf_counter()-start
+
+        self.stdout.write(f"{label:<28}{docs:>8}{elapsed:>10.2f}{docs/elapsed:>12.0f}{queries[0]:>10}")
+
+    def handle(self, *args, **options):
+        docs = options['docs']
+        batch = options['batch']
+
+        # a file database (not the in-memory test database) so that the cost of each commit is measured
+        db_dir = tempfile.mkdtemp()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(db_dir, 'benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        try:
+            self.stdout.write(f"{'path':<28}{'docs':>8}{'seconds':>10}{'docs/s':>12}{'queries':>10}")
+
+            if not options['skip_row_by_row']:
+                self.run("row by row (autocommit)", docs,
+                         lambda: [self.row_by_row(*entry) for entry in self.synthetic_entries("row", docs)])
+
+            def batched():
+                entries = list(self.synthetic_entries("batch", docs))
+                for index in range(0, docs, batch):
+                    add_docs_to_db(entries[index:index+batch])
+
+            self.run(f"add_docs_to_db, batch {batch}", docs, batched)
+            self.run("add_docs_to_db, batch 1", min(docs, 1000),
+                     lambda: [add_docs_to_db([entry]) for entry in self.synthetic_entries("single", min(docs, 1000))])
+
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(db_dir, ignore_errors=True)
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from newdocs.ann_index import IVFIndex
+
+
+class Command(BaseCommand):
+    help = '''Measures the approximate nearest-neighbour index used for taxonomy matching on synthetic names:
+    clustered random vectors, as names embedded close to each other ("Machine Learning", "machine-learning").
+    Reports the build time, the recall@1 against an exact scan and the latency per term for several nprobe values'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=50000, help='names in the index')
+        parser.add_argument('--dim', type=int, default=512)
+        parser.add_argument('--queries', type=int, default=1000)
+        parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16])
+
+    def handle(self, *args, **options):
+        size, dim = options['size'], options['dim']
+        rng = np.random.default_rng(0)
+
+        centers = rng.standard_normal((max(1, size//25), dim)).astype(np.float32)
+        vectors = centers[rng.integers(0, len(centers), size)] + 0.5*rng.standard_normal((size, dim)).astype(np.float32)
+        # queries are slight variations of names of the index
+        queries = vectors[rng.integers(0, size, options['queries'])] + 0.2*rng.standard_normal((options['queries'], dim)).astype(np.float32)
+
+        # names are added in batches, as ingestion does
+        index = IVFIndex()
+        start = time.perf_counter()
+        for batch in range(0, size, 500):
+            index.add([f"name {row}" for row in range(batch, min(batch+500, size))], vectors[batch:batch+500])
+        lists = len(index.centroids) if index.centroids is not None else 0
+        self.stdout.write(f"{size} names of size {dim}, {lists} lists, built in {time.perf_counter()-start:.2f}s")
+
+        exact = [matches[0][0] for matches in index.search(queries, k=1, exact=True)]
+        start = time.perf_counter()
+        for query in queries[:200]:
+            index.search(query, k=1, exact=True)
+        exact_latency = (time.perf_counter()-start)/min(200, len(queries))
+
+        self.stdout.write(f"{'nprobe':>8}{'recall@1':>10}{'per term':>12}{'exact scan':>12}")
+        for nprobe in options['nprobe']:
+            index.nprobe = nprobe
+            start = time.perf_counter()
+            approx = [index.search(query, k=1)[0][0][0] for query in queries]
+            latency = (time.perf_counter()-start)/len(queries)
+            recall = np.mean([a == b for a, b in zip(approx, exact)])
+            self.stdout.write(f"{nprobe:>8}{recall:>10.3f}{latency*1e6:>10.0f}us{exact_latency*1e6:>10.0f}us")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "index.npz")
+            index.save(path)
+            start = time.perf_counter()
+            IVFIndex.load(path)
+            self.stdout.write(f"saved in {os.path.getsize(path)/2**20:.0f}MB, loaded in {time.perf_counter()-start:.2f}s")
@@ -0,0 +1,61 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from backend.doc_cache import bump_versions
+from backend.models import DocImage, StoredImage
+from newdocs.doc_processing import PARSE_MAX_WORKERS, transcode_images
+from newdocs.image_store import store_path
+from newdocs.thumbnails import MEDIA_ROOT, write_variants
+
+
+class Command(BaseCommand):
+    help = '''Transcodes the stored images again (see newdocs/image_store.py) and rewrites their resized variants,
+    after changing THUMBNAIL_SMALL_WIDTH, THUMBNAIL_LARGE_WIDTH or THUMBNAIL_QUALITY. The originals are kept.
+    The images saved before the image store are moved to it by `python manage.py migrate_images`'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=100, help='images read from the database at once')
+
+    def transcode(self, image):
+        path = os.path.join(MEDIA_ROOT, image.image_url)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, 'rb') as image_file:
+            transcoded = transcode_images([image_file.read()])
+
+        return transcoded[0] if transcoded else None
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        done = failed = 0
+        last_id = 0
+
+        # one thread per process of the parse pool, each waiting for the transcoding of one image
+        with ThreadPoolExecutor(max_workers=max(PARSE_MAX_WORKERS, 1)) as executor:
+            while True:
+                chunk = list(StoredImage.objects.filter(id__gt=last_id).order_by("id")[:options['chunk']])
+                if not chunk:
+                    break
+                last_id = chunk[-1].id
+
+                updated = []
+                for image, transcoded in zip(chunk, executor.map(self.transcode, chunk)):
+                    if transcoded is None:
+                        failed += 1
+                        continue
+
+                    image.variants = write_variants(store_path(image.sha256), transcoded)
+                    updated.append(image)
+
+                StoredImage.objects.bulk_update(updated, ["variants"])
+                # the documents showing these images keep a copy of the variants
+                for image in updated:
+                    DocImage.objects.filter(stored=image).update(variants=image.variants)
+                bump_versions(DocImage.objects.filter(stored__in=updated).values("doc_id"))
+                done += len(updated)
+
+        self.stdout.write(f"{done} images transcoded ({failed} files missing or unreadable) in {time.perf_counter()-start:.1f}s")
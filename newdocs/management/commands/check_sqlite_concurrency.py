@@ -0,0 +1,150 @@
+import os
+import random
+import tempfile
+import time
+from threading import Thread, Event, Lock
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction, OperationalError
+from django.test import Client
+
+import backend.sqlite
+from backend.models import LoggedDoc
+from backend.sqlite import run_write
+from newdocs.doc_processing import add_docs_to_db
+from newdocs.management.commands.benchmark_persistence import Command as PersistenceBenchmark
+
+
+class Command(BaseCommand):
+    help = '''Writes batches of synthetic documents from several pipelines while other threads browse the home page
+    (first page with facet counts, then the next pages) and edit documents as in the admin, on a throwaway SQLite database.
+    Prints the "database is locked" errors and the latency of each kind of operation, with the SQLite profile
+    of the settings and with the SQLite defaults (--compare). The database of the app is not touched'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--docs', type=int, default=2000, help='documents in the database before the run')
+        parser.add_argument('--pipelines', type=int, default=2, help='threads writing batches of documents')
+        parser.add_argument('--batch', type=int, default=20, help='documents per batch')
+        parser.add_argument('--readers', type=int, default=4, help='threads browsing the home page')
+        parser.add_argument('--editors', type=int, default=1, help='threads editing documents')
+        parser.add_argument('--compare', action='store_true', help='also run without the profile (SQLite defaults, one writer per pipeline)')
+
+    def workload(self, options):
+        stop = Event()
+        lock = Lock()
+        stats = {}
+
+        def record(kind, elapsed=None, error=None):
+            with lock:
+                entry = stats.setdefault(kind, {"ok": [], "locked": 0, "errors": 0})
+                if error is None:
+                    entry["ok"].append(elapsed)
+                elif "locked" in str(error) or "busy" in str(error):
+                    entry["locked"] += 1
+                else:
+                    entry["errors"] += 1
+
+        def timed(kind, operation):
+            start = time.perf_counter()
+            try:
+                operation()
+            except OperationalError as e:
+                record(kind, error=e)
+            else:
+                record(kind, time.perf_counter()-start)
+
+        def pipeline(number):
+            entries = PersistenceBenchmark().synthetic_entries(f"pipeline-{number}", 10**9)
+            while not stop.is_set():
+                batch = [next(entries) for _ in range(options['batch'])]
+                timed("pipeline batch", lambda: run_write(add_docs_to_db, batch))
+            connection.close()
+
+        def reader(number):
+            client = Client(HTTP_HOST="localhost")
+            rng = random.Random(number)
+            while not stop.is_set():
+                params = rng.choice([{}, {"kw": "summary"}, {"category": f"Category {rng.randrange(40)}"},
+                                     {"author": "Jane"}, {"sort-by-status": "draft"}])
+                def browse():
+                    response = client.get("/api/docs", params)
+                    cursor = response.json().get("next_cursor")
+                    if cursor:
+                        client.get("/api/docs", {**params, "cursor": cursor})
+                timed("home page", browse)
+
+        def editor(number):
+            rng = random.Random(-number)
+            last_id = LoggedDoc.objects.order_by("-id").values_list("id", flat=True).first()
+            while not stop.is_set():
+                def edit():
+                    # the change view of the admin reads the document and saves it in one transaction
+                    with transaction.atomic():
+                        doc = LoggedDoc.objects.filter(id__lte=rng.randint(1, last_id)).order_by("-id").first()
+                        doc.is_draft = not doc.is_draft
+                        doc.comment = f"edited {time.time()}"
+                        doc.save()
+                timed("admin edit", edit)
+                time.sleep(0.05)
+            connection.close()
+
+        threads = [Thread(target=pipeline, args=(number,)) for number in range(options['pipelines'])]
+        threads += [Thread(target=reader, args=(number,)) for number in range(options['readers'])]
+        threads += [Thread(target=editor, args=(number,)) for number in range(options['editors'])]
+        for thread in threads:
+            thread.start()
+        time.sleep(options['seconds'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        return stats
+
+    def run(self, label, options):
+        # a fresh file database for each run, the journal mode (WAL) is kept in the file
+        db_dir = tempfile.mkdtemp()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(db_dir, 'concurrency.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        try:
+            entries = list(PersistenceBenchmark().synthetic_entries("seed", options['docs']))
+            for index in range(0, len(entries), 100):
+                add_docs_to_db(entries[index:index+100])
+
+            stats = self.workload(options)
+
+            self.stdout.write(label)
+            self.stdout.write(f"  {'operation':<18}{'done':>8}{'locked':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+            for kind, entry in stats.items():
+                times = sorted(entry["ok"]) or [0]
+                self.stdout.write(f"  {kind:<18}{len(entry['ok']):>8}{entry['locked']:>8}{entry['errors']:>8}"
+                                  f"{1000*times[len(times)//2]:>10.1f}{1000*times[int(len(times)*0.95)]:>10.1f}{1000*times[-1]:>10.1f}")
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            self.stderr.write("the database is not SQLite")
+            return
+
+        transaction_mode = connection.settings_dict['OPTIONS'].get('transaction_mode')
+        self.run(f"SQLite profile (SQLITE_CONCURRENCY={backend.sqlite.SQLITE_CONCURRENCY}, SQLITE_SINGLE_WRITER={backend.sqlite.SQLITE_SINGLE_WRITER}, "
+                 f"transaction_mode={transaction_mode})", options)
+
+        if options['compare']:
+            profile = (backend.sqlite.SQLITE_CONCURRENCY, backend.sqlite.SQLITE_SINGLE_WRITER, transaction_mode)
+            backend.sqlite.SQLITE_CONCURRENCY, backend.sqlite.SQLITE_SINGLE_WRITER = False, False
+            self.set_transaction_mode("DEFERRED")
+            try:
+                self.run("SQLite defaults", options)
+            finally:
+                backend.sqlite.SQLITE_CONCURRENCY, backend.sqlite.SQLITE_SINGLE_WRITER = profile[:2]
+                self.set_transaction_mode(profile[2])
+
+    def set_transaction_mode(self, mode):
+        ''' transaction_mode of the connections opened from now on (see backend/sqlite_backend), and of this one '''
+
+        connection.settings_dict['OPTIONS']['transaction_mode'] = mode
+        if hasattr(connection, 'transaction_mode'):
+            connection.transaction_mode = mode
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+
+from backend.dedupe import DEDUPE_BATCH_SIZE, dedupe_names
+
+LINKS_MIGRATION=("backend", "0008_taxonomy_links")
+UNIQUE_MIGRATION=("backend", "0009_unique_taxonomy_names")
+
+
+class Command(BaseCommand):
+    help = '''Moves the authors, categories and countries to one row per name linked to the documents, in batches
+    (one transaction each), so that a large database is not locked for the whole migration. Migration 0009 does the same
+    in one transaction. To use the command: python manage.py migrate backend 0008, run the command, then python manage.py migrate.
+    It can be stopped and run again'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=DEDUPE_BATCH_SIZE, help='rows per transaction')
+
+    def handle(self, *args, **options):
+        executor = MigrationExecutor(connection)
+        applied = executor.loader.applied_migrations
+
+        if UNIQUE_MIGRATION in applied:
+            self.stdout.write("names are already unique")
+            return
+        if LINKS_MIGRATION not in applied:
+            raise CommandError(f"run python manage.py migrate backend {LINKS_MIGRATION[1]} first")
+
+        # models as they are at 0008, with the doc column of the rows
+        apps = executor.loader.project_state(LINKS_MIGRATION).apps
+
+        start = time.perf_counter()
+        dedupe_names(apps, options['batch'], log=self.stdout.write)
+        self.stdout.write(f"done in {time.perf_counter()-start:.1f}s, run python manage.py migrate to add the unique constraints")
@@ -0,0 +1,96 @@
+import json
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import BoundedSemaphore, Lock
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = '''Runs a stub of the llama.cpp server /completion endpoint returning a valid JSON after a fixed delay (plus /tokenize, /props and /embedding).
+    Point LLAMA_CPP_SERVER_URL to it to exercise the document pipeline and the LLM dispatcher without a model.
+    The number of requests served at the same time is printed so the in-flight limits can be checked'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8080)
+        parser.add_argument('--delay', type=float, default=1.0, help='seconds spent on each completion')
+        parser.add_argument('--slots', type=int, default=4, help='requests above this number wait, like the --parallel slots of llama.cpp')
+        parser.add_argument('--ctx', type=int, default=8192, help='context of a slot reported by /props')
+
+    def handle(self, *args, **options):
+        delay = options['delay']
+        stats = {"in_flight": 0, "peak": 0, "served": 0}
+        lock = Lock()
+        stdout = self.stdout
+        slots = BoundedSemaphore(options['slots'])
+        n_ctx = options['ctx']
+
+        completion = {"metadata": {"authors": ["Stub Author"], "title": "Stub title", "slug": "stub-document",
+                                   "categories": ["stub"], "countries": [], "date_published": "2024/01/01"},
+                      "summaries": {"short_summary": "Stub short summary", "long_summary": "Stub long summary"},
+                      "short_summary": "Stub short summary"}
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data):
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/props":
+                    self.send_json({"default_generation_settings": {"n_ctx": n_ctx}})
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+
+            def do_POST(self):
+                request = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+                # one token per 4 characters, close enough for a stub
+                if self.path == "/tokenize":
+                    content = json.loads(request or b"{}").get("content", "")
+                    self.send_json({"tokens": list(range(len(content)//4))})
+                    return
+
+                # bag of hashed words, so that texts sharing words are close
+                if self.path == "/embedding":
+                    content = json.loads(request or b"{}").get("content", "")
+                    embedding = [0.0]*64
+                    for word in content.lower().split():
+                        embedding[zlib.crc32(word.encode()) % 64] += 1.0
+                    self.send_json({"embedding": embedding})
+                    return
+
+                if self.path != "/completion":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                with slots:
+                    with lock:
+                        stats["in_flight"] += 1
+                        stats["peak"] = max(stats["peak"], stats["in_flight"])
+
+                    time.sleep(delay)
+
+                    with lock:
+                        stats["in_flight"] -= 1
+                        stats["served"] += 1
+                        stdout.write(f"served {stats['served']} completions, peak concurrency {stats['peak']}")
+
+                self.send_json({"content": json.dumps(completion), "generation_settings": {"model": "llm-stub"}})
+
+        server = ThreadingHTTPServer(("127.0.0.1", options['port']), Handler)
+        self.stdout.write(f"llama.cpp stub listening on http://127.0.0.1:{options['port']}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,102 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from backend.doc_cache import bump_versions
+from backend.models import DocImage, LoggedDoc
+from newdocs.doc_processing import PARSE_MAX_WORKERS, transcode_images
+from newdocs.image_store import store_images, stored_fields
+from newdocs.thumbnails import MEDIA_ROOT, image_files, delete_image_files
+
+
+class Command(BaseCommand):
+    help = '''Moves the images saved before the image store (images/<slug>_<index>.png and their variants) to the store
+    (see newdocs/image_store.py): each file is hashed and transcoded, identical images are stored once and the DocImage
+    rows point to the stored image. A document showing the same image twice keeps one row.
+    The old files are deleted once their row is moved, unless --keep-files. Files that are missing or are not images
+    are reported and their rows left as they are'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-files', action='store_true', help='do not delete the files of the moved images')
+        parser.add_argument('--chunk', type=int, default=100, help='images read from the database at once')
+
+    def transcode(self, image):
+        path = os.path.join(MEDIA_ROOT, image.image_url)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, 'rb') as image_file:
+            transcoded = transcode_images([image_file.read()])
+
+        return transcoded[0] if transcoded else False
+
+    def move(self, chunk, transcoded, keep_files):
+        ''' Stores the images of a chunk and points their rows to the store, returns the rows moved '''
+
+        with transaction.atomic():
+            stored = store_images([image for image in transcoded if image])
+
+            moved = []
+            old_files = []
+            for image, image_transcoded in zip(chunk, transcoded):
+                if image_transcoded:
+                    old_files.extend(image_files(image))
+                    for field, value in stored_fields(stored[image_transcoded["sha256"]]).items():
+                        setattr(image, field, value)
+                    moved.append(image)
+
+            DocImage.objects.bulk_update(moved, ["stored", "image_url", "format", "width", "height", "variants"])
+
+        if not keep_files:
+            new_files = {path for image in moved for path in image_files(image)}
+            for path in set(old_files)-new_files:
+                if not DocImage.objects.filter(stored__isnull=True, image_url=path).exists():
+                    delete_image_files(DocImage(image_url=path))
+
+        return moved
+
+    def merge_duplicates(self):
+        ''' Keeps one row per document and stored image, the default image of the documents follows it '''
+
+        duplicates = (DocImage.objects.filter(stored__isnull=False).values("doc_id", "stored_id")
+                      .annotate(rows=Count("id"), kept=Min("id")).filter(rows__gt=1))
+
+        removed = 0
+        for duplicate in duplicates:
+            others = DocImage.objects.filter(doc_id=duplicate["doc_id"], stored_id=duplicate["stored_id"]).exclude(id=duplicate["kept"])
+            LoggedDoc.objects.filter(default_image__in=others).update(default_image_id=duplicate["kept"])
+            removed += others.delete()[0]
+
+        return removed
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        images = DocImage.objects.filter(stored__isnull=True)
+        done = missing = not_images = 0
+        last_id = 0
+
+        # one thread per process of the parse pool, each waiting for the transcoding of one image
+        with ThreadPoolExecutor(max_workers=max(PARSE_MAX_WORKERS, 1)) as executor:
+            while True:
+                chunk = list(images.filter(id__gt=last_id).order_by("id")[:options['chunk']])
+                if not chunk:
+                    break
+                last_id = chunk[-1].id
+
+                transcoded = list(executor.map(self.transcode, chunk))
+                missing += transcoded.count(None)
+                not_images += transcoded.count(False)
+
+                moved = self.move(chunk, transcoded, options['keep_files'])
+                # the tiles and pages showing these images are rendered again
+                bump_versions(list({image.doc_id for image in moved}))
+                done += len(moved)
+
+        merged = self.merge_duplicates()
+
+        self.stdout.write(f"{done} images moved to the store ({merged} duplicates of a document merged, "
+                          f"{missing} files missing, {not_images} not images) in {time.perf_counter()-start:.1f}s")
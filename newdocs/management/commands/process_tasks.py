@@ -0,0 +1,47 @@
+import time
+from multiprocessing import Process
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from newdocs.task_queue import worker_loop
+
+
+class Command(BaseCommand):
+    help = '''Runs worker processes that claim and process the documents queued from the UI.
+    Set TASK_QUEUE_WORKER=external in the .env file so that the web server leaves the queue to these workers.
+    Jobs left unfinished by a crashed worker are requeued after TASK_QUEUE_LEASE seconds'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+        parser.add_argument('--once', action='store_true', help='stop when the queue is empty instead of waiting for new tasks')
+
+    def handle(self, *args, **options):
+        # DB connections must not be shared with the child processes
+        connections.close_all()
+
+        def start_worker():
+            worker = Process(target=worker_loop, kwargs={"once": options['once']})
+            worker.start()
+            return worker
+
+        workers = [start_worker() for _ in range(options['workers'])]
+        self.stdout.write(f"{len(workers)} worker(s) started, batches of {settings.TASK_QUEUE_BATCH_SIZE} documents")
+
+        try:
+            while any(worker.is_alive() for worker in workers) or not options['once']:
+                if not options['once']:
+                    # restart workers that died (their jobs are requeued once their claims expire)
+                    for index, worker in enumerate(workers):
+                        if not worker.is_alive():
+                            self.stderr.write(f"worker {worker.pid} exited with code {worker.exitcode}, restarting")
+                            workers[index] = start_worker()
+                time.sleep(2)
+
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.facets import stored_counts_available, rebuild_counts
+
+
+class Command(BaseCommand):
+    help = '''Counts again the documents per author, category, country and validation status shown on the home page.
+    The counts are kept up to date when documents are saved, run this after restoring a database or editing it outside the app'''
+
+    def handle(self, *args, **options):
+        if not stored_counts_available():
+            raise CommandError("the counts are only stored with SQLite, they are computed on each request otherwise")
+
+        start = time.perf_counter()
+        docs = rebuild_counts()
+        self.stdout.write(f"{docs} documents counted in {time.perf_counter()-start:.2f}s")
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.search import fts_available, rebuild_index
+
+
+class Command(BaseCommand):
+    help = '''Rebuilds the full-text index of the documents used by the keyword search of the home page.
+    The index is kept up to date when documents are saved, run this after restoring a database or editing it outside the app'''
+
+    def handle(self, *args, **options):
+        if not fts_available():
+            raise CommandError("the full-text index needs SQLite with FTS5, run python manage.py migrate first")
+
+        start = time.perf_counter()
+        docs = rebuild_index()
+        self.stdout.write(f"{docs} documents indexed in {time.perf_counter()-start:.2f}s")
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from newdocs.embeddings import embeddings_enabled
+from newdocs.taxonomy import TAXONOMY_MODELS, build_index, index_lock, index_path
+
+
+class Command(BaseCommand):
+    help = '''Rebuilds the indexes of the author, category and country names used to match the terms proposed by the LLM,
+    from the embeddings saved on the rows (name_embedding). Names without embedding are embedded with --embed-missing.
+    Run it with --embed-missing after turning taxonomy matching on, and after changing EMBEDDING_MODEL'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--embed-missing', action='store_true', help='embed the names that have no embedding yet')
+
+    def handle(self, *args, **options):
+        if options['embed_missing'] and not embeddings_enabled():
+            raise CommandError("set EMBEDDING_CLIENT to embed names")
+
+        for kind in TAXONOMY_MODELS:
+            start = time.perf_counter()
+            index = build_index(kind, embed_missing=options['embed_missing'])
+            with index_lock(kind):
+                index.save(index_path(kind))
+            lists = len(index.centroids) if index.centroids is not None else 0
+            self.stdout.write(f"{kind}: {len(index)} names, {lists} lists, in {time.perf_counter()-start:.1f}s")
+
+        self.stdout.write("the processing workers load the new indexes before their next batch")
@@ -0,0 +1,62 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.models import LoggedDoc
+from newdocs.embeddings import EMBEDDING_BATCH_SIZE, doc_text, embed_texts, embeddings_enabled, get_vector_store
+
+
+class Command(BaseCommand):
+    help = '''Rebuilds the vector store used by the semantic search from the embeddings saved with the documents (summary_embedding).
+    Documents without embedding are embedded with --embed-missing. Run it after changing EMBEDDING_MODEL or EMBEDDING_DIMENSIONS
+    with --embed-all, or to drop the empty rows left by deleted documents'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--embed-missing', action='store_true', help='embed the documents that have no embedding yet')
+        parser.add_argument('--embed-all', action='store_true', help='embed every document again (after a change of model)')
+        parser.add_argument('--chunk', type=int, default=1000, help='documents read from the database at once')
+
+    def embed(self, docs):
+        for start in range(0, len(docs), EMBEDDING_BATCH_SIZE):
+            batch = docs[start:start+EMBEDDING_BATCH_SIZE]
+            for doc, vector in zip(batch, embed_texts([doc_text(doc) for doc in batch])):
+                doc.summary_embedding = vector.tolist()
+            LoggedDoc.objects.bulk_update(batch, ["summary_embedding"])
+
+    def handle(self, *args, **options):
+        embed = options['embed_missing'] or options['embed_all']
+        if embed and not embeddings_enabled():
+            raise CommandError("set EMBEDDING_CLIENT to embed documents")
+
+        start = time.perf_counter()
+        ids, vectors = [], []
+        embedded = skipped = 0
+        last_id = 0
+
+        # documents are read by chunks of ids so that the embeddings of the whole base are never decoded at once
+        while True:
+            docs = list(LoggedDoc.objects.filter(id__gt=last_id).order_by("id")
+                        .only("id", "title", "overview", "summary", "summary_embedding")[:options['chunk']])
+            if not docs:
+                break
+            last_id = docs[-1].id
+
+            to_embed = [doc for doc in docs if options['embed_all'] or (embed and not doc.summary_embedding)]
+            if to_embed:
+                self.embed(to_embed)
+                embedded += len(to_embed)
+
+            for doc in docs:
+                if not doc.summary_embedding:
+                    skipped += 1
+                    continue
+                ids.append(doc.id)
+                vectors.append(np.asarray(doc.summary_embedding, dtype=np.float32))
+
+        if len({vector.shape for vector in vectors}) > 1:
+            raise CommandError("the saved embeddings have different sizes, run the command with --embed-all")
+
+        get_vector_store().rebuild(ids, np.vstack(vectors) if vectors else [])
+        self.stdout.write(f"{len(ids)} documents in the vector store ({embedded} embedded, {skipped} without embedding) "
+                          f"in {time.perf_counter()-start:.1f}s")
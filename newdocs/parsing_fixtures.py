@@ -0,0 +1,154 @@
+import json
+import random
+from html import escape
+
+# Representative Arxiv abstract pages and Youtube watch pages, generated so that benchmark_parsing and the tests do not
+# depend on saved copies of the sites. They follow the layout read by doc_parsing.arxiv_soup and youtube_soup and
+# carry what makes the real pages costly to parse: on Arxiv the navigation, the tools of the right column and the
+# footer around div.leftcolumn, on Youtube the inline scripts (ytInitialData) that make up most of a watch page.
+# Pages are deterministic: the same index always gives the same page.
+
+WORDS = ("model", "language", "learning", "policy", "graph", "network", "data", "training", "evaluation", "agent",
+         "transformer", "inference", "benchmark", "retrieval", "alignment", "robust", "sparse", "attention", "energy", "climate")
+
+ARXIV_SUBJECTS = ("Computation and Language (cs.CL)", "Machine Learning (cs.LG)", "Computers and Society (cs.CY)",
+                  "Artificial Intelligence (cs.AI)", "General Economics (econ.GN)")
+
+DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def _sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()+"."
+
+def _name(rng):
+    return f"{rng.choice('ABCDEFGHJKLMNPRSTVW')}{''.join(rng.choice('aeiourlnst') for _ in range(5))} " \
+           f"{rng.choice('ABCDEFGHJKLMNPRSTVW')}{''.join(rng.choice('aeiourlnst') for _ in range(7))}"
+
+def _filler(rng, size):
+    ''' navigation and tool links, about size bytes '''
+
+    links = []
+    length = 0
+    while length < size:
+        link = f'<li><a href="/{rng.choice(WORDS)}/{rng.randrange(10**6)}" class="nav-link">{_sentence(rng, 3)}</a></li>\n'
+        links.append(link)
+        length += len(link)
+    return "<ul>\n"+"".join(links)+"</ul>\n"
+
+def arxiv_page(index=0, size_kb=60):
+    ''' Arxiv abstract page (arxiv.org/abs/...), about size_kb KB '''
+
+    rng = random.Random(f"arxiv-{index}")
+    title = _sentence(rng, 8)[:-1]
+    authors = [_name(rng) for _ in range(rng.randint(2, 8))]
+    subject = rng.choice(ARXIV_SUBJECTS)
+    submitted = f"{rng.choice(DAYS)}, {rng.randint(1, 28)} {rng.choice(MONTHS)} {rng.randint(2015, 2024)} {rng.randint(10, 23)}:{rng.randint(10, 59)}:{rng.randint(10, 59)} UTC"
+    abstract = " ".join(_sentence(rng, rng.randint(10, 25)) for _ in range(8))
+    filler = max(size_kb*1024-4096, 0)
+
+    return f'''<!DOCTYPE html>
+<html lang="en">
+<head>
+<title>[2401.{index:05d}] {escape(title)}</title>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<meta property="og:type" content="website">
+<meta property="og:title" content="{escape(title)}">
+<meta property="og:image" content="/static/browse/0.3.4/images/arxiv-logo-fb.png">
+<meta name="citation_title" content="{escape(title)}">
+{"".join(f'<meta name="citation_author" content="{escape(author)}">' for author in authors)}
+<link rel="stylesheet" media="screen" href="/static/browse/0.3.4/css/arXiv.css">
+<script src="/static/browse/0.3.4/js/mathjaxToggle.min.js" type="text/javascript"></script>
+</head>
+<body class="with-cu-identity">
+<div class="flex-wrap-footer">
+<header><div id="cu-identity"><a href="https://www.cornell.edu/">Cornell University</a></div>
+<div class="header-breadcrumbs"><a href="/">arXiv</a> &gt; <a href="/list/cs/recent">cs</a> &gt; arXiv:2401.{index:05d}</div>
+<nav class="search-block">{_filler(rng, filler//4)}</nav></header>
+<main><div id="content"><div id="abs-outer">
+<div class="leftcolumn">
+<div class="subheader"><h1>Computer Science &gt; {escape(subject.split(" (")[0])}</h1></div>
+<div id="content-inner"><div id="abs">
+<div class="dateline">[Submitted on {submitted[5:16]}]</div>
+<h1 class="title mathjax"><span class="descriptor">Title:</span>{escape(title)}</h1>
+<div class="authors"><span class="descriptor">Authors:</span>{", ".join(f'<a href="https://arxiv.org/search/cs?searchtype=author&amp;query={escape(author)}">{escape(author)}</a>' for author in authors)}</div>
+<blockquote class="abstract mathjax"><span class="descriptor">Abstract:</span>{escape(abstract)}</blockquote>
+<div class="metatable"><table summary="Additional metadata">
+<tr><td class="tablecell label">Subjects:</td><td class="tablecell subjects"><span class="primary-subject">{escape(subject)}</span></td></tr>
+<tr><td class="tablecell label">Cite as:</td><td class="tablecell arxivid"><a href="/abs/2401.{index:05d}">arXiv:2401.{index:05d}</a> [cs.CL]</td></tr>
+</table></div>
+</div></div>
+<div class="submission-history"><h2>Submission history</h2> From: {escape(authors[0])} [<a href="/show-email/{index}">view email</a>]<br>
+<strong>[v1]</strong> {submitted} ({rng.randint(100, 9999)} KB)<br></div>
+</div>
+<div class="extra-services"><div class="full-text"><h2>Access Paper:</h2>{_filler(rng, filler//4)}</div>
+<div class="bookmarks"><h3>Bookmark</h3>{_filler(rng, filler//4)}</div></div>
+</div></div></main>
+<footer>{_filler(rng, filler//4)}</footer>
+</div>
+<script>window.MathJaxToggle();</script>
+</body>
+</html>
+'''.encode()
+
+def youtube_page(index=0, size_kb=800):
+    ''' Youtube watch page, about size_kb KB, mostly the inline JSON of ytInitialData '''
+
+    rng = random.Random(f"youtube-{index}")
+    title = _sentence(rng, 7)[:-1]
+    channel = _name(rng)
+    keywords = ", ".join(sorted({rng.choice(WORDS) for _ in range(8)}))
+    description = " ".join(_sentence(rng) for _ in range(3))
+    published = f"{rng.choice(MONTHS)} {rng.randint(1, 28)}, {rng.randint(2015, 2024)}"
+
+    # ytInitialData, nested renderers of the recommended videos
+    items = []
+    length = 0
+    while length < size_kb*1024-8192:
+        item = {"compactVideoRenderer":{"videoId":f"{rng.randrange(16**11):011x}",
+                                        "title":{"simpleText":_sentence(rng, 6)},
+                                        "longBylineText":{"runs":[{"text":_name(rng)}]},
+                                        "viewCountText":{"simpleText":f"{rng.randrange(10**7):,} views"},
+                                        "thumbnail":{"thumbnails":[{"url":f"https://i.ytimg.com/vi/{rng.randrange(16**11):011x}/hqdefault.jpg",
+                                                                     "width":168, "height":94}]},
+                                        "trackingParams":f"{rng.getrandbits(256):064x}"}}
+        items.append(item)
+        length += len(json.dumps(item))
+    initial_data = json.dumps({"contents":{"twoColumnWatchNextResults":{"secondaryResults":{"results":items}}}})
+
+    return f'''<!DOCTYPE html>
+<html style="font-size: 10px;font-family: Roboto, Arial, sans-serif;" lang="en">
+<head>
+<title>{escape(title)} - YouTube</title>
+<meta name="description" content="{escape(description)}">
+<meta name="keywords" content="{escape(keywords)}">
+<meta property="og:site_name" content="YouTube">
+<meta property="og:title" content="{escape(title)}">
+<meta property="og:image" content="https://i.ytimg.com/vi/{index:011d}/maxresdefault.jpg">
+<link rel="stylesheet" href="https://www.youtube.com/s/desktop/css/www-main-desktop-watch-page-skeleton.css">
+<script nonce="{rng.getrandbits(64):016x}">var ytcfg={{"EXPERIMENT_FLAGS":{{}}, "INNERTUBE_CONTEXT_CLIENT_VERSION":"2.2024"}};</script>
+</head>
+<body dir="ltr">
+<ytd-app><div id="content" class="style-scope ytd-app">
+<ytd-watch-flexy class="style-scope ytd-page-manager">
+<div id="above-the-fold" class="style-scope ytd-watch-metadata">
+<h1 class="style-scope ytd-watch-metadata"><yt-formatted-string class="style-scope ytd-watch-metadata">{escape(title)}</yt-formatted-string></h1>
+<div id="info-container" class="style-scope ytd-watch-metadata"><span id="date-text" class="style-scope ytd-watch-metadata">{published}</span></div>
+</div>
+<ytd-channel-name id="channel-name" class="style-scope ytd-video-owner-renderer"><a class="yt-simple-endpoint" href="/@{index}">{escape(channel)}</a></ytd-channel-name>
+</ytd-watch-flexy>
+</div></ytd-app>
+<script nonce="{rng.getrandbits(64):016x}">var ytInitialData = {initial_data};</script>
+</body>
+</html>
+'''.encode()
+
+PAGES = {"Arxiv": arxiv_page, "Youtube": youtube_page}
+
+def fixture_pages(category, count=3, size_kb=None):
+    ''' [(name, html bytes)] of generated pages of a category, "Arxiv" or "Youtube" '''
+
+    page = PAGES[category]
+    options = {"size_kb":size_kb} if size_kb else {}
+    return [(f"generated {category.lower()} {index}", page(index, **options)) for index in range(count)]
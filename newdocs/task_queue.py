@@ -0,0 +1,180 @@
+import os
+import socket
+import time
+from datetime import timedelta
+from threading import Thread, Event
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from newdocs.doc_processing import ProcessingProgress, processing_start
+from backend.models import ProcessingTask, ProcessingJob
+
+TASK_QUEUE_BATCH_SIZE=settings.TASK_QUEUE_BATCH_SIZE
+TASK_QUEUE_LEASE=settings.TASK_QUEUE_LEASE
+TASK_QUEUE_MAX_ATTEMPTS=settings.TASK_QUEUE_MAX_ATTEMPTS
+
+
+## QUEUE
+
+def enqueue_task(data, client, chat_format, model, task_id, refresh_cache=False, bypass_llm_cache=False):
+    ''' Stores a new task and one job per URL in the DB. Workers will pick them up
+    :data: dictionary of urls classified by category, see newdocs.views.classify_urls 
+    :refresh_cache: documents are downloaded again instead of being served by the HTTP cache 
+    :bypass_llm_cache: the model is called again instead of reusing cached completions '''
+
+    with transaction.atomic():
+        task = ProcessingTask.objects.create(task_id=task_id, client=client, chat_format=chat_format, model=model,
+                                             refresh_cache=refresh_cache, bypass_llm_cache=bypass_llm_cache, total_docs=sum(len(urls) for urls in data.values()))
+        ProcessingJob.objects.bulk_create([ProcessingJob(task=task, url=url, category=category)
+                                           for category, urls in data.items() for url in urls])
+
+    return task
+
+def requeue_stale_jobs():
+    ''' Jobs whose worker stopped refreshing its claim (crash, restart...) go back to the queue,
+    unless they already failed too many times, in which case they are closed as failed.
+    No worker is left to finish the tasks whose last open jobs are closed here, so they are finished here '''
+
+    stale = ProcessingJob.objects.filter(status=ProcessingJob.RUNNING,
+                                         claimed_at__lt=timezone.now()-timedelta(seconds=TASK_QUEUE_LEASE))
+
+    expired = stale.filter(attempts__gte=TASK_QUEUE_MAX_ATTEMPTS)
+    task_ids = set(expired.values_list('task_id', flat=True))
+    expired.update(status=ProcessingJob.DONE, success=False, claim_token=None)
+    requeued = stale.update(status=ProcessingJob.PENDING, worker=None, claim_token=None)
+
+    for task in ProcessingTask.objects.filter(pk__in=task_ids).exclude(status=ProcessingTask.FINISHED):
+        if not ProcessingJob.objects.filter(task=task).exclude(status=ProcessingJob.DONE).exists():
+            TaskProgress(task, []).finish()
+
+    return requeued
+
+def claim_jobs(worker_id, limit=TASK_QUEUE_BATCH_SIZE):
+    ''' Atomically claims up to `limit` pending jobs of the oldest unfinished task
+    The claim is a single conditional UPDATE so two workers can never claim the same job
+    Returns the task and the list of claimed jobs (empty if there is nothing to do) '''
+
+    job = ProcessingJob.objects.filter(status=ProcessingJob.PENDING).order_by('task__created_at', 'id').first()
+    if job is None:
+        return None, []
+
+    token = uuid4().hex
+    candidates = list(ProcessingJob.objects.filter(task_id=job.task_id, status=ProcessingJob.PENDING)
+                      .order_by('id').values_list('id', flat=True)[:limit])
+
+    ProcessingJob.objects.filter(id__in=candidates, status=ProcessingJob.PENDING).update(
+        status=ProcessingJob.RUNNING, worker=worker_id, claim_token=token,
+        claimed_at=timezone.now(), attempts=F('attempts')+1)
+
+    jobs = list(ProcessingJob.objects.filter(claim_token=token))
+    if jobs:
+        ProcessingTask.objects.filter(pk=job.task_id, status=ProcessingTask.PENDING).update(status=ProcessingTask.RUNNING)
+
+    return job.task, jobs
+
+## PROGRESS
+
+class TaskProgress(ProcessingProgress):
+    '''
+    Progress of a task processed by one or several workers.
+    Counters are read from the jobs in the DB so that every worker publishes the progress of the whole task
+    with the same progress_update JSON contract as an in-process task
+    '''
+    def __init__(self, task, jobs):
+        super().__init__(task.task_id, task.total_docs)
+        self.task = task
+        self.jobs = {job.url: job for job in jobs}
+
+    def refresh(self):
+        ''' counters of the whole task, read when the progress is published '''
+        done = ProcessingJob.objects.filter(task=self.task, status=ProcessingJob.DONE)
+        failed = list(done.filter(success=False).values_list('url', 'slug'))
+        self.processed_docs = done.count()
+        self.failed_docs = {"count":len(failed), "docs":[list(doc) for doc in failed]}
+
+    def done(self, job):
+        claimed = self.jobs.get(job["url"])
+        if claimed is None:
+            return
+
+        ProcessingJob.objects.filter(pk=claimed.pk, claim_token=claimed.claim_token).update(
+            status=ProcessingJob.DONE, success=job["process_log"].get("success", True), slug=job["article"].slug)
+
+    def finish(self):
+        # the task is only finished once the jobs claimed by the other workers are done too
+        remaining = ProcessingJob.objects.filter(task=self.task).exclude(status=ProcessingJob.DONE).exists()
+
+        if remaining:
+            self.update(None, None, "waiting for the remaining documents")
+        else:
+            ProcessingTask.objects.filter(pk=self.task.pk).update(status=ProcessingTask.FINISHED)
+            self.update(None, None, "finished")
+        self.publish()
+
+## WORKER
+
+def get_worker_id():
+    ''' host:pid plus a random suffix, as several workers can run in the same process (see launch_processing) '''
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+def heartbeat(worker_id, stop):
+    ''' Refreshes the claims of the worker until stop is set, so that its jobs are not considered stale '''
+
+    while not stop.wait(TASK_QUEUE_LEASE/4):
+        ProcessingJob.objects.filter(worker=worker_id, status=ProcessingJob.RUNNING).update(claimed_at=timezone.now())
+
+    connection.close()
+
+def run_jobs(task, jobs):
+    ''' Processes a batch of claimed jobs of a task through the document pipeline '''
+
+    docs = {"youtube":[], "arxiv":[], "others":[]}
+    for job in jobs:
+        docs[job.category].append(job.url)
+
+    progress = TaskProgress(task, jobs)
+
+    try:
+        processing_start(docs, task.client, task.chat_format, task.model, task.task_id, progress=progress, 
+                         refresh_cache=task.refresh_cache, bypass_llm_cache=task.bypass_llm_cache)
+
+    finally:
+        # released jobs may close the task (too many attempts), so the final state is published again
+        release_jobs(jobs)
+        progress.finish()
+
+def release_jobs(jobs):
+    ''' Jobs of a batch that could not be completed (e.g. DB error) go back to the queue to be retried,
+    or are closed as failed once they have been attempted TASK_QUEUE_MAX_ATTEMPTS times '''
+
+    unfinished = ProcessingJob.objects.filter(claim_token=jobs[0].claim_token, status=ProcessingJob.RUNNING)
+    unfinished.filter(attempts__gte=TASK_QUEUE_MAX_ATTEMPTS).update(status=ProcessingJob.DONE, success=False)
+    unfinished.update(status=ProcessingJob.PENDING, worker=None, claim_token=None)
+
+def worker_loop(worker_id=None, once=False, poll_interval=2):
+    ''' Claims and processes jobs until the queue is empty (once=True) or forever
+    :once: used when the web process drains the queue itself, see settings.TASK_QUEUE_WORKER '''
+
+    worker_id = worker_id or get_worker_id()
+    stop = Event()
+    Thread(target=heartbeat, args=(worker_id, stop), daemon=True).start()
+
+    try:
+        while True:
+            requeue_stale_jobs()
+            task, jobs = claim_jobs(worker_id)
+
+            if jobs:
+                run_jobs(task, jobs)
+            elif once:
+                break
+            else:
+                time.sleep(poll_interval)
+
+    finally:
+        stop.set()
+        connection.close()
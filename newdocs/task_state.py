@@ -0,0 +1,65 @@
+import time
+from datetime import timedelta
+from threading import Lock
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from backend.models import TaskState
+
+TASK_STATE_TTL=settings.TASK_STATE_TTL
+CLEANUP_INTERVAL=60 # seconds between two deletions of the expired entries by a process
+
+# State of the processing tasks (progress_task_<task id>) shared by the processes of the app through the DB:
+# the web worker that answers a poll is rarely the one that launched the task, and the task may run in a
+# process_tasks worker. Each write replaces the entry in one statement (INSERT ... ON CONFLICT DO UPDATE)
+# and pushes back its expiry, reads are one indexed lookup, so many pollers only cost reads.
+# A DB error is printed and treated as a missing entry: the progress is informative, it never stops a task.
+
+_last_cleanup=0
+_cleanup_lock=Lock()
+
+
+def progress_key(task_id):
+    return f"progress_task_{task_id}"
+
+def get_state(key, default=None):
+    ''' Value of an entry, or default if it is missing or expired '''
+
+    try:
+        value=TaskState.objects.filter(key=key, expires_at__gt=timezone.now()).values_list("value", flat=True).first()
+    except DatabaseError as e:
+        print("task state unavailable", e)
+        return default
+
+    return default if value is None else value
+
+def set_state(key, value, ttl=TASK_STATE_TTL):
+    ''' Creates or replaces an entry, kept ttl seconds after its last write '''
+
+    try:
+        TaskState.objects.bulk_create([TaskState(key=key, value=value, expires_at=timezone.now()+timedelta(seconds=ttl))],
+                                      update_conflicts=True, unique_fields=["key"], update_fields=["value", "expires_at", "modified_at"])
+        delete_expired()
+
+    except DatabaseError as e:
+        print("task state unavailable", e)
+
+def delete_state(key):
+    try:
+        TaskState.objects.filter(key=key).delete()
+    except DatabaseError as e:
+        print("task state unavailable", e)
+
+def delete_expired(force=False):
+    ''' Drops the expired entries, at most once per CLEANUP_INTERVAL per process unless forced '''
+
+    global _last_cleanup
+
+    with _cleanup_lock:
+        if not force and time.monotonic()-_last_cleanup<CLEANUP_INTERVAL:
+            return 0
+        _last_cleanup=time.monotonic()
+
+    return TaskState.objects.filter(expires_at__lte=timezone.now()).delete()[0]
@@ -0,0 +1,219 @@
+import os
+import traceback
+from contextlib import contextmanager
+from threading import Lock
+
+import numpy as np
+from django.conf import settings
+
+from backend.models import Author, Category, Country
+from backend.sqlite import run_write
+from newdocs.ann_index import IVFIndex
+from newdocs.embeddings import embed_texts, embeddings_enabled
+
+try:
+    import fcntl
+except ImportError: # Windows, writers are only serialized within a process
+    fcntl = None
+
+# Matches the authors, categories and countries proposed by the LLM to the names already in the database,
+# so that "Machine-learning" is saved as the existing "Machine Learning" rather than as a new name.
+# Terms are first matched on their lowercase form, then on their embedding with an approximate nearest-neighbour
+# index of the names (see newdocs/ann_index.py) above TAXONOMY_MATCH_THRESHOLD (cosine similarity).
+# A name that matches nothing is kept as the LLM wrote it, and added to the index once its document is saved.
+# Each process keeps the indexes in memory and loads them again when another process (a worker of the task queue,
+# rebuild_taxonomy_index) wrote their file since: the names a process adds are merged into the file on disk
+# under a file lock when it is written, so that no process overwrites the names added by the others.
+
+TAXONOMY_MATCHING=settings.TAXONOMY_MATCHING
+TAXONOMY_MATCH_THRESHOLD=settings.TAXONOMY_MATCH_THRESHOLD
+TAXONOMY_AUTHOR_MATCH_THRESHOLD=settings.TAXONOMY_AUTHOR_MATCH_THRESHOLD
+VECTOR_STORE_DIR=settings.VECTOR_STORE_DIR
+
+# kind -> (model, name field, key of the list in the article, similarity above which a term is the same name)
+# names of different people are close in embedding space ("John Smith", "Jane Smith"), authors need a stricter threshold
+TAXONOMY_MODELS={"author":(Author, "name", "authors", TAXONOMY_AUTHOR_MATCH_THRESHOLD),
+                 "category":(Category, "category_name", "categories", TAXONOMY_MATCH_THRESHOLD),
+                 "country":(Country, "country_name", "countries", TAXONOMY_MATCH_THRESHOLD)}
+
+SAVE_EVERY=100 # names added to an index before it is written to disk again
+
+_indexes={}
+_lowercase={} # kind -> {lowercase name: name}
+_unsaved={} # kind -> names added since the index was last written
+_pending={} # kind -> {name: vector} of the names added by this process since the index was last written
+_loaded={} # kind -> (inode, mtime, size) of the file the index was read from or written to
+_lock=Lock()
+
+
+def matching_enabled():
+    return TAXONOMY_MATCHING and embeddings_enabled()
+
+def index_path(kind):
+    return os.path.join(VECTOR_STORE_DIR, f"taxonomy_{kind}.npz")
+
+def file_key(path):
+    try:
+        stat=os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+@contextmanager
+def index_lock(kind):
+    ''' One writer of the file of an index at a time, across processes '''
+
+    os.makedirs(VECTOR_STORE_DIR, exist_ok=True)
+    with open(os.path.join(VECTOR_STORE_DIR, f"taxonomy_{kind}.lock"), "w") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+## INDEXES
+
+def build_index(kind, embed_missing=False):
+    ''' Index of the distinct names of a kind, from the name_embedding saved in the database
+    :embed_missing: embeds the names that have no embedding yet and saves it on their rows '''
+
+    model, field, _, _ = TAXONOMY_MODELS[kind]
+
+    vectors=dict(model.objects.filter(name_embedding__isnull=False).values_list(field, "name_embedding").iterator())
+
+    if embed_missing:
+        missing=list(model.objects.filter(name_embedding__isnull=True).order_by(field).values_list(field, flat=True))
+        for start in range(0, len(missing), 256):
+            names=missing[start:start+256]
+            for name, vector in zip(names, embed_texts(names)):
+                vectors[name]=vector.tolist()
+                model.objects.filter(**{field:name}).update(name_embedding=vectors[name])
+
+    index=IVFIndex()
+    if vectors:
+        index.add(list(vectors), np.asarray(list(vectors.values()), dtype=np.float32))
+
+    return index
+
+def refresh_index(kind):
+    ''' Loads the index of a kind from disk if its file changed since it was loaded or written by this process,
+    or builds it from the database the first time if there is no file. The names added by this process and not
+    written yet are added to the index loaded. Called with _lock held '''
+
+    key=file_key(index_path(kind))
+    if kind in _indexes and key==_loaded.get(kind):
+        return
+
+    try:
+        index=IVFIndex.load(index_path(kind))
+    except (FileNotFoundError, OSError, ValueError, KeyError):
+        # an unreadable file is written again with the index in memory
+        if kind in _indexes:
+            _loaded[kind]=key
+            return
+        index=build_index(kind)
+        _unsaved[kind]=len(index)
+
+    pending=_pending.setdefault(kind, {})
+    if pending:
+        index.add(list(pending), np.asarray(list(pending.values())))
+
+    _indexes[kind]=index
+    _loaded[kind]=key
+    _unsaved.setdefault(kind, 0)
+    _lowercase[kind]={label.lower(): label for label in index.labels}
+
+def get_index(kind):
+    ''' Index of a kind, with the names written to disk by the other processes '''
+
+    with _lock:
+        refresh_index(kind)
+        return _indexes[kind]
+
+def save_indexes(force=False):
+    ''' Writes the indexes that changed, every SAVE_EVERY names or when forced (end of a batch of documents),
+    merged with the names the other processes wrote since they were loaded '''
+
+    with _lock:
+        for kind, unsaved in _unsaved.items():
+            if unsaved and (force or unsaved >= SAVE_EVERY):
+                with index_lock(kind):
+                    refresh_index(kind)
+                    _indexes[kind].save(index_path(kind))
+                    _loaded[kind]=file_key(index_path(kind))
+                _unsaved[kind]=0
+                _pending[kind]={}
+
+## MATCHING
+
+def resolve_terms(articles):
+    '''
+    Replaces, in place, the authors, categories and countries of the articles by the closest name in the database
+    All the new terms of the batch are embedded in one call per kind.
+    Returns {kind: {name: vector}} of the names that matched nothing, to be indexed once the documents are saved
+    '''
+
+    if not matching_enabled():
+        return {}
+
+    new_terms={}
+    try:
+        for kind, (_, _, key, threshold) in TAXONOMY_MODELS.items():
+            index=get_index(kind)
+            lowercase=_lowercase[kind]
+
+            terms=sorted({term for article in articles for term in article.get(key) or [] if isinstance(term, str) and term.strip()})
+            to_embed=[term for term in terms if term.lower() not in lowercase]
+
+            canonical={term: lowercase[term.lower()] for term in terms if term.lower() in lowercase}
+            new_terms[kind]={}
+
+            if to_embed:
+                vectors=embed_texts(to_embed)
+                with _lock:
+                    neighbours=index.search(vectors, k=1)
+                for term, vector, matches in zip(to_embed, vectors, neighbours):
+                    if matches and matches[0][1] >= threshold:
+                        canonical[term]=matches[0][0]
+                    else:
+                        new_terms[kind][term]=vector
+
+            for article in articles:
+                if article.get(key):
+                    # two terms of a document may resolve to the same name
+                    article[key]=list(dict.fromkeys(canonical.get(term, term) if isinstance(term, str) else term for term in article[key]))
+
+    except Exception as e:
+        traceback.print_exc()
+        print(f"taxonomy matching skipped: {e}")
+        return {}
+
+    return new_terms
+
+def save_embeddings(model, field, vectors):
+    for name, vector in vectors.items():
+        model.objects.filter(**{field:name}, name_embedding__isnull=True).update(name_embedding=vector.tolist())
+
+def index_terms(new_terms):
+    ''' Adds the new names of a saved batch to the indexes and saves their embedding on their row '''
+
+    try:
+        for kind, vectors in new_terms.items():
+            if not vectors:
+                continue
+
+            model, field, _, _ = TAXONOMY_MODELS[kind]
+            run_write(save_embeddings, model, field, vectors)
+
+            with _lock:
+                refresh_index(kind)
+                index=_indexes[kind]
+                size=len(index)
+                index.add(list(vectors), np.asarray(list(vectors.values())))
+                _unsaved[kind]+=len(index)-size
+                _pending[kind].update(vectors)
+                _lowercase[kind].update((name.lower(), name) for name in vectors if name.lower() not in _lowercase[kind])
+
+        save_indexes()
+
+    except Exception as e:
+        traceback.print_exc()
+        print(f"could not index new names: {e}")
@@ -1,5 +1,579 @@
+import io
+import json
+import os
+import tempfile
+from datetime import timedelta
+from queue import Queue
+from unittest import mock
+
+from django.db import transaction
 from django.test import TestCase
-import argparse
-from newdocs.doc_processing import processing_start
+from django.utils import timezone
+import numpy as np
+from PIL import Image
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from urllib3 import HTTPResponse
+
+from backend.models import CompletionCache, DocImage, LoggedDoc, ProcessingLog, ProcessingJob, ProcessingTask, StoredImage
+from newdocs.doc_parsing import fast_parse, full_parse, parse_html
+from newdocs.doc_processing import (OutputTemplate, ProcessingProgress, STOP, add_docs_to_db, allocate_slug, get_doc, get_image,
+                                    llm_doc, parse_doc, progress_update, run_persist_stage, task_running)
+from newdocs.http_cache import cached_get
+from newdocs.image_processing import process_image
+from newdocs.ann_index import IVFIndex
+from newdocs.image_store import release_unreferenced, store_doc_images
+from newdocs.llm_cache import evict
+from newdocs.parsing_fixtures import arxiv_page, fixture_pages
+from newdocs import taxonomy
+from newdocs.views import progress_events
+from newdocs.task_queue import TASK_QUEUE_LEASE, TASK_QUEUE_MAX_ATTEMPTS, claim_jobs, enqueue_task, requeue_stale_jobs
+from newdocs.task_state import get_state, progress_key
+from newdocs.thumbnails import STAGING_DIR, THUMBNAIL_SIZES, delete_staged, image_files
+
+
+class MemoryProgress(ProcessingProgress):
+    ''' progress kept in memory, never published to the task state store '''
+
+    def publish(self):
+        self.pending = None
+
+
+def pipeline_job(url, slug="document", task_id="test-task"):
+    ''' job as handed over by the LLM stage to the persist stage '''
+
+    article = OutputTemplate()
+    article.url = url
+    article.title = f"Title of {url}"
+    article.slug = slug
+    article.overview = "overview"
+    article.summary = "summary"
+    article.summary_type = "Description"
+    article.date_published = "2024/01/31"
+    article.model_used = "test-model"
+    return {"url":url, "category":"Others", "article":article, "process_log":{"task_id":task_id, "url":url}}
+
+
+# the writer thread has its own connection, which does not see the transaction of a test
+@mock.patch("backend.sqlite.SQLITE_SINGLE_WRITER", False)
+class PersistStageTests(TestCase):
+
+    def run_stage(self, jobs, progress):
+        inbox = Queue()
+        for job in jobs:
+            inbox.put(job)
+        inbox.put(STOP)
+        run_persist_stage(inbox, progress)
+
+    def test_batch_written_once(self):
+        progress = MemoryProgress("test-task", 2)
+        self.run_stage([pipeline_job("https://example.com/a"), pipeline_job("https://example.com/b")], progress)
+
+        self.assertEqual(LoggedDoc.objects.count(), 2)
+        self.assertEqual(ProcessingLog.objects.count(), 2)
+        self.assertEqual(progress.processed_docs, 2)
+
+    def test_committed_batch_not_retried(self):
+        # a failure after the commit must not write the documents and their logs a second time
+        progress = MemoryProgress("test-task", 2)
+        with mock.patch.object(progress, "done", side_effect=RuntimeError("progress store down")):
+            self.run_stage([pipeline_job("https://example.com/a"), pipeline_job("https://example.com/b")], progress)
+
+        self.assertEqual(LoggedDoc.objects.count(), 2)
+        self.assertEqual(ProcessingLog.objects.count(), 2)
+        self.assertEqual(progress.failed_docs["count"], 0)
+
+    def test_slug_conflict_logged_once(self):
+        # a concurrent writer commits "taken" after the slugs were read: the first attempt fails on the unique slug
+        LoggedDoc.objects.create(slug="taken", title="Taken", source_url="https://example.com/taken")
+        stale = iter(["taken"])
+        entries = [(job["article"].to_dict(), job["process_log"])
+                   for job in (pipeline_job("https://example.com/a", slug="taken"), pipeline_job("https://example.com/b"))]
+
+        def stale_allocation(*args, **kwargs):
+            return next(stale, None) or allocate_slug(*args, **kwargs)
+
+        with mock.patch("newdocs.doc_processing.allocate_slug", side_effect=stale_allocation) as allocate:
+            docs = add_docs_to_db(entries)
+
+        self.assertGreater(allocate.call_count, 2)
+        self.assertEqual(sorted(doc.slug for doc in docs), ["document", "taken-2"])
+        self.assertEqual(ProcessingLog.objects.count(), 2)
+
+
+class ProgressStreamTests(TestCase):
+
+    def events(self, stream):
+        ''' progress of the events sent until the stream ends '''
+        return [json.loads(event.split("data: ")[1]) for event in stream if event.startswith("event: progress")]
+
+    def publish(self, task_id, processed_docs, step="processing"):
+        progress_update(task_id, 2, processed_docs, {"count":0, "docs":[]}, None, None, step)
+
+    def test_local_task_read_from_memory(self):
+        task_running("local-task")
+        self.addCleanup(task_running, "local-task", False)
+        self.publish("local-task", 1)
+
+        stream = progress_events("local-task")
+        next(stream)
+        with mock.patch("newdocs.views.get_state", side_effect=get_state) as read_state:
+            self.assertEqual(json.loads(next(stream).split("data: ")[1])["completed"], 1)
+
+            # published while the event was sent, the stream does not wait for the next one
+            self.publish("local-task", 2, "finished")
+            self.assertEqual([progress["completed"] for progress in self.events(stream)], [2])
+
+        read_state.assert_not_called()
+
+    def test_other_process_task_read_from_the_store(self):
+        self.publish("remote-task", 2, "finished")
+
+        with mock.patch("newdocs.views.get_state", side_effect=get_state) as read_state:
+            self.assertEqual([progress["completed"] for progress in self.events(progress_events("remote-task"))], [2])
+
+        read_state.assert_called_once_with(progress_key("remote-task"), mock.ANY)
+
+    def test_stopped_task_read_from_the_store(self):
+        task_running("stopped-task")
+        self.publish("stopped-task", 1)
+        task_running("stopped-task", False)
+
+        # published by another worker of the task after this process stopped processing it
+        self.publish("stopped-task", 2, "finished")
+        self.assertEqual([progress["completed"] for progress in self.events(progress_events("stopped-task"))], [2])
+
+
+class SlugAllocationTests(TestCase):
+
+    def add_docs(self, *slugs):
+        for slug in slugs:
+            LoggedDoc.objects.create(slug=slug, title=slug, source_url=f"https://example.com/{slug}")
+
+    def test_free_slug_kept(self):
+        self.assertEqual(allocate_slug("Attention Is All You Need"), "attention-is-all-you-need")
+        self.assertEqual(allocate_slug("!!!"), "document")
+
+    def test_next_free_suffix(self):
+        self.add_docs("paper", "paper-2", "paper-5", "paper-notes")
+
+        self.assertEqual(allocate_slug("paper"), "paper-6")
+        self.assertEqual(allocate_slug("notes"), "notes")
+
+    def test_slugs_of_the_batch_taken(self):
+        self.add_docs("paper")
+
+        self.assertEqual(allocate_slug("paper", taken={"paper-2"}), "paper-3")
+        self.assertEqual(allocate_slug("other", taken={"other"}), "other-2")
+
+    def test_reprocessed_document_keeps_its_slug(self):
+        self.add_docs("paper", "paper-2")
+
+        self.assertEqual(allocate_slug("paper", current="paper-2"), "paper-2")
+        self.assertEqual(allocate_slug("paper", current="other"), "paper-3")
+
+
+class TaskQueueTests(TestCase):
+
+    def setUp(self):
+        urls = {"youtube":[], "arxiv":[], "others":[f"https://example.com/{i}" for i in range(3)]}
+        self.task = enqueue_task(urls, "openai", "chatml", "test-model", "test-task")
+
+    def expire_lease(self, jobs):
+        ProcessingJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            claimed_at=timezone.now()-timedelta(seconds=TASK_QUEUE_LEASE+1))
+
+    def test_claims_do_not_overlap(self):
+        task, first = claim_jobs("worker-1", limit=2)
+        _, second = claim_jobs("worker-2", limit=2)
+
+        self.assertEqual(task, self.task)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({job.pk for job in first} & {job.pk for job in second})
+        self.assertEqual(claim_jobs("worker-3"), (None, []))
+
+        job = ProcessingJob.objects.get(pk=first[0].pk)
+        self.assertEqual((job.status, job.worker, job.attempts), (ProcessingJob.RUNNING, "worker-1", 1))
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, ProcessingTask.RUNNING)
+
+    def test_live_lease_kept(self):
+        claim_jobs("worker-1")
+
+        self.assertEqual(requeue_stale_jobs(), 0)
+        self.assertFalse(ProcessingJob.objects.filter(status=ProcessingJob.PENDING).exists())
+
+    def test_stale_lease_requeued(self):
+        _, jobs = claim_jobs("worker-1")
+        self.expire_lease(jobs)
+
+        self.assertEqual(requeue_stale_jobs(), 3)
+        self.assertEqual(ProcessingJob.objects.filter(status=ProcessingJob.PENDING, worker=None, claim_token=None).count(), 3)
+
+        _, jobs = claim_jobs("worker-2")
+        self.assertEqual([job.attempts for job in jobs], [2, 2, 2])
+
+    def test_last_stale_jobs_finish_task(self):
+        _, jobs = claim_jobs("worker-1", limit=1)
+        ProcessingJob.objects.exclude(pk=jobs[0].pk).update(status=ProcessingJob.DONE, success=True)
+        ProcessingJob.objects.filter(pk=jobs[0].pk).update(attempts=TASK_QUEUE_MAX_ATTEMPTS)
+        self.expire_lease(jobs)
+
+        self.assertEqual(requeue_stale_jobs(), 0)
+
+        job = ProcessingJob.objects.get(pk=jobs[0].pk)
+        self.assertEqual((job.status, job.success), (ProcessingJob.DONE, False))
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, ProcessingTask.FINISHED)
+
+
+class FakeServer:
+    ''' Session answering every GET with the same page, validated by its ETag, and recording the requests '''
+
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        self.requests.append(headers or {})
+
+        response = Response()
+        response.url = url
+        if (headers or {}).get("If-None-Match") == self.etag:
+            response.status_code = 304
+            response.headers = CaseInsensitiveDict({"ETag":self.etag})
+            response.raw = HTTPResponse(body=io.BytesIO(b""), preload_content=False)
+        else:
+            response.status_code = 200
+            response.headers = CaseInsensitiveDict({"ETag":self.etag, "Content-Type":"text/html"})
+            response.raw = HTTPResponse(body=io.BytesIO(self.body), preload_content=False)
+        return response
+
+
+class HttpCacheTests(TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        for patcher in (mock.patch("newdocs.http_cache.HTTP_CACHE_DIR", cache_dir.name),
+                        mock.patch("newdocs.http_cache._cache_size", None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_conditional_get(self):
+        server = FakeServer(b"<html>page</html>", '"v1"')
+
+        first = cached_get(server, "https://example.com/page")
+        self.assertEqual(first.content, b"<html>page</html>")
+        self.assertFalse(getattr(first, "from_cache", False))
+
+        second = cached_get(server, "https://example.com/page")
+        self.assertEqual(server.requests[1].get("If-None-Match"), '"v1"')
+        self.assertTrue(second.from_cache)
+        self.assertEqual(second.content, b"<html>page</html>")
+
+    def test_changed_page_downloaded_again(self):
+        server = FakeServer(b"<html>old</html>", '"v1"')
+        cached_get(server, "https://example.com/page").content
+
+        server.body, server.etag = b"<html>new</html>", '"v2"'
+        response = cached_get(server, "https://example.com/page")
+
+        self.assertEqual(response.content, b"<html>new</html>")
+        self.assertEqual(cached_get(server, "https://example.com/page").content, b"<html>new</html>")
+        self.assertEqual(server.requests[-1].get("If-None-Match"), '"v2"')
+
+    def test_refresh_ignores_cache(self):
+        server = FakeServer(b"<html>page</html>", '"v1"')
+        cached_get(server, "https://example.com/page").content
+
+        response = cached_get(server, "https://example.com/page", refresh=True)
+
+        self.assertEqual(server.requests[-1], {})
+        self.assertEqual(response.content, b"<html>page</html>")
+
+
+VALID_COMPLETION = json.dumps({"metadata":{"authors":["Ada Lovelace"], "title":"Notes", "slug":"notes", "categories":["Computing"],
+                                           "countries":["United Kingdom"], "date_published":"1843/10/01"},
+                               "summaries":{"short_summary":"short", "long_summary":"long"}})
+
+
+def streamed_response(status_code, body=b"<html><body>page</body></html>", content_type="text/html"):
+    response = Response()
+    response.url = "https://example.com/page"
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict({"Content-Type":content_type})
+    response.raw = HTTPResponse(body=io.BytesIO(body), preload_content=False)
+    return response
+
+
+class FetchTests(TestCase):
+    ''' responses are closed once read or refused, their connection goes back to the pool of the shared session '''
+
+    def fetch(self, function, response):
+        with mock.patch("newdocs.doc_processing.http_get", return_value=response):
+            return function("https://example.com/page")
+
+    def test_error_status_closed(self):
+        for status_code in (404, 503):
+            with self.subTest(status_code=status_code):
+                response = streamed_response(status_code)
+                self.assertTrue(self.fetch(get_doc, response).error)
+                self.assertTrue(response.raw.closed)
+
+                response = streamed_response(status_code)
+                self.assertIsNone(self.fetch(get_image, response))
+                self.assertTrue(response.raw.closed)
+
+    def test_page_closed_once_read(self):
+        response = streamed_response(200)
+        self.assertEqual(self.fetch(get_doc, response).html, b"<html><body>page</body></html>")
+        self.assertTrue(response.raw.closed)
+
+    def test_pdf_closed_once_spooled(self):
+        response = streamed_response(200, b"%PDF-1.4 document", "application/pdf")
+        with self.fetch(get_doc, response).pdf as pdf_file:
+            pdf_file.seek(0)
+            self.assertEqual(pdf_file.read(), b"%PDF-1.4 document")
+        self.assertTrue(response.raw.closed)
+
+
+@mock.patch("newdocs.llm_cache.LLM_CACHE_ENABLED", True)
+class CompletionCacheTests(TestCase):
+
+    def llm_job(self, prompt="Please extract metadata: the article"):
+        job = pipeline_job("https://example.com/notes")
+        job.update({"llm":"long", "prompt":prompt})
+        return job
+
+    def run_llm(self, job, completions):
+        ''' Runs the LLM stage with the model answering the given contents in turn, returns the number of calls '''
+
+        answers = [{"content":content, "model":"test-model"} for content in completions]
+        with mock.patch("newdocs.doc_processing.run_openai", side_effect=answers) as model:
+            llm_doc(job, "openai", "chatml", "test-model", MemoryProgress("test-task", 1))
+        return model.call_count
+
+    def test_miss_then_hit(self):
+        first = self.llm_job()
+        self.assertEqual(self.run_llm(first, [VALID_COMPLETION]), 1)
+        self.assertEqual(first["process_log"].get("cache_misses"), 1)
+        self.assertEqual(CompletionCache.objects.count(), 1)
+
+        second = self.llm_job()
+        self.assertEqual(self.run_llm(second, []), 0)
+        self.assertEqual(second["process_log"].get("cache_hits"), 1)
+        self.assertEqual(second["article"].title, "Notes")
+
+    def test_other_prompt_misses(self):
+        self.run_llm(self.llm_job(), [VALID_COMPLETION])
+
+        self.assertEqual(self.run_llm(self.llm_job("Please extract metadata: another article"), [VALID_COMPLETION]), 1)
+        self.assertEqual(CompletionCache.objects.count(), 2)
+
+    def test_invalid_json_not_cached(self):
+        # the invalid answer is healed by a second call, only the healed answer is stored
+        job = self.llm_job()
+        self.assertEqual(self.run_llm(job, ["{not json", VALID_COMPLETION]), 2)
+        self.assertTrue(job["process_log"]["success"])
+        self.assertEqual(list(CompletionCache.objects.values_list("completion", flat=True)),
+                         [{"content":VALID_COMPLETION, "model":"test-model"}])
+
+        # the same prompt goes to the model again
+        self.assertEqual(self.run_llm(self.llm_job(), [VALID_COMPLETION]), 1)
+
+    def test_evict_least_recently_used(self):
+        now = timezone.now()
+        for i in range(3):
+            entry = CompletionCache.objects.create(key=f"key-{i}", client="openai", model="test-model", completion={})
+            # last_used_at is set on creation (auto_now_add)
+            CompletionCache.objects.filter(pk=entry.pk).update(last_used_at=now-timedelta(minutes=3-i))
+
+        with mock.patch("newdocs.llm_cache.LLM_CACHE_MAX_ENTRIES", 2):
+            evict(force=True)
+
+        self.assertEqual(sorted(CompletionCache.objects.values_list("key", flat=True)), ["key-1", "key-2"])
+
+
+class FastParseTests(TestCase):
+
+    def test_same_output_as_full_parse(self):
+        for category in ("Arxiv", "Youtube"):
+            for name, html in fixture_pages(category, count=2, size_kb=40):
+                with self.subTest(name):
+                    fast, full = fast_parse(html, category), full_parse(html, category)
+                    self.assertIsNotNone(fast)
+                    self.assertEqual(fast[category.lower()], full[category.lower()])
+                    self.assertEqual(fast["og_image"], full["og_image"])
+
+    def test_incomplete_arxiv_page_parsed_entirely(self):
+        html = arxiv_page(size_kb=10).replace(b'class="primary-subject"', b'class="subject"')
+
+        self.assertIsNone(fast_parse(html, "Arxiv"))
+        page = parse_html(html, "Arxiv")
+        self.assertEqual(page["arxiv"]["categories"], [])
+        self.assertTrue(page["text"])
+
+
+class ParseStageTests(TestCase):
+
+    def parse(self, text):
+        job = pipeline_job("https://example.com/page")
+        progress = MemoryProgress("test-task", 1)
+        page = {"youtube":None, "arxiv":None, "text":text, "og_image":None, "first_image":None}
+        with mock.patch("newdocs.doc_processing.extract_doc", return_value=page):
+            return parse_doc(job, progress, "openai", "gpt-3.5-turbo-1106"), progress
+
+    def test_text_sent_to_model(self):
+        job, progress = self.parse("Title\n\nThe main content of the page.")
+
+        self.assertEqual(job["llm"], "long")
+        self.assertIn("The main content of the page.", job["prompt"])
+        self.assertEqual(progress.failed_docs["count"], 0)
+
+    def test_empty_context_fails(self):
+        for text in (None, "", " \n\n\t "):
+            with self.subTest(text=text):
+                job, progress = self.parse(text)
+
+                self.assertIsNone(job["llm"])
+                self.assertFalse(job["process_log"]["success"])
+                self.assertEqual(progress.failed_docs["count"], 1)
+
+
+@mock.patch("backend.sqlite.SQLITE_SINGLE_WRITER", False)
+class TaxonomyIndexTests(TestCase):
+
+    def setUp(self):
+        vector_store = tempfile.TemporaryDirectory()
+        self.addCleanup(vector_store.cleanup)
+        patchers = [mock.patch("newdocs.taxonomy.VECTOR_STORE_DIR", vector_store.name)]
+        # a process that has not loaded the indexes yet
+        patchers += [mock.patch.dict(getattr(taxonomy, state), clear=True) for state in ("_indexes", "_lowercase", "_unsaved", "_pending", "_loaded")]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def vector(self, *values):
+        return np.asarray(values, dtype=np.float32)
+
+    def saved_names(self):
+        return set(IVFIndex.load(taxonomy.index_path("category")).labels)
+
+    def test_names_of_other_processes_kept(self):
+        taxonomy.index_terms({"category":{"Robotics":self.vector(1, 0, 0, 0)}})
+        taxonomy.save_indexes(force=True)
+
+        # another worker adds a name to the file
+        with taxonomy.index_lock("category"):
+            other = IVFIndex.load(taxonomy.index_path("category"))
+            other.add(["Climate"], np.asarray([self.vector(0, 1, 0, 0)]))
+            other.save(taxonomy.index_path("category"))
+
+        self.assertIn("Climate", taxonomy.get_index("category").labels)
+        self.assertEqual(taxonomy._lowercase["category"]["climate"], "Climate")
+
+        taxonomy.index_terms({"category":{"Energy":self.vector(0, 0, 1, 0)}})
+        taxonomy.save_indexes(force=True)
+        self.assertEqual(self.saved_names(), {"Robotics", "Climate", "Energy"})
+
+    def test_unsaved_names_merged_when_writing(self):
+        taxonomy.index_terms({"category":{"Robotics":self.vector(1, 0, 0, 0)}})
+
+        # written by another worker while this one still holds a name in memory
+        other = IVFIndex()
+        other.add(["Climate"], np.asarray([self.vector(0, 1, 0, 0)]))
+        other.save(taxonomy.index_path("category"))
+
+        taxonomy.save_indexes(force=True)
+        self.assertEqual(self.saved_names(), {"Robotics", "Climate"})
+
+
+def transcoded_image(color="red", size=(640, 480)):
+    ''' JPEG image transcoded as by the parse pool '''
+
+    content = io.BytesIO()
+    Image.new("RGB", size, color).save(content, "JPEG")
+    return process_image(content.getvalue(), THUMBNAIL_SIZES)
+
+
+class ImageStoreTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        patcher = mock.patch("newdocs.thumbnails.MEDIA_ROOT", media_root.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.media_root = media_root.name
+
+        self.docs = [LoggedDoc.objects.create(slug=f"doc-{i}", title=f"doc-{i}", source_url=f"https://example.com/{i}")
+                     for i in range(2)]
+
+    def exists(self, image):
+        return [os.path.isfile(os.path.join(self.media_root, path)) for path in image_files(image)]
+
+    def staged(self):
+        directory = os.path.join(self.media_root, STAGING_DIR)
+        return os.listdir(directory) if os.path.isdir(directory) else []
+
+    def store(self, doc_images):
+        with self.captureOnCommitCallbacks(execute=True):
+            return store_doc_images(doc_images)
+
+    def test_same_image_stored_once(self):
+        image = transcoded_image()
+        first, second = self.store([(doc, image) for doc in self.docs])
+
+        stored = StoredImage.objects.get()
+        self.assertEqual(first.stored_id, stored.pk)
+        self.assertEqual(second.stored_id, stored.pk)
+        self.assertEqual(stored.ref_count, 2)
+        self.assertTrue(all(self.exists(stored)))
+        self.assertEqual(self.staged(), [])
+
+        # shown again by a document, nothing is written
+        with mock.patch("newdocs.image_store.write_image") as write_image:
+            self.store([(self.docs[0], image)])
+        write_image.assert_not_called()
+        self.assertEqual(DocImage.objects.count(), 2)
+
+    def test_images_and_links_stored_together(self):
+        # a link that can't be created leaves no unreferenced image that a collection could delete meanwhile
+        with mock.patch.object(DocImage.objects, "bulk_create", side_effect=RuntimeError("insert failed")):
+            with self.assertRaises(RuntimeError):
+                self.store([(self.docs[0], transcoded_image())])
+
+        self.assertFalse(StoredImage.objects.exists())
+
+    def test_release_after_the_last_reference(self):
+        first, second = self.store([(doc, transcoded_image()) for doc in self.docs])
+        stored = StoredImage.objects.get()
+
+        first.delete()
+        self.assertEqual(release_unreferenced(), 0)
+        self.assertEqual(StoredImage.objects.get().ref_count, 1)
+        self.assertTrue(all(self.exists(stored)))
+
+        second.delete()
+        self.assertEqual(release_unreferenced(), 1)
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertFalse(any(self.exists(stored)))
+
+    def test_rollback_leaves_no_file(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    images = store_doc_images([(self.docs[0], transcoded_image("blue"))])
+                    raise RuntimeError("batch failed")
+
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertFalse(any(self.exists(images[0])))
 
-# Create your tests here.
\ No newline at end of file
+        # left under their temporary name until they are old enough not to belong to an open transaction
+        self.assertTrue(self.staged())
+        self.assertEqual(delete_staged(), 0)
+        self.assertEqual(delete_staged(max_age=-1), len(image_files(images[0])))
+        self.assertEqual(self.staged(), [])
@@ -0,0 +1,127 @@
+import os
+import time
+from uuid import uuid4
+
+from django.conf import settings
+
+MEDIA_ROOT=settings.MEDIA_ROOT
+
+# Files of the images of the documents (DocImage), in MEDIA_ROOT/images. The bytes are transcoded in the parse pool
+# by image_processing.process_images: the original is kept as <name>.<extension of its real format> and each size
+# is written next to it as <name>_<size>.webp and <name>_<size>.jpg, the name being the hash of the original
+# (see newdocs/image_store.py). The tiles of the home page show the small variant,
+# the page of a document the large one, the original is only shown when editing the document.
+
+# size name -> (max width, max height) in pixels, tall images are capped at twice the width of the small variant
+THUMBNAIL_SIZES={"small":(settings.THUMBNAIL_SMALL_WIDTH, 2*settings.THUMBNAIL_SMALL_WIDTH),
+                 "large":(settings.THUMBNAIL_LARGE_WIDTH, settings.THUMBNAIL_LARGE_WIDTH)}
+
+VARIANT_EXTENSIONS={"webp":"webp", "jpeg":"jpg"}
+
+# files written under a temporary name until the rows showing them are committed (see image_store.store_images),
+# those of a transaction rolled back are deleted after STAGING_MAX_AGE seconds
+STAGING_DIR=os.path.join('images', 'staging')
+STAGING_MAX_AGE=3600
+
+
+def write_file(relative_path, content, staged=None):
+    ''' :staged: list, if given the file is written in STAGING_DIR under a unique name
+    and (temporary path, path) is appended to it, see move_staged '''
+
+    if staged is not None:
+        temporary_path=os.path.join(STAGING_DIR, f"{uuid4().hex}{os.path.splitext(relative_path)[1]}")
+        staged.append((temporary_path, relative_path))
+        relative_path=temporary_path
+
+    path=os.path.join(MEDIA_ROOT, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as image_file:
+        image_file.write(content)
+
+def write_variants(name, image, staged=None):
+    ''' Writes the variants of a transcoded image and returns their paths, the value of DocImage.variants
+    {size name: {"width", "height", "webp": path, "jpeg": path}}
+    :name: file name without extension, the variants are images/<name>_<size>.<format>
+    :staged: see write_file '''
+
+    variants={}
+    written={}
+    for size, variant in image["variants"].items():
+        # an image smaller than both sizes has the same variant for both, written once
+        if id(variant) in written:
+            variants[size]=written[id(variant)]
+            continue
+
+        variants[size]=written[id(variant)]={"width":variant["width"], "height":variant["height"]}
+        for image_format, extension in VARIANT_EXTENSIONS.items():
+            if image_format in variant:
+                relative_path=os.path.join('images', f"{name}_{size}.{extension}")
+                write_file(relative_path, variant[image_format], staged)
+                variants[size][image_format]=relative_path
+
+    return variants
+
+def write_image(name, image, staged=None):
+    ''' Writes the original and the variants of a transcoded image (see image_processing.process_image)
+    Returns the fields of its DocImage: image_url, format, width, height and variants
+    :name: file name without extension
+    :staged: see write_file, the fields hold the final paths '''
+
+    relative_path=os.path.join('images', f"{name}.{image['extension']}")
+    write_file(relative_path, image["content"], staged)
+
+    return {"image_url":relative_path,
+            "format":image["format"],
+            "width":image["width"],
+            "height":image["height"],
+            "variants":write_variants(name, image, staged)}
+
+def move_staged(staged):
+    ''' Moves files written by write_file under a temporary name to their path '''
+
+    for temporary_path, relative_path in staged:
+        path=os.path.join(MEDIA_ROOT, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(os.path.join(MEDIA_ROOT, temporary_path), path)
+
+def delete_staged(max_age=STAGING_MAX_AGE):
+    ''' Deletes the files left in STAGING_DIR for more than max_age seconds, never moved as their transaction was rolled back
+    Returns the number of files deleted '''
+
+    directory=os.path.join(MEDIA_ROOT, STAGING_DIR)
+    if not os.path.isdir(directory):
+        return 0
+
+    deleted=0
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and time.time()-entry.stat().st_mtime>max_age:
+                os.remove(entry.path)
+                deleted+=1
+        except OSError:
+            pass
+
+    return deleted
+
+def image_files(image):
+    ''' Paths of the files of a DocImage, relative to MEDIA_ROOT '''
+
+    paths=[image.image_url]
+    for variant in (image.variants or {}).values():
+        paths.extend(variant[image_format] for image_format in VARIANT_EXTENSIONS if image_format in variant)
+
+    return paths
+
+def delete_image_files(image):
+    for relative_path in image_files(image):
+        path=os.path.join(MEDIA_ROOT, relative_path)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    # the directory of a stored image (images/<2 first characters of its hash>, see newdocs/image_store.py) once empty
+    directory=os.path.dirname(image.image_url)
+    if directory!='images':
+        try:
+            os.rmdir(os.path.join(MEDIA_ROOT, directory))
+        except OSError:
+            pass
@@ -10,6 +10,7 @@ urlpatterns = [
     path('<slug:document_slug>/resubmit', views.resubmit_document, name='resubmit_document'),
     path('manual', views.manual, name='manual'),
     path('progress-update/<str:task_id>/', views.progress_update, name='progress_update'),
+    path('progress-stream/<str:task_id>/', views.progress_stream, name='progress_stream'),
     path('process-summary', views.process_summary, name='process_summary'),
     path('process-complete', views.process_complete, name='process_complete'),
     ]
\ No newline at end of file
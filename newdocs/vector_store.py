@@ -0,0 +1,257 @@
+import os
+import json
+import tempfile
+from contextlib import contextmanager
+from threading import Lock
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # Windows, writers are only serialized within a process
+    fcntl = None
+
+# Embeddings of the documents kept as one contiguous float32 matrix on disk (vectors.npy) with the id of the document
+# of each row (ids.npy), both memory-mapped so that a search reads the matrix without loading or decoding it.
+# Rows are normalized when they are added, so a cosine similarity is a dot product, computed by blocks with NumPy.
+# meta.json holds the number of rows in use: rows are written before it is replaced, so readers (other threads or
+# processes) never see a partial row. The files grow by doubling and a removed document leaves an empty row (id -1)
+# until the store is rebuilt.
+
+SEARCH_BLOCK_ROWS=65536 # rows multiplied at once by search, bounds the memory of a search
+
+
+class DimensionMismatch(ValueError):
+    pass
+
+class VectorStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._meta_stat = None
+        self.count = 0
+        self.dim = None
+        self.vectors = None
+        self.ids = None
+        self.rows = {}
+
+    ## FILES
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _write_lock(self):
+        ''' One writer at a time, across threads and processes '''
+
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, open(self._file("lock"), "w") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _refresh(self):
+        ''' Maps the files again if another writer changed them since they were mapped '''
+
+        try:
+            stat = os.stat(self._file("meta.json"))
+        except FileNotFoundError:
+            self.count, self.dim, self.vectors, self.ids, self.rows = 0, None, None, None, {}
+            self._meta_stat = None
+            return
+
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key == self._meta_stat:
+            return
+
+        with open(self._file("meta.json")) as meta_file:
+            meta = json.load(meta_file)
+
+        self._map(meta["count"], meta["dim"])
+        ids = self.ids[:self.count].tolist()
+        self.rows = {doc_id: row for row, doc_id in enumerate(ids) if doc_id >= 0}
+        self._meta_stat = key
+
+    def _map(self, count, dim):
+        self.count, self.dim = count, dim
+        self.vectors = np.load(self._file("vectors.npy"), mmap_mode="r")
+        self.ids = np.load(self._file("ids.npy"), mmap_mode="r")
+
+    def _written(self, count, dim, rows):
+        ''' State of the writer after its own write, without reading back the ids 
+        :rows: {doc id: row} added (or None for removed documents) '''
+
+        for doc_id, row in rows.items():
+            if row is None:
+                self.rows.pop(doc_id, None)
+            else:
+                self.rows[doc_id] = row
+        self._map(count, dim)
+        stat = os.stat(self._file("meta.json"))
+        self._meta_stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _write_meta(self, count, dim):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "w") as meta_file:
+            json.dump({"count": count, "dim": dim}, meta_file)
+        os.replace(tmp_path, self._file("meta.json"))
+
+    def _create_files(self, capacity, dim, vectors=None, ids=None):
+        ''' Writes new files of the given capacity (with the rows passed, if any) and swaps them in.
+        Readers keep the old files mapped until they notice the new meta '''
+
+        for name, dtype, shape, rows in [("vectors.npy", np.float32, (capacity, dim), vectors),
+                                         ("ids.npy", np.int64, (capacity,), ids)]:
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".npy")
+            os.close(fd)
+            array = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+            if name == "ids.npy":
+                array[:] = -1
+            if rows is not None and len(rows):
+                array[:len(rows)] = rows
+            array.flush()
+            del array
+            os.replace(tmp_path, self._file(name))
+
+    ## WRITES
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors/norms
+
+    def add(self, doc_ids, vectors):
+        ''' Adds or replaces the embeddings of documents
+        :doc_ids: list of LoggedDoc ids
+        :vectors: array (len(doc_ids), dim), raises DimensionMismatch if the store holds vectors of another size '''
+
+        if not len(doc_ids):
+            return
+
+        vectors = self._normalize(vectors)
+
+        with self._write_lock():
+            self._refresh()
+
+            if self.dim is not None and vectors.shape[1] != self.dim:
+                raise DimensionMismatch(f"vectors of size {vectors.shape[1]}, the store holds vectors of size {self.dim}, rebuild it")
+
+            # a document listed twice keeps its last vector
+            latest = {int(doc_id): index for index, doc_id in enumerate(doc_ids)}
+            new_ids = [doc_id for doc_id in latest if doc_id not in self.rows]
+            count = self.count + len(new_ids)
+            capacity = len(self.ids) if self.ids is not None else 0
+
+            if count > capacity or self.dim is None:
+                current_vectors = self.vectors[:self.count] if self.count else None
+                current_ids = self.ids[:self.count] if self.count else None
+                self._create_files(max(2*capacity, count, 1024), vectors.shape[1], current_vectors, current_ids)
+
+            all_vectors = np.load(self._file("vectors.npy"), mmap_mode="r+")
+            all_ids = np.load(self._file("ids.npy"), mmap_mode="r+")
+
+            # rows of the documents already stored are overwritten in place, new ones are appended
+            new_rows = {doc_id: self.count+offset for offset, doc_id in enumerate(new_ids)}
+            targets = np.array([self.rows.get(doc_id, new_rows.get(doc_id)) for doc_id in latest], dtype=np.int64)
+            all_vectors[targets] = vectors[list(latest.values())]
+            all_ids[targets] = list(latest)
+            all_vectors.flush()
+            all_ids.flush()
+            del all_vectors, all_ids
+
+            self._write_meta(count, vectors.shape[1])
+            self._written(count, vectors.shape[1], new_rows)
+
+    def remove(self, doc_ids):
+        ''' Empties the rows of deleted documents, they are dropped when the store is rebuilt '''
+
+        with self._write_lock():
+            self._refresh()
+            removed = [doc_id for doc_id in doc_ids if doc_id in self.rows]
+            if not removed:
+                return
+            rows = [self.rows[doc_id] for doc_id in removed]
+
+            all_vectors = np.load(self._file("vectors.npy"), mmap_mode="r+")
+            all_ids = np.load(self._file("ids.npy"), mmap_mode="r+")
+            all_vectors[rows] = 0
+            all_ids[rows] = -1
+            all_vectors.flush()
+            all_ids.flush()
+            del all_vectors, all_ids
+
+            self._write_meta(self.count, self.dim)
+            self._written(self.count, self.dim, {doc_id: None for doc_id in removed})
+
+    def rebuild(self, doc_ids, vectors):
+        ''' Replaces the content of the store, without empty rows '''
+
+        vectors = self._normalize(vectors) if len(doc_ids) else np.zeros((0, 0), dtype=np.float32)
+
+        with self._write_lock():
+            dim = vectors.shape[1] if len(doc_ids) else 0
+            self._create_files(max(len(doc_ids), 1024), dim, vectors, np.asarray(doc_ids, dtype=np.int64))
+            self._write_meta(len(doc_ids), dim if len(doc_ids) else None)
+            self._refresh()
+
+    ## SEARCH
+
+    def distances(self, vector):
+        ''' Cosine distance (1 - similarity) of every row to a vector, and the ids of the rows (-1 for empty rows) '''
+
+        self._refresh()
+        if not self.count:
+            return np.zeros(0), np.zeros(0, dtype=np.int64)
+
+        vector = self._normalize(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0]
+        if vector.shape[0] != self.dim:
+            raise DimensionMismatch(f"query of size {vector.shape[0]}, the store holds vectors of size {self.dim}")
+
+        vectors, ids = self.vectors, self.ids
+        similarities = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+            end = min(start+SEARCH_BLOCK_ROWS, self.count)
+            np.dot(vectors[start:end], vector, out=similarities[start:end])
+
+        return 1.0-similarities.astype(np.float64), np.array(ids[:self.count])
+
+    def ranked(self, vector, after=None, chunk_size=200):
+        '''
+        Yields (doc id, distance) of the stored documents, closest first, then by decreasing id.
+        The distances are computed once, the order is sorted one chunk at a time.
+        :after: (distance, id) of the last document of the previous page
+        '''
+
+        distances, ids = self.distances(vector)
+        remaining = ids >= 0
+
+        while True:
+            if after:
+                remaining &= (distances > after[0]) | ((distances == after[0]) & (ids < after[1]))
+
+            candidates = np.flatnonzero(remaining)
+            if not len(candidates):
+                return
+
+            # the chunk_size closest, keeping every row tied with the last one so that ids break the ties
+            if len(candidates) > chunk_size:
+                threshold = np.partition(distances[candidates], chunk_size-1)[chunk_size-1]
+                candidates = candidates[distances[candidates] <= threshold]
+
+            order = candidates[np.lexsort((-ids[candidates], distances[candidates]))][:chunk_size]
+            for row in order:
+                yield int(ids[row]), float(distances[row])
+
+            after = (float(distances[order[-1]]), int(ids[order[-1]]))
+
+    def search(self, vector, k=10):
+        ''' The k closest documents, list of (doc id, distance) '''
+
+        results = []
+        for result in self.ranked(vector, chunk_size=k):
+            results.append(result)
+            if len(results) == k:
+                break
+        return results
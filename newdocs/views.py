@@ -1,15 +1,25 @@
 import json
+import time
 from threading import Thread
 from urllib.parse import urlparse
 
+from django.conf import settings
 from django.shortcuts import render
-from django.http import JsonResponse
-from django.core.cache import cache
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db.models import Sum, OuterRef, Subquery
 
-from newdocs.doc_processing import processing_start
+from newdocs.task_queue import enqueue_task, worker_loop
+from newdocs.doc_processing import local_progress, progress_published, running_tasks
+from newdocs.task_state import progress_key, get_state, set_state, delete_state
 from articles.forms import AuthorFormset, CategoryFormset, CountryFormset
 from backend.models import LoggedDoc, ChatFormat, OpenaiModel, ProcessingLog
 
+LOOKUP_CHUNK_SIZE=500 # URLs per query in augment_urls
+PROGRESS_STREAM_TIMEOUT=settings.PROGRESS_STREAM_TIMEOUT
+PROGRESS_STREAM_POLL=5 # seconds between two reads of the progress of a task processed by another process
+PROGRESS_STREAM_KEEPALIVE=15 # seconds without event before a comment is sent, so that proxies keep the connection open
+DEFAULT_PROGRESS={"progress":0, "processing_step":"launching..."}
+
 ## UTILS
 
 def validate_url(url):
@@ -47,19 +57,34 @@ def classify_urls(urls): #urls is a list of strings
 def augment_urls(urls): #urls is a list of strings
     '''
     check if urls exist in the database and add information about the last processing
+    two queries per chunk of URLs: the documents, then the latest log of each existing document
     '''
 
+    slugs = {}
+    last_logs = {}
+
+    # chunks keep the number of variables of each query below the limit of SQLite
+    for start in range(0, len(urls), LOOKUP_CHUNK_SIZE):
+        chunk = urls[start:start+LOOKUP_CHUNK_SIZE]
+        chunk_slugs = dict(LoggedDoc.objects.filter(source_url__in=chunk).values_list('source_url', 'slug'))
+        slugs.update(chunk_slugs)
+
+        if chunk_slugs:
+            # latest log of each URL, found through the (source_url, created_at) index
+            latest = ProcessingLog.objects.filter(source_url=OuterRef('source_url')).order_by('-created_at', '-id').values('id')[:1]
+            logs = ProcessingLog.objects.filter(source_url__in=list(chunk_slugs), id=Subquery(latest))
+            last_logs.update({log.source_url: log for log in logs})
+
     augmented_urls = []
 
     for url in urls:
         url_info = {"url":url, "exists":False, 'slug':None, "last_processing":None, "was_success":None, "output":None, 'model':None}
 
         #check if the url already exists in the database
-        try:
-            existing_doc = LoggedDoc.objects.get(source_url=url)
+        if url in slugs:
             url_info["exists"]=True
-            url_info["slug"]=existing_doc.slug
-            last_processing=ProcessingLog.objects.filter(source_url=url).order_by('-created_at').first()
+            url_info["slug"]=slugs[url]
+            last_processing=last_logs.get(url)
         
             if last_processing is not None:
                 url_info["last_processing"]=last_processing.created_at
@@ -67,13 +92,54 @@ def augment_urls(urls): #urls is a list of strings
                 url_info["output"]=last_processing.llm_output
                 url_info["model"]=last_processing.llm
 
-        except LoggedDoc.DoesNotExist:
-            pass
-
         augmented_urls.append(url_info)
 
     return augmented_urls
 
+def progress_finished(progress):
+    return progress.get("progress", 0)>=100 or progress.get("processing_step")=="finished"
+
+def progress_events(task_id):
+    '''
+    Server-sent events of the progress of a task: a "progress" event with the progress JSON (see progress_update)
+    every time it changes, until the task is finished or the stream has been open PROGRESS_STREAM_TIMEOUT seconds
+    The progress of a task processed by this process is read from memory when its pipeline publishes it, that of
+    a task processed by another process from the task state store every PROGRESS_STREAM_POLL seconds
+    '''
+
+    # the browser reconnects 2 seconds after the stream is closed, unless the task is finished
+    yield "retry: 2000\n\n"
+
+    last = None
+    now = time.monotonic()
+    deadline, keepalive = now+PROGRESS_STREAM_TIMEOUT, now+PROGRESS_STREAM_KEEPALIVE
+
+    while now<deadline:
+        with progress_published:
+            progress = local_progress.get(task_id) if task_id in running_tasks else None
+        if progress is None:
+            progress = get_state(progress_key(task_id), DEFAULT_PROGRESS)
+
+        if progress!=last:
+            last = progress
+            keepalive = now+PROGRESS_STREAM_KEEPALIVE
+            yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+            if progress_finished(progress):
+                return
+
+        elif now>=keepalive:
+            keepalive = now+PROGRESS_STREAM_KEEPALIVE
+            yield ": keepalive\n\n"
+
+        with progress_published:
+            if task_id in running_tasks:
+                # until this process publishes a new progress of the task or stops processing it
+                progress_published.wait_for(lambda: task_id not in running_tasks or local_progress.get(task_id) not in (None, last),
+                                            max(keepalive-now, 0))
+            else:
+                progress_published.wait_for(lambda: task_id in running_tasks, PROGRESS_STREAM_POLL)
+        now = time.monotonic()
+
 ## VIEWS 
 
 def new_docs(request):
@@ -200,6 +266,8 @@ def launch_processing(request):
             chat_format = request.POST.get('chat')
             model = request.POST.get('model_name')
             selected_urls = request.POST.getlist('selected_urls')
+            refresh_cache = request.POST.get('refresh_cache') == 'true'
+            bypass_llm_cache = request.POST.get('bypass_llm_cache') == 'true'
 
             #check if the urls are valid
             selected_urls = [validate_url(url) for url in selected_urls]
@@ -211,9 +279,17 @@ def launch_processing(request):
             task_id = request.POST.get('task_id')
             print(data, client) 
 
-            #lauch thread for a long process
-            thread = Thread(target=processing_start, args=(data, client, chat_format, model, task_id))
-            thread.start()
+            #the progress is stored before the task is queued, so that a worker always overwrites it
+            total = sum(len(urls) for urls in data.values())
+            set_state(progress_key(task_id), {**DEFAULT_PROGRESS, "processing_step":"queued", "completed":0, "total":total})
+
+            #the task is stored in the DB so that it survives a restart of the server, and is processed by the workers
+            enqueue_task(data, client, chat_format, model, task_id, refresh_cache, bypass_llm_cache)
+
+            #unless external workers are running (manage.py process_tasks), a thread of this process drains the queue
+            if settings.TASK_QUEUE_WORKER == 'inline':
+                thread = Thread(target=worker_loop, kwargs={"once":True})
+                thread.start()
 
             response_content = {'status': 'processing started', 'task_id': task_id}
             
@@ -231,13 +307,23 @@ def launch_processing(request):
 def progress_update(request, task_id):
     '''
     Whilst the processing is ongoing, this view is called by an AJAX request
-    to get information about the progress from the cache
+    to get information about the progress from the task state store, shared by all the processes
     '''
 
-    default_progress_message = {"progress":0, "processing_step":"launching..."}
-
-    progress = cache.get(f"progress_task_{task_id}", default_progress_message)
+    progress = get_state(progress_key(task_id), DEFAULT_PROGRESS)
     return JsonResponse(progress)
+
+def progress_stream(request, task_id):
+    '''
+    Progress of a task pushed to the browser as server-sent events (EventSource) while the processing is ongoing,
+    progress_update is the polling fallback
+    '''
+
+    response = StreamingHttpResponse(progress_events(task_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # nginx would otherwise buffer the events
+    response["X-Accel-Buffering"] = "no"
+    return response
     
 def process_summary(request):
     ''' This is the one-but-last stage of the addition pipeline
@@ -253,7 +339,10 @@ def process_summary(request):
             task_id = request.POST.get('task_id')
             duration = float(request.POST.get('duration'))
             
-            total = len(selected_urls) if selected_urls else 0
+            #total of the task as counted by the pipeline, the task is over so its progress is dropped
+            progress = get_state(progress_key(task_id), {})
+            total = progress.get("total", len(selected_urls) if selected_urls else 0)
+            delete_state(progress_key(task_id))
 
             #retrieve info from processing log
             logs = ProcessingLog.objects.filter(task_id=task_id)
@@ -261,6 +350,7 @@ def process_summary(request):
             processed_by_llm = logs.filter(llm_turns__gt=0).count()
             two_shot_success = logs.filter(success=True, llm_turns__gt=1).count()
             failed_json = logs.filter(success=False, llm_turns__gt=1).count()
+            cache_stats = logs.aggregate(hits=Sum('cache_hits'), misses=Sum('cache_misses'))
             model = logs.exclude(llm=None).values_list('llm', flat=True).distinct()
             if len(model)>0:
                 model = model[0]
@@ -280,6 +370,8 @@ def process_summary(request):
                      'processed_by_llm': processed_by_llm,
                      'two_shot_success': two_shot_success,
                      'failed_json': failed_json,
+                     'cache_hits': cache_stats['hits'] or 0,
+                     'cache_misses': cache_stats['misses'] or 0,
                      'minutes': minutes,
                      'seconds': seconds}
             
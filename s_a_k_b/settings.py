@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 from pathlib import Path
 from django.core.management.commands.runserver import Command as runserver
-from decouple import config
+from decouple import config, Choices
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -30,6 +30,98 @@ LLM_API_KEY = config('LLM_API_KEY')
 LLM_API_URL = config('LLM_API_URL')
 LLAMA_CPP_SERVER_URL = config('LLAMA_CPP_SERVER_URL')
 
+# documents per page of the home page (the next pages are loaded while scrolling)
+HOMEPAGE_PAGE_SIZE = config('HOMEPAGE_PAGE_SIZE', default=50, cast=int)
+# authors, categories and countries with the most documents listed next to the filters
+HOMEPAGE_FACET_SIZE = config('HOMEPAGE_FACET_SIZE', default=10, cast=int)
+# seconds the rendered tiles of the home page and document pages are cached (0 renders them on every request)
+DOC_CACHE_TIMEOUT = config('DOC_CACHE_TIMEOUT', default=86400, cast=int)
+# where they are cached, shared by the processes of the server: files in DOC_CACHE_LOCATION (default ./doc_cache),
+# redis at the DOC_CACHE_LOCATION url (redis://..., requires pip install redis) or memory (one copy per process),
+# at most DOC_CACHE_MAX_ENTRIES tiles and pages (files and memory)
+DOC_CACHE_BACKEND = config('DOC_CACHE_BACKEND', default='file', cast=Choices(['file', 'redis', 'memory']))
+DOC_CACHE_LOCATION = config('DOC_CACHE_LOCATION', default=os.path.join(BASE_DIR, 'doc_cache'))
+DOC_CACHE_MAX_ENTRIES = config('DOC_CACHE_MAX_ENTRIES', default=20000, cast=int)
+
+CACHES = {
+    'default': {
+        'BACKEND': {'file': 'django.core.cache.backends.filebased.FileBasedCache',
+                    'redis': 'django.core.cache.backends.redis.RedisCache',
+                    'memory': 'django.core.cache.backends.locmem.LocMemCache'}[DOC_CACHE_BACKEND],
+        'LOCATION': DOC_CACHE_LOCATION,
+        'OPTIONS': {} if DOC_CACHE_BACKEND == 'redis' else {'MAX_ENTRIES': DOC_CACHE_MAX_ENTRIES},
+    }
+}
+
+# Document processing
+# number of URLs downloaded in parallel (pages, PDFs and thumbnails) and timeout of each request in seconds
+FETCH_MAX_WORKERS = config('FETCH_MAX_WORKERS', default=8, cast=int)
+FETCH_TIMEOUT = config('FETCH_TIMEOUT', default=30, cast=int)
+# number of processes parsing documents (HTML and PDF) in parallel, 0 parses them in the pipeline thread
+PARSE_MAX_WORKERS = config('PARSE_MAX_WORKERS', default=os.cpu_count() or 1, cast=int)
+# tokens of a document sent to the model: the context of the model (OpenaiModel.context_length, or the context of a slot
+# of the llama.cpp server, LLAMA_CPP_CONTEXT_LENGTH if it can't be read) minus the completion, capped to CONTEXT_MAX_TOKENS
+CONTEXT_MAX_TOKENS = config('CONTEXT_MAX_TOKENS', default=6000, cast=int)
+LLAMA_CPP_CONTEXT_LENGTH = config('LLAMA_CPP_CONTEXT_LENGTH', default=8192, cast=int)
+# maximum number of documents waiting between two stages of the pipeline (fetch -> parse -> LLM -> database)
+PIPELINE_QUEUE_SIZE = config('PIPELINE_QUEUE_SIZE', default=4, cast=int)
+# maximum number of documents written to the database in one transaction
+PERSIST_BATCH_SIZE = config('PERSIST_BATCH_SIZE', default=20, cast=int)
+# progress of a task published at most once per PROGRESS_MIN_INTERVAL seconds (the updates in between are coalesced)
+# and seconds a progress stream (server-sent events) stays open before the browser reconnects
+PROGRESS_MIN_INTERVAL = config('PROGRESS_MIN_INTERVAL', default=0.5, cast=float)
+PROGRESS_STREAM_TIMEOUT = config('PROGRESS_STREAM_TIMEOUT', default=300, cast=int)
+# on-disk cache of downloaded pages, PDFs and thumbnails, revalidated with conditional requests (size in MB)
+HTTP_CACHE_ENABLED = config('HTTP_CACHE_ENABLED', default=True, cast=bool)
+HTTP_CACHE_DIR = config('HTTP_CACHE_DIR', default=os.path.join(BASE_DIR, 'http_cache'))
+HTTP_CACHE_MAX_BYTES = config('HTTP_CACHE_MAX_MB', default=500, cast=int)*1024*1024
+# thumbnails are transcoded in the parse pool to WebP and JPEG variants, at most THUMBNAIL_SMALL_WIDTH pixels wide
+# for the tiles of the home page and THUMBNAIL_LARGE_WIDTH for the page of a document (quality of the encoding 1-100)
+THUMBNAIL_SMALL_WIDTH = config('THUMBNAIL_SMALL_WIDTH', default=480, cast=int)
+THUMBNAIL_LARGE_WIDTH = config('THUMBNAIL_LARGE_WIDTH', default=1200, cast=int)
+THUMBNAIL_QUALITY = config('THUMBNAIL_QUALITY', default=80, cast=int)
+# PDFs are streamed to a temp file and rejected above this size (in MB)
+PDF_MAX_BYTES = config('PDF_MAX_MB', default=50, cast=int)*1024*1024
+# LLM completion cache: the same prompt sent with the same grammar to the same model is answered from the DB
+LLM_CACHE_ENABLED = config('LLM_CACHE_ENABLED', default=True, cast=bool)
+LLM_CACHE_TTL_DAYS = config('LLM_CACHE_TTL_DAYS', default=30, cast=int)
+LLM_CACHE_MAX_ENTRIES = config('LLM_CACHE_MAX_ENTRIES', default=10000, cast=int)
+# Task queue: URLs submitted in the UI are stored as jobs in the DB and processed by workers
+# 'inline' drains the queue in a thread of the web process, 'external' leaves it to `python manage.py process_tasks`
+TASK_QUEUE_WORKER = config('TASK_QUEUE_WORKER', default='inline')
+# number of jobs claimed at once by a worker, seconds after which the jobs of a silent worker are requeued, and retries
+TASK_QUEUE_BATCH_SIZE = config('TASK_QUEUE_BATCH_SIZE', default=20, cast=int)
+TASK_QUEUE_LEASE = config('TASK_QUEUE_LEASE', default=120, cast=int)
+TASK_QUEUE_MAX_ATTEMPTS = config('TASK_QUEUE_MAX_ATTEMPTS', default=3, cast=int)
+# seconds the progress of a task is kept in the database once it stopped changing
+TASK_STATE_TTL = config('TASK_STATE_TTL', default=86400, cast=int)
+# Semantic search: documents are embedded with the OpenAI embeddings API ('openai') or the /embedding endpoint of the
+# llama.cpp server ('llama_cpp_server', started with --embedding), empty to turn it off.
+# EMBEDDING_DIMENSIONS shortens the vectors of OpenAI text-embedding-3 models (0 keeps the size of the model)
+EMBEDDING_CLIENT = config('EMBEDDING_CLIENT', default='')
+EMBEDDING_MODEL = config('EMBEDDING_MODEL', default='text-embedding-3-small')
+EMBEDDING_DIMENSIONS = config('EMBEDDING_DIMENSIONS', default=512, cast=int)
+VECTOR_STORE_DIR = config('VECTOR_STORE_DIR', default=os.path.join(BASE_DIR, 'vector_store'))
+# authors, categories and countries proposed by the LLM are replaced by the closest existing name (cosine similarity of
+# their embeddings above the threshold), needs EMBEDDING_CLIENT
+TAXONOMY_MATCHING = config('TAXONOMY_MATCHING', default=True, cast=bool)
+TAXONOMY_MATCH_THRESHOLD = config('TAXONOMY_MATCH_THRESHOLD', default=0.9, cast=float)
+TAXONOMY_AUTHOR_MATCH_THRESHOLD = config('TAXONOMY_AUTHOR_MATCH_THRESHOLD', default=0.97, cast=float)
+# LLM clients: maximum number of simultaneous requests (for llama.cpp, match the --parallel slots of the server)
+# and optional requests/tokens per minute limits to stay below the API rate limits (0 means no limit)
+LLM_CLIENTS = {
+    'openai': {
+        'max_in_flight': config('OPENAI_MAX_IN_FLIGHT', default=10, cast=int),
+        'requests_per_minute': config('OPENAI_REQUESTS_PER_MINUTE', default=0, cast=int),
+        'tokens_per_minute': config('OPENAI_TOKENS_PER_MINUTE', default=0, cast=int),
+    },
+    'llama_cpp_server': {
+        'max_in_flight': config('LLAMA_CPP_MAX_IN_FLIGHT', default=4, cast=int),
+        'requests_per_minute': config('LLAMA_CPP_REQUESTS_PER_MINUTE', default=0, cast=int),
+        'tokens_per_minute': config('LLAMA_CPP_TOKENS_PER_MINUTE', default=0, cast=int),
+    },
+}
+
 
 # SECURITY WARNING: don't run with debug turned on in dev or production!
 if SERVER_TYPE == 'local':
@@ -90,10 +182,23 @@ WSGI_APPLICATION = 's_a_k_b.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# SQLite profile applied to every connection (see backend/sqlite.py), so that the home page and the admin can be used 
+# while documents are written: WAL journal, synchronous=NORMAL, SQLITE_BUSY_TIMEOUT milliseconds of waiting on a lock,
+# SQLITE_MMAP_SIZE bytes memory-mapped and a page cache of SQLITE_CACHE_SIZE (negative: KiB, positive: pages)
+SQLITE_CONCURRENCY = config('SQLITE_CONCURRENCY', default=True, cast=bool)
+SQLITE_BUSY_TIMEOUT = config('SQLITE_BUSY_TIMEOUT', default=20000, cast=int)
+SQLITE_SYNCHRONOUS = config('SQLITE_SYNCHRONOUS', default='NORMAL')
+SQLITE_MMAP_SIZE = config('SQLITE_MMAP_SIZE', default=268435456, cast=int)
+SQLITE_CACHE_SIZE = config('SQLITE_CACHE_SIZE', default=-65536, cast=int)
+# the writes of the document pipeline go through one writer thread per process
+SQLITE_SINGLE_WRITER = config('SQLITE_SINGLE_WRITER', default=True, cast=bool)
+
+# the SQLite backend of Django 5.0 with the transaction_mode option of Django 5.1 (see backend/sqlite_backend)
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'backend.sqlite_backend',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE' if SQLITE_CONCURRENCY else 'DEFERRED'},
     }
 }
 